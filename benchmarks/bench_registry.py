@@ -0,0 +1,295 @@
+"""Registry pull and push throughput benchmarks
+
+Each case pushes an image of `--layers` layers of `--layer-size`
+random bytes to an in-process stand-in registry and pulls it back.
+The push and pull are each run in a fresh process to measure their
+peak resident memory. For every operation the wall time, throughput
+of uncompressed layer content, registry requests by method and peak
+RSS are reported.
+
+    python benchmarks/bench_registry.py --layers 1,8 --layer-size 1MiB,16MiB
+
+Results written with `--output` can be compared against in later runs
+with `--baseline`, which fails if throughput drops by more than
+`--tolerance` or more requests are made.
+
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import multiprocessing
+import os
+import re
+import resource
+import sys
+import tempfile
+import time
+
+# benchmark the checkout rather than an installed version
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from stub_registry import StubRegistry  # noqa: E402
+
+SIZE_UNITS = {"": 1, "B": 1, "KiB": 2**10, "MiB": 2**20, "GiB": 2**30}
+
+
+def parse_size(size: str):
+    match = re.fullmatch(r"(\d+)\s*([KMG]iB|B)?", size.strip())
+    if match is None:
+        raise argparse.ArgumentTypeError(f"invalid size {size}")
+    return int(match.group(1)) * SIZE_UNITS[match.group(2) or ""]
+
+
+def format_size(size: int):
+    for unit in ("GiB", "MiB", "KiB"):
+        if size >= SIZE_UNITS[unit] and size % SIZE_UNITS[unit] == 0:
+            return f"{size // SIZE_UNITS[unit]}{unit}"
+    return f"{size}B"
+
+
+def _reset_peak_rss():
+    # linux allows resetting the peak resident set size of a process
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _peak_rss():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 2**10
+    except OSError:
+        pass
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macos and kilobytes elsewhere
+    return peak_rss if sys.platform == "darwin" else peak_rss * 2**10
+
+
+def _build_image(directory: str, name: str, layers: int, layer_size: int):
+    from python_docker.base import Image
+
+    image = Image(name, "latest", storage="file")
+    for i in range(layers):
+        layer_directory = os.path.join(directory, str(i))
+        os.makedirs(layer_directory)
+        with open(os.path.join(layer_directory, "data"), "wb") as f:
+            for offset in range(0, layer_size, 2**20):
+                f.write(os.urandom(min(2**20, layer_size - offset)))
+        image.add_layer_path(layer_directory, arcpath="/")
+    return image
+
+
+async def _async_operation(case, operation, image):
+    from python_docker.async_registry import AsyncRegistry
+
+    async with AsyncRegistry(case["url"]) as registry:
+        if operation == "push":
+            await registry.push_image(image, compression=case["compression"])
+        else:
+            await registry.pull_image(case["name"], "latest")
+
+
+def _sync_operation(case, operation, image):
+    from python_docker.registry import Registry
+
+    registry = Registry(case["url"])
+    if operation == "push":
+        registry.push_image(image, compression=case["compression"])
+    else:
+        registry.pull_image(case["name"], "latest")
+
+
+def _run_operation(case, operation, results):
+    with tempfile.TemporaryDirectory() as directory:
+        image = None
+        if operation == "push":
+            image = _build_image(
+                directory, case["name"], case["layers"], case["layer_size"]
+            )
+
+        _reset_peak_rss()
+        start = time.perf_counter()
+        if case["client"] == "async":
+            asyncio.run(_async_operation(case, operation, image))
+        else:
+            _sync_operation(case, operation, image)
+        results.put({"seconds": time.perf_counter() - start, "peak_rss": _peak_rss()})
+
+
+def run_case(registry: StubRegistry, case: dict, operation: str):
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    start_request = len(registry.requests)
+
+    process = context.Process(target=_run_operation, args=(case, operation, results))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError(f"{operation} failed for case {case}")
+    result = results.get()
+
+    requests = {}
+    for method, _ in registry.requests[start_request:]:
+        requests[method] = requests.get(method, 0) + 1
+
+    size = case["layers"] * case["layer_size"]
+    return {
+        "operation": operation,
+        "client": case["client"],
+        "layers": case["layers"],
+        "layer_size": case["layer_size"],
+        "seconds": result["seconds"],
+        "throughput": size / result["seconds"],
+        "requests": requests,
+        "peak_rss": result["peak_rss"],
+    }
+
+
+def _key(result):
+    return (
+        result["operation"],
+        result["client"],
+        result["layers"],
+        result["layer_size"],
+    )
+
+
+def compare(results, baseline, tolerance: float):
+    """Regressions of `results` compared to `baseline`"""
+    baseline = {_key(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        previous = baseline.get(_key(result))
+        if previous is None:
+            continue
+        if result["throughput"] < previous["throughput"] * (1 - tolerance):
+            regressions.append(
+                f"{_key(result)} throughput {previous['throughput'] / 2**20:.1f} -> {result['throughput'] / 2**20:.1f} MiB/s"
+            )
+        if sum(result["requests"].values()) > sum(previous["requests"].values()):
+            regressions.append(
+                f"{_key(result)} requests {previous['requests']} -> {result['requests']}"
+            )
+    return regressions
+
+
+def print_header():
+    print(
+        f"{'operation':<10}{'client':<8}{'layers':>7}{'size':>9}{'seconds':>10}"
+        f"{'MiB/s':>9}{'rss MiB':>9}  requests"
+    )
+
+
+def print_result(result):
+    requests = " ".join(
+        f"{method}={count}" for method, count in sorted(result["requests"].items())
+    )
+    print(
+        f"{result['operation']:<10}{result['client']:<8}{result['layers']:>7}"
+        f"{format_size(result['layer_size']):>9}{result['seconds']:>10.3f}"
+        f"{result['throughput'] / 2**20:>9.1f}{result['peak_rss'] / 2**20:>9.1f}"
+        f"  {requests}",
+        flush=True,
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--layers",
+        default=[1, 8],
+        type=lambda s: [int(n) for n in s.split(",")],
+        help="comma separated layer counts",
+    )
+    parser.add_argument(
+        "--layer-size",
+        default=[2**20, 16 * 2**20],
+        type=lambda s: [parse_size(size) for size in s.split(",")],
+        help="comma separated layer sizes e.g. 512KiB,16MiB",
+    )
+    parser.add_argument(
+        "--client", default="sync", choices=["sync", "async"], help="registry client"
+    )
+    parser.add_argument(
+        "--compression",
+        default="gzip",
+        choices=["gzip", "zstd"],
+        help="layer compression",
+    )
+    parser.add_argument(
+        "--latency", default=0.0, type=float, help="seconds added to every request"
+    )
+    parser.add_argument(
+        "--bandwidth",
+        default=None,
+        type=parse_size,
+        help="bytes per second of request and response bodies e.g. 100MiB",
+    )
+    parser.add_argument(
+        "--token-auth", action="store_true", help="require bearer tokens"
+    )
+    parser.add_argument(
+        "--error-rate",
+        default=0.0,
+        type=float,
+        help="fraction of requests failing with 503",
+    )
+    parser.add_argument(
+        "--truncate-rate",
+        default=0.0,
+        type=float,
+        help="fraction of blob downloads interrupted half way",
+    )
+    parser.add_argument("--output", help="write results as json")
+    parser.add_argument("--baseline", help="compare against json results")
+    parser.add_argument(
+        "--tolerance",
+        default=0.25,
+        type=float,
+        help="allowed relative throughput drop compared to the baseline",
+    )
+    args = parser.parse_args(argv)
+
+    results = []
+    print_header()
+    for layers, layer_size in itertools.product(args.layers, args.layer_size):
+        with StubRegistry(
+            latency=args.latency,
+            bandwidth=args.bandwidth,
+            token_auth=args.token_auth,
+            error_rate=args.error_rate,
+            truncate_rate=args.truncate_rate,
+        ) as registry:
+            case = {
+                "url": registry.url,
+                "name": f"benchmark/layers-{layers}-{format_size(layer_size).lower()}",
+                "client": args.client,
+                "compression": args.compression,
+                "layers": layers,
+                "layer_size": layer_size,
+            }
+            for operation in ("push", "pull"):
+                results.append(run_case(registry, case, operation))
+                print_result(results[-1])
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"regression: {regression}")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
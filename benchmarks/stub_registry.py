@@ -0,0 +1,319 @@
+"""In-process stand-in for a docker v2 registry
+
+Implements the blob, upload, manifest, tag and catalog endpoints of
+the registry api backed by dictionaries so that clients can be
+benchmarked without docker. Optionally bearer token authentication is
+required for every request.
+
+"""
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+MANIFEST_V2 = "application/vnd.docker.distribution.manifest.v2+json"
+
+
+class StubRegistry:
+    """Registry served from a background thread on a random local port
+
+    `latency` seconds are added to every request and `bandwidth`
+    bytes per second throttles request and response bodies. With
+    `token_auth` clients must authenticate with tokens from `/token`
+    which expire after `token_expires_in` seconds.
+
+    Failures are injected at random with a fraction `error_rate` of
+    requests answered with 503 and a fraction `truncate_rate` of blob
+    downloads closing the connection half way through the body.
+
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        bandwidth: float = None,
+        token_auth: bool = False,
+        token_expires_in: int = 300,
+        error_rate: float = 0.0,
+        truncate_rate: float = 0.0,
+    ):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.truncate_rate = truncate_rate
+        self.token_auth = token_auth
+        self.token_expires_in = token_expires_in
+        self.tokens = {}
+        self.blobs = {}
+        self.manifests = {}
+        self.uploads = {}
+        self.requests = []
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _handler_factory(self))
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def request_counts(self):
+        counts = {}
+        for method, _ in self.requests:
+            counts[method] = counts.get(method, 0) + 1
+        return counts
+
+
+def _handler_factory(registry):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _throttle(self, size):
+            if registry.bandwidth:
+                time.sleep(size / registry.bandwidth)
+
+        def _read_body(self):
+            if self.headers.get("Transfer-Encoding") == "chunked":
+                body = bytearray()
+                while True:
+                    size = int(self.rfile.readline().split(b";")[0], 16)
+                    body += self.rfile.read(size)
+                    self.rfile.readline()
+                    if size == 0:
+                        break
+                body = bytes(body)
+            else:
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length) if length else b""
+            self._throttle(len(body))
+            return body
+
+        def _send(self, status, body=b"", headers=None):
+            self.send_response(status)
+            headers = headers or {}
+            headers.setdefault("Content-Length", str(len(body)))
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.end_headers()
+            if body and self.command != "HEAD":
+                self._throttle(len(body))
+                self.wfile.write(body)
+
+        def _dispatch(self):
+            url = urlparse(self.path)
+            query = {k: v[0] for k, v in parse_qs(url.query).items()}
+            with registry.lock:
+                registry.requests.append((self.command, url.path))
+            if registry.latency:
+                time.sleep(registry.latency)
+
+            body = (
+                self._read_body() if self.command in ("PUT", "PATCH", "POST") else b""
+            )
+
+            if url.path != "/token" and random.random() < registry.error_rate:
+                return self._send(503, headers={"Retry-After": "0"})
+
+            if registry.token_auth:
+                if url.path == "/token":
+                    return self._token(parse_qs(url.query).get("scope", []))
+                if not self._authorized(url.path):
+                    return self._send(
+                        401,
+                        headers={
+                            "WWW-Authenticate": f'Bearer realm="{registry.url}/token",service="stub"'
+                        },
+                    )
+
+            if url.path == "/v2/":
+                return self._send(200, b"{}")
+            if url.path == "/v2/_catalog":
+                names = sorted({name for name, _ in registry.manifests})
+                return self._send(200, json.dumps({"repositories": names}).encode())
+
+            match = re.fullmatch(r"/v2/(.+)/tags/list", url.path)
+            if match:
+                name = match.group(1)
+                tags = sorted(
+                    t
+                    for n, t in registry.manifests
+                    if n == name and not t.startswith("sha256:")
+                )
+                return self._send(
+                    200, json.dumps({"name": name, "tags": tags or None}).encode()
+                )
+
+            match = re.fullmatch(r"/v2/(.+)/blobs/uploads/([^/]*)", url.path)
+            if match:
+                return self._upload(match.group(1), match.group(2), query, body)
+
+            match = re.fullmatch(r"/v2/(.+)/blobs/(sha256:[0-9a-f]+)", url.path)
+            if match:
+                return self._blob(match.group(1), match.group(2))
+
+            match = re.fullmatch(r"/v2/(.+)/manifests/(.+)", url.path)
+            if match:
+                return self._manifest(match.group(1), match.group(2), body)
+
+            return self._send(404)
+
+        def _token(self, scopes):
+            token = uuid.uuid4().hex
+            access = {}
+            for scope in scopes:
+                _, name, actions = scope.split(":")
+                access.setdefault(name, set()).update(actions.split(","))
+            registry.tokens[token] = (time.time() + registry.token_expires_in, access)
+            body = {"token": token, "expires_in": registry.token_expires_in}
+            return self._send(200, json.dumps(body).encode())
+
+        def _authorized(self, path):
+            authorization = self.headers.get("Authorization", "")
+            if not authorization.startswith("Bearer "):
+                return False
+            token = registry.tokens.get(authorization[len("Bearer ") :])
+            if token is None or token[0] < time.time():
+                return False
+            match = re.fullmatch(r"/v2/(.+)/(blobs|manifests|tags)/.*", path)
+            if match is None:
+                return True
+            action = "pull" if self.command in ("GET", "HEAD") else "push"
+            return action in token[1].get(match.group(1), set())
+
+        def _blob(self, name, digest):
+            content = registry.blobs.get((name, digest))
+            if content is None:
+                return self._send(404)
+            headers = {"Docker-Content-Digest": digest}
+            range_header = self.headers.get("Range")
+            if range_header and self.command == "GET":
+                start, end = re.fullmatch(r"bytes=(\d*)-(\d*)", range_header).groups()
+                if not start:
+                    # suffix range of the last bytes
+                    start, end = max(len(content) - int(end), 0), ""
+                start = int(start)
+                end = min(int(end), len(content) - 1) if end else len(content) - 1
+                headers["Content-Range"] = f"bytes {start}-{end}/{len(content)}"
+                return self._send(206, content[start : end + 1], headers)
+            if self.command == "HEAD":
+                headers["Content-Length"] = str(len(content))
+                return self._send(200, b"", headers)
+            if random.random() < registry.truncate_rate:
+                headers["Content-Length"] = str(len(content))
+                self.close_connection = True
+                return self._send(200, content[: len(content) // 2], headers)
+            return self._send(200, content, headers)
+
+        def _upload_headers(self, name, upload_id):
+            size = len(registry.uploads[upload_id])
+            return {
+                "Location": f"/v2/{name}/blobs/uploads/{upload_id}",
+                "Range": f"0-{max(size - 1, 0)}",
+                "Docker-Upload-UUID": upload_id,
+            }
+
+        def _upload(self, name, upload_id, query, body):
+            if self.command == "POST":
+                if "mount" in query:
+                    content = registry.blobs.get((query.get("from"), query["mount"]))
+                    if content is not None:
+                        registry.blobs[(name, query["mount"])] = content
+                        return self._send(
+                            201,
+                            headers={
+                                "Location": f"/v2/{name}/blobs/{query['mount']}",
+                                "Docker-Content-Digest": query["mount"],
+                            },
+                        )
+                upload_id = str(uuid.uuid4())
+                registry.uploads[upload_id] = bytearray()
+                if "digest" in query:
+                    return self._finish(name, upload_id, query["digest"], body)
+                return self._send(202, headers=self._upload_headers(name, upload_id))
+
+            if upload_id not in registry.uploads:
+                return self._send(404)
+
+            if self.command == "GET":
+                return self._send(204, headers=self._upload_headers(name, upload_id))
+            elif self.command == "PATCH":
+                content_range = self.headers.get("Content-Range")
+                if content_range:
+                    start = int(content_range.split("-")[0])
+                    if start != len(registry.uploads[upload_id]):
+                        return self._send(416)
+                registry.uploads[upload_id].extend(body)
+                return self._send(202, headers=self._upload_headers(name, upload_id))
+            elif self.command == "PUT":
+                return self._finish(name, upload_id, query["digest"], body)
+            elif self.command == "DELETE":
+                registry.uploads.pop(upload_id)
+                return self._send(204)
+
+        def _finish(self, name, upload_id, digest, body):
+            content = bytes(registry.uploads.pop(upload_id)) + body
+            if f"sha256:{hashlib.sha256(content).hexdigest()}" != digest:
+                return self._send(400)
+            registry.blobs[(name, digest)] = content
+            return self._send(
+                201,
+                headers={
+                    "Location": f"/v2/{name}/blobs/{digest}",
+                    "Docker-Content-Digest": digest,
+                },
+            )
+
+        def _manifest(self, name, reference, body):
+            if self.command == "PUT":
+                digest = f"sha256:{hashlib.sha256(body).hexdigest()}"
+                media_type = self.headers.get("Content-Type", MANIFEST_V2)
+                registry.manifests[(name, reference)] = (body, media_type)
+                registry.manifests[(name, digest)] = (body, media_type)
+                return self._send(201, headers={"Docker-Content-Digest": digest})
+
+            if (name, reference) not in registry.manifests:
+                return self._send(404)
+            content, media_type = registry.manifests[(name, reference)]
+            digest = f"sha256:{hashlib.sha256(content).hexdigest()}"
+
+            if self.command == "DELETE":
+                for key in [
+                    k for k, v in registry.manifests.items() if v[0] == content
+                ]:
+                    del registry.manifests[key]
+                return self._send(202)
+
+            headers = {"Docker-Content-Digest": digest, "Content-Type": media_type}
+            if self.command == "HEAD":
+                headers["Content-Length"] = str(len(content))
+                return self._send(200, b"", headers)
+            return self._send(200, content, headers)
+
+        do_GET = do_HEAD = do_POST = do_PUT = do_PATCH = do_DELETE = _dispatch
+
+    return Handler
@@ -0,0 +1,1137 @@
+import asyncio
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import io
+import itertools
+import json
+import tempfile
+import time
+from typing import Tuple
+
+from python_docker import auth, schema, utils, compression
+from python_docker.base import Image
+from python_docker.cache import BlobCache, ManifestCache, TocCache
+from python_docker.observers import RequestEvent, url_template
+from python_docker.registry import (
+    DEFAULT_TIMEOUT,
+    MANIFEST_VERSION_MEDIA_TYPES,
+    _body_position,
+    _image_platform,
+    _is_manifest_list,
+    _manifest_digest,
+    _manifest_layers,
+    _manifest_list,
+    _mount_sources,
+    _parse_location,
+    _parse_range_offset,
+    _range_header,
+    _read_cached_range,
+    _retry_after,
+    _select_manifest,
+    _with_compression,
+)
+from python_docker.retry import IDEMPOTENT_METHODS, RetryPolicy
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+class AsyncRegistry:
+    """asyncio client for docker registries with the same interface
+    as `Registry`
+
+    All requests share a single connection pool of at most
+    `max_connections` connections. The authentication type of the
+    registry is detected on the first request. Use the client as an
+    async context manager or call `aclose` to close the connection
+    pool.
+
+    Blocking work runs in thread pools of the client of at most
+    `max_workers` threads rather than the default executor of the
+    event loop. Decompressing layers and reading files never wait on
+    the event loop while compressing layers may read lazy layers
+    through it so they run in separate pools which cannot deadlock
+    each other. Content of lazily pulled layers is fetched on the
+    event loop of the client and must therefore be read from another
+    thread for example with `loop.run_in_executor`.
+
+    """
+
+    def __init__(
+        self,
+        hostname: str = "https://registry-1.docker.io",
+        username: str = None,
+        password: str = None,
+        cache: BlobCache = None,
+        max_connections: int = 100,
+        observers=None,
+        retry: RetryPolicy = None,
+        timeout=DEFAULT_TIMEOUT,
+        max_workers: int = None,
+    ):
+        if httpx is None:
+            raise ImportError("AsyncRegistry requires the httpx package")
+
+        self.hostname = hostname
+        self.username = username
+        self.password = password
+        self.cache = cache
+        # callables notified with a RequestEvent for every request
+        self.observers = list(observers or [])
+        self.retry = retry or RetryPolicy()
+        self.token_cache = auth.TokenCache()
+        self.manifest_cache = ManifestCache(cache)
+        self.toc_cache = TocCache(cache)
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+            ),
+            timeout=_httpx_timeout(timeout),
+        )
+        self.authentication_type = None
+        self._authentication_detected = False
+        self._basic_authenticated = False
+        self._lock = None
+        self._loop = None
+        self._default_token = None
+        # blocking work which never waits on the event loop
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        # blocking work which may read lazy layers through the event loop
+        self._layer_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers
+        )
+
+    async def __aenter__(self):
+        await self.detect_authentication()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.aclose()
+
+    async def aclose(self):
+        await self.client.aclose()
+        self._executor.shutdown(wait=False)
+        self._layer_executor.shutdown(wait=False)
+
+    @property
+    def lock(self):
+        # created lazily since asyncio locks bind to the running loop
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    async def detect_authentication(self):
+        self._loop = asyncio.get_running_loop()
+        if self._authentication_detected:
+            return
+
+        response = await self._request("/v2/")
+        if "www-authenticate" in response.headers:
+            auth_scheme, parameters = auth.parse_www_authenticate(
+                response.headers["www-authenticate"]
+            )
+            self.authentication_type = auth_scheme
+            self.authentication_parameters = parameters
+            if auth_scheme == "Basic":
+                if self.username is None or self.password is None:
+                    raise ValueError(
+                        "registry requires basic authentication and username and or password not specified when initializing client"
+                    )
+            elif auth_scheme != "Bearer":
+                raise ValueError(f"authentication type {auth_scheme} not supported")
+        self._authentication_detected = True
+
+    async def token_authenticate(
+        self,
+        image: str = None,
+        action: str = None,
+        mount_from=None,
+        refresh: bool = False,
+    ):
+        """Get bearer token for the requested scope, see
+        `Registry.token_authenticate`
+
+        """
+        access = auth.scope_access(image, action, mount_from)
+
+        token = None if refresh else self.token_cache.get(access)
+        if token is not None:
+            return token
+
+        async with self.lock:
+            token = None if refresh else self.token_cache.get(access)
+            if token is None:
+                token = await self._request_token(access)
+                self.token_cache.put(access, token)
+        self._default_token = token
+        return token
+
+    async def _request_token(self, access):
+        headers = {}
+        if self.username is not None and self.password is not None:
+            headers["Authorization"] = auth.basic_credentials(
+                self.username, self.password
+            )
+
+        base_url = auth.token_url(
+            self.authentication_parameters, access, username=self.username
+        )
+
+        response = await self._send(
+            self.client.build_request("GET", base_url, headers=headers)
+        )
+        if response.status_code != 200:
+            raise ValueError(f"token authentication failed for {base_url}")
+
+        return auth.Token.from_response(response.json())
+
+    async def authenticate(
+        self, image: str = None, action: str = None, mount_from=None
+    ):
+        await self.detect_authentication()
+        if self.authentication_type == "Basic":
+            if not self._basic_authenticated:
+                if not await self.authenticated():
+                    raise ValueError("failed to authenticate")
+                self._basic_authenticated = True
+        elif self.authentication_type == "Bearer":
+            await self.token_authenticate(image, action, mount_from)
+
+    async def authenticated(self):
+        response = await self._request("/v2/")
+        return response.status_code != 401
+
+    def _authorization_headers(self):
+        if self.authentication_type == "Basic":
+            return {
+                "Authorization": auth.basic_credentials(self.username, self.password)
+            }
+        elif self._default_token is not None:
+            return {"Authorization": self._default_token.header}
+        return {}
+
+    async def request(
+        self,
+        url: str,
+        method="GET",
+        headers=None,
+        params=None,
+        data=None,
+        stream=False,
+        image: str = None,
+        action: str = None,
+        idempotent: bool = None,
+        **kwargs,
+    ):
+        """Send request to the registry, see `Registry.request`
+
+        With `stream` set the response body is not read and the
+        response must be closed with `aclose`. `data` may be a file
+        object which is read in the default executor.
+
+        """
+        await self.detect_authentication()
+        return await self._request(
+            url,
+            method=method,
+            headers=headers,
+            params=params,
+            data=data,
+            stream=stream,
+            image=image,
+            action=action,
+            idempotent=idempotent,
+        )
+
+    async def _request(
+        self,
+        url: str,
+        method="GET",
+        headers=None,
+        params=None,
+        data=None,
+        stream=False,
+        image: str = None,
+        action: str = None,
+        idempotent: bool = None,
+    ):
+        scoped = (
+            self.authentication_type == "Bearer"
+            and image is not None
+            and action is not None
+        )
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT_METHODS
+        data_position = _body_position(data)
+        rewindable = (
+            data is None or isinstance(data, bytes) or data_position is not None
+        )
+
+        token, refresh, refreshed, retries = None, False, False, 0
+        for attempt in itertools.count():
+            content = data
+            if data_position is not None:
+                data.seek(data_position)
+            if hasattr(data, "read"):
+                content = _aiter_fileobj(data, self._executor)
+
+            request_headers = {**self._authorization_headers(), **(headers or {})}
+            if scoped:
+                token = await self.token_authenticate(image, action, refresh=refresh)
+                request_headers["Authorization"] = token.header
+            refresh = False
+
+            request = self.client.build_request(
+                method,
+                f"{self.hostname}{url}",
+                headers=request_headers,
+                params=params,
+                content=content,
+            )
+            try:
+                response = await self._send(request, retries=attempt, stream=stream)
+            except httpx.TransportError:
+                delay = None
+                if idempotent and rewindable:
+                    delay = self.retry.delay(retries)
+                if delay is None:
+                    raise
+            else:
+                if (
+                    scoped
+                    and response.status_code == 401
+                    and rewindable
+                    and not refreshed
+                ):
+                    await response.aclose()
+                    self.token_cache.invalidate(token)
+                    refresh = refreshed = True
+                    continue
+
+                delay = None
+                if (
+                    idempotent
+                    and rewindable
+                    and self.retry.should_retry_status(response.status_code)
+                ):
+                    delay = self.retry.delay(
+                        retries, response.headers.get("Retry-After")
+                    )
+                if delay is None:
+                    return response
+                await response.aclose()
+
+            retries += 1
+            await asyncio.sleep(delay)
+
+    async def _send(self, request, retries: int = 0, stream: bool = False):
+        """Send a single http request notifying the observers, see
+        `Registry._send`
+
+        """
+        if not self.observers:
+            return await self.client.send(request, stream=stream)
+
+        url = str(request.url)
+        start = time.perf_counter()
+        try:
+            response = await self.client.send(request, stream=stream)
+        except httpx.HTTPError as e:
+            self._notify(
+                RequestEvent(
+                    method=request.method,
+                    url=url,
+                    url_template=url_template(url),
+                    status=None,
+                    bytes_sent=0,
+                    bytes_received=0,
+                    seconds=time.perf_counter() - start,
+                    retries=retries,
+                    error=e,
+                )
+            )
+            raise
+
+        finished = False
+
+        def _finish():
+            nonlocal finished
+            if finished:
+                return
+            finished = True
+            self._notify(
+                RequestEvent(
+                    method=request.method,
+                    url=url,
+                    url_template=url_template(url),
+                    status=response.status_code,
+                    bytes_sent=int(request.headers.get("Content-Length", 0)),
+                    bytes_received=response.num_bytes_downloaded,
+                    seconds=time.perf_counter() - start,
+                    retries=retries,
+                )
+            )
+
+        if stream:
+            aclose = response.aclose
+
+            async def _aclose():
+                try:
+                    await aclose()
+                finally:
+                    _finish()
+
+            response.aclose = _aclose
+        else:
+            _finish()
+        return response
+
+    def _notify(self, event: RequestEvent):
+        for observer in self.observers:
+            observer(event)
+
+    async def get_manifest(self, image: str, tag: str, version="v1"):
+        if version not in MANIFEST_VERSION_MEDIA_TYPES:
+            raise ValueError(f"manifest version={version} not supported")
+
+        data = json.loads(await self.get_manifest_content(image, tag, version=version))
+        if version == "v1":
+            return schema.DockerManifestV1.parse_obj(data)
+        elif version == "v2" or not _is_manifest_list(data):
+            return schema.DockerManifestV2.parse_obj(data)
+        else:
+            return schema.DockerManifestList.parse_obj(data)
+
+    async def get_platform_manifest(self, image: str, tag: str, platform: str = None):
+        """Get v2 manifest of `tag` for `platform`, see
+        `Registry.get_platform_manifest`
+
+        """
+        manifest = await self.get_manifest(image, tag, version="list")
+        if isinstance(manifest, schema.DockerManifestV2):
+            return manifest, None
+
+        descriptor = _select_manifest(image, tag, manifest, platform)
+        return (
+            await self.get_manifest(image, descriptor.digest, version="v2"),
+            descriptor.platform,
+        )
+
+    async def get_manifest_content(self, image: str, tag: str, version="v2"):
+        """Get raw manifest of `tag`, see `Registry.get_manifest_content`"""
+        media_type = MANIFEST_VERSION_MEDIA_TYPES[version]
+        digest = self.manifest_cache.digest(image, tag, media_type)
+        if digest is not None and digest != tag:
+            digest = await self.get_manifest_digest(image, tag, version=version)
+
+        content = None
+        if digest is not None:
+            content = await self._run_blocking(self.manifest_cache.get, digest)
+        if content is None:
+            response = await self.request(
+                f"/v2/{image}/manifests/{tag}",
+                image=image,
+                action="pull",
+                headers={"Accept": media_type},
+            )
+            response.raise_for_status()
+            content = response.content
+            digest = _manifest_digest(response.headers, content, tag)
+            await self._run_blocking(self.manifest_cache.put, digest, content)
+
+        self.manifest_cache.tag(image, tag, media_type, digest)
+        return content
+
+    async def get_manifest_configuration(
+        self, image: str, tag: str, manifest: schema.DockerManifestV2 = None
+    ):
+        if manifest is None:
+            manifest = await self.get_manifest(image, tag, version="v2")
+
+        digest = manifest.config.digest
+        content = await self._run_blocking(self.manifest_cache.get, digest)
+        if content is None:
+            content = await self.get_blob(image, digest)
+            await self._run_blocking(self.manifest_cache.put, digest, content)
+        return schema.DockerConfig.parse_obj(json.loads(content))
+
+    async def get_manifest_digest(self, image: str, tag: str, version="v2"):
+        response = await self.request(
+            f"/v2/{image}/manifests/{tag}",
+            method="HEAD",
+            image=image,
+            action="pull",
+            headers={"Accept": MANIFEST_VERSION_MEDIA_TYPES[version]},
+        )
+        response.raise_for_status()
+        return response.headers["Docker-Content-Digest"]
+
+    async def check_blob(self, image: str, blobsum: str):
+        response = await self.request(
+            f"/v2/{image}/blobs/{blobsum}", method="HEAD", image=image, action="pull"
+        )
+        return response.status_code == 200
+
+    async def check_blobs(self, image: str, blobsums, max_concurrency: int = 16):
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def _check_blob(blobsum):
+            async with semaphore:
+                return await self.check_blob(image, blobsum)
+
+        blobsums = list(blobsums)
+        exists = await asyncio.gather(*[_check_blob(blobsum) for blobsum in blobsums])
+        return dict(zip(blobsums, exists))
+
+    async def get_blob(
+        self, image: str, blobsum: str, byte_range: Tuple[int, int] = None
+    ):
+        """Content of blob `blobsum` or part of it with `byte_range`, see
+        `Registry.get_blob`
+
+        """
+        if byte_range is not None:
+            return await self._get_blob_range(image, blobsum, *byte_range)
+
+        if self.cache is not None:
+            fileobj = await self.download_blob(image, blobsum)
+            return await self._run_blocking(_read_and_close, fileobj)
+
+        response = await self.request(
+            f"/v2/{image}/blobs/{blobsum}", image=image, action="pull"
+        )
+        response.raise_for_status()
+        return response.content
+
+    async def _get_blob_range(
+        self, image: str, blobsum: str, start: int, end: int = None
+    ):
+        if self.cache is not None:
+            content = await self._run_blocking(
+                _read_cached_range, self.cache, blobsum, start, end
+            )
+            if content is not None:
+                return content
+
+        if end is not None and 0 <= end <= start:
+            return b""
+        response = await self.request(
+            f"/v2/{image}/blobs/{blobsum}",
+            image=image,
+            action="pull",
+            headers={"Range": _range_header(start, end)},
+        )
+        response.raise_for_status()
+        if response.status_code != 206:
+            # registry ignored the range and sent the whole blob
+            return response.content[start:end]
+        return response.content
+
+    async def download_blob(
+        self,
+        image: str,
+        blobsum: str,
+        fileobj=None,
+        chunk_size: int = utils.DEFAULT_CHUNK_SIZE,
+    ):
+        """Stream blob into `fileobj` verifying the digest, see
+        `Registry.download_blob`
+
+        """
+        if self.cache is not None and fileobj is None:
+            cached_fileobj = await self._run_blocking(self.cache.open, blobsum)
+            if cached_fileobj is not None:
+                return cached_fileobj
+
+            # the cache locks and scans its directory on commit
+            download = self.cache.download(blobsum)
+            cache_fileobj = await self._run_blocking(download.__enter__)
+            try:
+                await self._download_blob(image, blobsum, cache_fileobj, chunk_size)
+            except BaseException as e:
+                if not await self._run_blocking(
+                    download.__exit__, type(e), e, e.__traceback__
+                ):
+                    raise
+            else:
+                await self._run_blocking(download.__exit__, None, None, None)
+            return download.fileobj
+
+        if fileobj is None:
+            fileobj = tempfile.SpooledTemporaryFile(max_size=chunk_size)
+        await self._download_blob(image, blobsum, fileobj, chunk_size)
+        await self._run_blocking(fileobj.seek, 0)
+        return fileobj
+
+    async def _download_blob(self, image: str, blobsum: str, fileobj, chunk_size: int):
+        algorithm, expected_checksum = blobsum.split(":", 1)
+        hasher = hashlib.new(algorithm)
+        start = await self._run_blocking(fileobj.tell)
+
+        def _write(chunk):
+            hasher.update(chunk)
+            fileobj.write(chunk)
+
+        def _restart():
+            fileobj.seek(start)
+            fileobj.truncate()
+
+        offset, resumes = 0, 0
+        while True:
+            headers = {"Range": f"bytes={offset}-"} if offset else None
+            response = await self.request(
+                f"/v2/{image}/blobs/{blobsum}",
+                image=image,
+                action="pull",
+                headers=headers,
+                stream=True,
+            )
+            try:
+                response.raise_for_status()
+                if offset and response.status_code != 206:
+                    # registry ignored the range and sent the whole blob
+                    hasher, offset = hashlib.new(algorithm), 0
+                    await self._run_blocking(_restart)
+
+                async for chunk in response.aiter_bytes(chunk_size):
+                    # hashing and writing to disk block
+                    await self._run_blocking(_write, chunk)
+                    offset += len(chunk)
+            except httpx.TransportError:
+                delay = self.retry.delay(resumes)
+                if delay is None:
+                    raise
+                resumes += 1
+                await asyncio.sleep(delay)
+                continue
+            finally:
+                await response.aclose()
+            break
+
+        if hasher.hexdigest() != expected_checksum:
+            raise ValueError(
+                f"blob {blobsum} digest mismatch got {algorithm}:{hasher.hexdigest()}"
+            )
+
+    async def begin_upload(self, image: str, mount: str = None, mount_from: str = None):
+        """Begin a blob upload, see `Registry.begin_upload`"""
+        params = {}
+        if mount is not None and mount_from is not None:
+            params = {"mount": mount, "from": mount_from}
+
+        response = await self.request(
+            f"/v2/{image}/blobs/uploads/",
+            method="POST",
+            image=image,
+            action="push",
+            params=params,
+            idempotent=True,
+        )
+        response.raise_for_status()
+        if params and response.status_code == 201:
+            return None
+        return _parse_location(response.headers["Location"])
+
+    async def get_upload_status(
+        self, image: str, upload_location: str, upload_query: dict, uploaded: int = 0
+    ):
+        response = await self.request(
+            upload_location, image=image, action="push", params=upload_query
+        )
+        response.raise_for_status()
+        upload_location, upload_query = _parse_location(response.headers["Location"])
+        return (
+            upload_location,
+            upload_query,
+            _parse_range_offset(response.headers, uploaded),
+        )
+
+    async def upload_blob_chunks(
+        self,
+        image: str,
+        upload_location: str,
+        upload_query: dict,
+        digest,
+        chunk_size: int = utils.DEFAULT_CHUNK_SIZE,
+        max_resumes: int = None,
+    ):
+        """Upload blob content in chunks, see `Registry.upload_blob_chunks`"""
+        if max_resumes is None:
+            max_resumes = self.retry.total
+        loop = asyncio.get_running_loop()
+        fileobj = io.BytesIO(digest) if isinstance(digest, bytes) else digest
+        size = fileobj.seek(0, io.SEEK_END)
+
+        offset, resumes = 0, 0
+        while offset < size:
+            fileobj.seek(offset)
+            chunk = await loop.run_in_executor(self._executor, fileobj.read, chunk_size)
+
+            try:
+                response = await self.request(
+                    upload_location,
+                    method="PATCH",
+                    data=chunk,
+                    image=image,
+                    action="push",
+                    params=upload_query,
+                    headers={
+                        "Content-Type": "application/octet-stream",
+                        "Content-Range": f"{offset}-{offset + len(chunk) - 1}",
+                    },
+                )
+                response.raise_for_status()
+            except httpx.HTTPError as e:
+                resumes += 1
+                if resumes > max_resumes:
+                    raise
+                delay = self.retry.backoff(
+                    resumes - 1, _retry_after(getattr(e, "response", None))
+                )
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                (
+                    upload_location,
+                    upload_query,
+                    status_offset,
+                ) = await self.get_upload_status(
+                    image, upload_location, upload_query, uploaded=offset
+                )
+                offset = 0 if status_offset is None else status_offset
+                continue
+
+            resumes = 0
+            upload_location, upload_query = _parse_location(
+                response.headers["Location"]
+            )
+            status_offset = _parse_range_offset(response.headers, offset + len(chunk))
+            offset = offset + len(chunk) if status_offset is None else status_offset
+
+        return upload_location, upload_query
+
+    async def upload_blob(
+        self,
+        image: str,
+        digest,
+        checksum,
+        chunk_size: int = None,
+        mount_from: str = None,
+    ):
+        """Upload blob to registry, see `Registry.upload_blob`"""
+        upload = await self.begin_upload(
+            image, mount=f"sha256:{checksum}", mount_from=mount_from
+        )
+        if upload is None:
+            return
+        upload_location, upload_query = upload
+
+        with contextlib.ExitStack() as stack:
+            if callable(digest):
+                # opening the blob may read lazy layers
+                digest = await asyncio.get_running_loop().run_in_executor(
+                    self._layer_executor, digest
+                )
+                if not isinstance(digest, bytes):
+                    stack.enter_context(digest)
+
+            if chunk_size is not None:
+                upload_location, upload_query = await self.upload_blob_chunks(
+                    image, upload_location, upload_query, digest, chunk_size=chunk_size
+                )
+                digest = None
+
+            headers = {"Content-Type": "application/octet-stream"}
+            position = _body_position(digest)
+            if position is not None:
+                # registries expect a content length rather than a chunked body
+                size = digest.seek(0, io.SEEK_END) - digest.seek(position)
+                headers["Content-Length"] = str(size)
+
+            upload_query["digest"] = f"sha256:{checksum}"
+
+            await self._complete_upload(
+                image, upload_location, upload_query, digest, checksum, headers
+            )
+
+    async def _complete_upload(
+        self,
+        image: str,
+        upload_location: str,
+        upload_query: dict,
+        data,
+        checksum,
+        headers,
+    ):
+        """Complete blob upload with the final PUT request, see
+        `Registry._complete_upload`
+
+        """
+        blobsum = f"sha256:{checksum}"
+        data_position = _body_position(data)
+        rewindable = (
+            data is None or isinstance(data, bytes) or data_position is not None
+        )
+
+        retries = 0
+        while True:
+            if retries > 0 and data_position is not None:
+                data.seek(data_position)
+            try:
+                response = await self.request(
+                    upload_location,
+                    method="PUT",
+                    data=data,
+                    image=image,
+                    action="push",
+                    params=upload_query,
+                    headers=headers,
+                    idempotent=False,
+                )
+            except httpx.TransportError:
+                if await self.check_blob(image, blobsum):
+                    return
+                delay = self.retry.delay(retries) if rewindable else None
+                if delay is None:
+                    raise
+            else:
+                if response.is_success:
+                    return
+                if response.status_code != 404 and not self.retry.should_retry_status(
+                    response.status_code
+                ):
+                    response.raise_for_status()
+                if await self.check_blob(image, blobsum):
+                    return
+                delay = None
+                if rewindable and response.status_code != 404:
+                    delay = self.retry.delay(
+                        retries, response.headers.get("Retry-After")
+                    )
+                if delay is None:
+                    response.raise_for_status()
+                await response.aclose()
+
+            retries += 1
+            await asyncio.sleep(delay)
+
+    async def upload_manifest(self, image: str, tag: str, manifest: dict):
+        manifest_config, manifest_config_checksum = manifest["config"]
+        manifest, manifest_checksum = manifest["manifest"]
+
+        if not await self.check_blob(image, f"sha256:{manifest_config_checksum}"):
+            await self.upload_blob(image, manifest_config, manifest_config_checksum)
+
+        await self.put_manifest(image, tag, manifest)
+
+    async def put_manifest(
+        self,
+        image: str,
+        tag: str,
+        manifest: bytes,
+        media_type: str = schema.DOCKER_MANIFEST_V2_MEDIA_TYPE,
+    ):
+        response = await self.request(
+            f"/v2/{image}/manifests/{tag}",
+            method="PUT",
+            data=manifest,
+            image=image,
+            action="push",
+            headers={"Content-Type": media_type},
+        )
+        response.raise_for_status()
+
+    async def list_images(self, n: int = None, last: int = None):
+        query = {}
+        if n is not None:
+            query["n"] = n
+        if last is not None:
+            query["last"] = last
+
+        response = await self.request("/v2/_catalog", params=query)
+        return response.json()["repositories"]
+
+    async def list_image_tags(self, image: str, n: int = None, last: int = None):
+        query = {}
+        if n is not None:
+            query["n"] = n
+        if last is not None:
+            query["last"] = last
+
+        response = await self.request(f"/v2/{image}/tags/list", params=query)
+        return response.json()["tags"]
+
+    async def pull_image(
+        self,
+        image: str,
+        tag: str = "latest",
+        lazy: bool = False,
+        max_concurrency: int = 16,
+        storage: str = "file",
+        platform: str = None,
+    ):
+        """Pull specific image from docker registry, see `Registry.pull_image`
+
+        At most `max_concurrency` layers are downloaded at once.
+
+        """
+        await self.authenticate(image=image, action="pull")
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def _get_layer_blob(blobsum, layer_compression):
+            async with semaphore:
+                fileobj = await self.download_blob(image, blobsum)
+
+            def _decompress():
+                with fileobj:
+                    decompress = functools.partial(
+                        compression.decompress_fileobj,
+                        fileobj,
+                        compression=layer_compression,
+                    )
+                    if storage == "file":
+                        return utils.FileSlice.temporary(decompress)
+                    content = io.BytesIO()
+                    decompress(content)
+                    return content.getvalue()
+
+            return await loop.run_in_executor(self._executor, _decompress)
+
+        def _lazy_layer_blob(blobsum, layer_compression):
+            return self._run_threadsafe(_get_layer_blob(blobsum, layer_compression))
+
+        manifest, manifest_platform = await self.get_platform_manifest(
+            image, tag, platform
+        )
+        manifest_config = await self.get_manifest_configuration(
+            image, tag, manifest=manifest
+        )
+        image_platform = _image_platform(manifest_config, manifest_platform, platform)
+
+        def _lazy_blob_range(blobsum, start, end=None):
+            return self._run_threadsafe(
+                self.get_blob(image, blobsum, byte_range=(start, end))
+            )
+
+        def _lazy_blob_stream(blobsum):
+            return self._run_threadsafe(self.download_blob(image, blobsum))
+
+        def _layer_content(layer, layer_compression):
+            return {
+                "content": functools.partial(
+                    _lazy_layer_blob, layer.digest, layer_compression
+                ),
+                "compressed_content_range": functools.partial(
+                    _lazy_blob_range, layer.digest
+                ),
+                "compressed_content_stream": functools.partial(
+                    _lazy_blob_stream, layer.digest
+                ),
+            }
+
+        layers = _manifest_layers(
+            self.hostname,
+            image,
+            manifest,
+            manifest_config,
+            _layer_content,
+            toc_cache=self.toc_cache,
+        )
+
+        if not lazy:
+            contents = await asyncio.gather(
+                *[
+                    _get_layer_blob(
+                        layer.digest,
+                        compression.media_type_compression(layer.mediaType),
+                    )
+                    for layer in manifest.layers
+                ]
+            )
+            for layer, content in zip(layers, contents):
+                layer._set_content(content)
+
+        return Image(image, tag, layers, storage=storage, platform=image_platform)
+
+    async def _run_blocking(self, func, *args):
+        """Run blocking `func` such as file and cache access in the
+        client's thread pool
+
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(func, *args)
+        )
+
+    def _run_threadsafe(self, coroutine):
+        if self._loop is None or self._loop.is_closed():
+            coroutine.close()
+            raise RuntimeError("event loop of AsyncRegistry is not running")
+        if _running_loop() is self._loop:
+            coroutine.close()
+            raise RuntimeError(
+                "lazy layers of AsyncRegistry must be read outside of the event loop thread"
+            )
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    async def push_image(
+        self,
+        image: Image,
+        max_concurrency: int = 16,
+        chunk_size: int = None,
+        compression: str = None,
+    ):
+        """Push image to docker registry, see `Registry.push_image`
+
+        At most `max_concurrency` blobs are checked or uploaded at once.
+
+        """
+        (image,) = _with_compression([image], compression)
+        (manifest,) = await self._push_blobs(
+            image.name, [image], max_concurrency, chunk_size
+        )
+        await self.put_manifest(
+            image.name,
+            image.tag,
+            manifest["manifest"][0],
+            media_type=image.manifest_media_type,
+        )
+
+    async def push_index(
+        self,
+        image: str,
+        tag: str,
+        images,
+        max_concurrency: int = 16,
+        chunk_size: int = None,
+        compression: str = None,
+    ):
+        """Push multi-arch image made of `images` of different
+        platforms, see `Registry.push_index`
+
+        """
+        platforms = [image.platform for image in images]
+        if None in platforms:
+            raise ValueError("every image of a manifest list requires a platform")
+        if len(set(platforms)) != len(platforms):
+            raise ValueError(f"images have duplicate platforms {platforms}")
+
+        images = _with_compression(images, compression)
+        manifests = await self._push_blobs(image, images, max_concurrency, chunk_size)
+        await asyncio.gather(
+            *[
+                self.put_manifest(
+                    image,
+                    f"sha256:{manifest['manifest'][1]}",
+                    manifest["manifest"][0],
+                    media_type=child.manifest_media_type,
+                )
+                for child, manifest in zip(images, manifests)
+            ]
+        )
+
+        content, media_type = _manifest_list(images, manifests)
+        await self.put_manifest(image, tag, content, media_type=media_type)
+
+    async def _push_blobs(self, name, images, max_concurrency, chunk_size):
+        """Upload the missing blobs of `images` to repository `name`
+        and return their `Image.manifest_v2`
+
+        """
+        loop = asyncio.get_running_loop()
+        all_layers = [layer for image in images for layer in image.layers]
+        mount_from = _mount_sources(self.hostname, name, all_layers)
+        await self.authenticate(
+            image=name,
+            action="push,pull",
+            mount_from=sorted(set(mount_from.values())),
+        )
+
+        # compressing layers is cpu bound and may read lazy layers
+        await asyncio.gather(
+            *[
+                loop.run_in_executor(
+                    self._layer_executor, getattr, layer, "compressed_checksum"
+                )
+                for layer in all_layers
+            ]
+        )
+        manifests = [image.manifest_v2 for image in images]
+        configs = {
+            f"sha256:{manifest['config'][1]}": manifest["config"]
+            for manifest in manifests
+        }
+
+        layers = {f"sha256:{layer.compressed_checksum}": layer for layer in all_layers}
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def _upload_blob(blobsum):
+            async with semaphore:
+                if blobsum in layers:
+                    layer = layers[blobsum]
+                    await self.upload_blob(
+                        name,
+                        layer.open_compressed,
+                        layer.compressed_checksum,
+                        chunk_size=chunk_size,
+                        mount_from=mount_from.get(layer),
+                    )
+                else:
+                    await self.upload_blob(name, *configs[blobsum])
+
+        blob_exists = await self.check_blobs(
+            name,
+            list(layers) + list(configs),
+            max_concurrency=max_concurrency,
+        )
+        await asyncio.gather(
+            *[
+                _upload_blob(blobsum)
+                for blobsum, exists in blob_exists.items()
+                if not exists
+            ]
+        )
+        return manifests
+
+    async def delete_image(self, image, tag):
+        digest = await self.get_manifest_digest(image, tag)
+        response = await self.request(
+            f"/v2/{image}/manifests/{digest}", method="DELETE"
+        )
+        response.raise_for_status()
+
+
+def _httpx_timeout(timeout):
+    if isinstance(timeout, tuple):
+        connect, read = timeout
+        return httpx.Timeout(read, connect=connect, pool=None)
+    return httpx.Timeout(timeout, pool=None)
+
+
+def _read_and_close(fileobj):
+    with fileobj:
+        return fileobj.read()
+
+
+def _running_loop():
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
+async def _aiter_fileobj(
+    fileobj, executor=None, chunk_size: int = utils.DEFAULT_CHUNK_SIZE
+):
+    loop = asyncio.get_running_loop()
+    while True:
+        chunk = await loop.run_in_executor(executor, fileobj.read, chunk_size)
+        if not chunk:
+            break
+        yield chunk
@@ -0,0 +1,152 @@
+import base64
+import re
+import threading
+import time
+from datetime import datetime
+from typing import Dict, FrozenSet
+
+
+# default token lifetime in seconds from the token authentication specification
+DEFAULT_TOKEN_EXPIRES_IN = 60
+# tokens are refreshed this many seconds before they expire
+TOKEN_EXPIRY_MARGIN = 10
+
+
+def parse_www_authenticate(header: str):
+    """Split a `WWW-Authenticate` header into the scheme and parameters"""
+    auth_scheme, parameters = header.split(" ", 1)
+    return auth_scheme, {
+        key.strip(): value
+        for key, value in re.findall('([^,=]*)="([^"]*)"', parameters)
+    }
+
+
+def basic_credentials(username: str, password: str):
+    credentials = base64.b64encode(f"{username}:{password}".encode("utf-8")).decode(
+        "utf-8"
+    )
+    return f"Basic {credentials}"
+
+
+def scope_access(image: str = None, action: str = None, mount_from=None):
+    """Mapping of repository to the actions requested for a token
+
+    Cross repository blob mounts require pull access to the
+    repositories in `mount_from`.
+
+    """
+    access = {}
+    if image is not None and action is not None:
+        access[image] = frozenset(action.split(","))
+    for source_image in mount_from or []:
+        access[source_image] = access.get(source_image, frozenset()) | {"pull"}
+    return access
+
+
+def token_url(
+    authentication_parameters: Dict[str, str],
+    access: Dict[str, FrozenSet[str]],
+    username: str = None,
+):
+    query = [
+        ("service", authentication_parameters["service"]),
+    ]
+    for image, actions in access.items():
+        query.append(("scope", f"repository:{image}:{','.join(sorted(actions))}"))
+    if username is not None:
+        query.append(("account", username))
+
+    return (
+        authentication_parameters["realm"]
+        + "?"
+        + "&".join(f"{key}={value}" for key, value in query)
+    )
+
+
+def _parse_issued_at(issued_at: str):
+    # RFC 3339 timestamps may have nanosecond precision and a Z suffix
+    match = re.fullmatch(
+        r"(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})(?:\.(\d+))?(Z|[+-]\d{2}:\d{2})?",
+        issued_at,
+    )
+    if match is None:
+        return None
+    timestamp, fraction, offset = match.groups()
+    if fraction:
+        timestamp += "." + fraction[:6].ljust(6, "0")
+    if offset in (None, "Z"):
+        offset = "+00:00"
+    return datetime.fromisoformat(timestamp + offset).timestamp()
+
+
+class Token:
+    def __init__(self, token: str, expires_at: float):
+        self.token = token
+        self.expires_at = expires_at
+
+    @classmethod
+    def from_response(cls, data: dict, received_at: float = None):
+        """Token from the json response of a token server
+
+        The token expires `expires_in` seconds after it was issued. The
+        time it was received is used if `issued_at` is missing or in
+        the future due to clock skew.
+
+        """
+        received_at = time.time() if received_at is None else received_at
+        issued_at = received_at
+        if data.get("issued_at"):
+            issued_at = min(_parse_issued_at(data["issued_at"]) or issued_at, issued_at)
+        expires_in = data.get("expires_in") or DEFAULT_TOKEN_EXPIRES_IN
+        return cls(
+            token=data.get("token") or data["access_token"],
+            expires_at=issued_at + expires_in,
+        )
+
+    @property
+    def expired(self):
+        return time.time() >= self.expires_at - TOKEN_EXPIRY_MARGIN
+
+    @property
+    def header(self):
+        return f"Bearer {self.token}"
+
+
+class TokenCache:
+    """Thread safe cache of bearer tokens keyed by the access they grant
+
+    A cached token is reused for any request whose repository actions
+    are a subset of the token access.
+
+    """
+
+    def __init__(self):
+        self._tokens = []
+        self.lock = threading.RLock()
+
+    def get(self, access: Dict[str, FrozenSet[str]]):
+        with self.lock:
+            self._tokens = [
+                (token_access, token)
+                for token_access, token in self._tokens
+                if not token.expired
+            ]
+            for token_access, token in reversed(self._tokens):
+                if all(
+                    actions <= token_access.get(image, frozenset())
+                    for image, actions in access.items()
+                ):
+                    return token
+        return None
+
+    def put(self, access: Dict[str, FrozenSet[str]], token: Token):
+        with self.lock:
+            self._tokens.append((access, token))
+
+    def invalidate(self, token: Token):
+        with self.lock:
+            self._tokens = [
+                (token_access, cached_token)
+                for token_access, cached_token in self._tokens
+                if cached_token is not token
+            ]
@@ -1,29 +1,76 @@
+import contextlib
+import functools
 import io
 import os
 import tarfile
 import secrets
+import shutil
 from datetime import datetime, timezone
 import hashlib
-import gzip
 import tempfile
-from typing import Callable, Union
+from typing import Callable, Tuple, Union
 
-from python_docker import schema, utils, docker
+from python_docker import schema, utils, docker, compression
+from python_docker.build import BuildCache
+from python_docker.cache import TocCache
 from python_docker.tar import (
-    parse_v1,
+    _member_path,
+    index_layer,
+    index_tar,
+    parse_v1_index,
+    resolve_toc_entry,
     write_v1,
     write_tar_from_contents,
+    write_tar_from_diff,
+    write_tar_from_layers,
     write_tar_from_path,
     write_tar_from_paths,
 )
 
 
 class Layer:
+    """Docker image layer
+
+    `content` is the uncompressed layer tar either as bytes, a path
+    or `utils.FileSlice` of a file on disk or a callable which lazily
+    returns either of them. `content_stream` is an optional callable
+    returning a file object of the content which is used to read lazy
+    content once without storing it. Layers backed by a file are memory mapped
+    on demand and their compressed content is also stored in a
+    temporary file so that the layer is never read fully into memory.
+
+    The layer is compressed with `compression` either "gzip" or
+    "zstd" at `compression_level`. Setting `compression_threads`
+    greater than one compresses in parallel, for gzip in blocks of
+    `compression_block_size` bytes see
+    `compression.gzip_compress_fileobj`.
+
+    The table of contents of the layer tar is computed once and kept
+    in `toc_cache` when given keyed by the diff id `checksum`. With
+    `compression_toc` gzip layers are compressed with the table of
+    contents embedded see `compression.gzip_compress_toc_fileobj`.
+
+    `compressed_content_stream` and `compressed_content_range` are
+    optional callables reading the original compressed blob of a
+    pulled layer. `compressed_content_stream()` returns a file object
+    of the blob and `compressed_content_range(start, end)` the bytes
+    from `start` to `end`. With them files are read from a lazy gzip
+    layer with an embedded table of contents without fetching the
+    whole blob.
+
+    While the layer is compressed with the compression of the
+    original blob and without `compression_toc` the blob is used as
+    the compressed content instead of compressing the layer again
+    and `compressed_size` and `compressed_checksum` of the blob are
+    trusted. Otherwise they are computed from the content.
+
+    """
+
     def __init__(
         self,
         id,
         parent,
-        content: Union[bytes, Callable],
+        content: Union[bytes, str, os.PathLike, utils.FileSlice, Callable],
         architecture: str = "x86-64",
         os: str = "linux",
         created: str = None,
@@ -32,14 +79,43 @@ class Layer:
         checksum: str = None,
         compressed_size: int = None,
         compressed_checksum: str = None,
+        source: Tuple[str, str] = None,
+        compression: str = "gzip",
+        compression_level: int = None,
+        compression_threads: int = 1,
+        compression_block_size: int = None,
+        content_stream: Callable = None,
+        toc_cache: TocCache = None,
+        compression_toc: bool = False,
+        compressed_content_range: Callable = None,
+        compressed_content_stream: Callable = None,
     ):
         self.id = id
         self.parent = parent
-
-        if isinstance(content, bytes):
-            self._cached_content = content
-        else:  # callable
+        # (registry hostname, image) the layer was pulled from
+        self.source = source
+        self.compression = compression
+        self.compression_level = compression_level
+        self.compression_threads = compression_threads
+        self.compression_block_size = compression_block_size
+        self.toc_cache = toc_cache
+        self.compression_toc = compression_toc
+        if compressed_content_stream is not None:
+            self._compressed_content_stream = compressed_content_stream
+            self._blob_compression = compression
+            self._blob_size = compressed_size
+            self._blob_checksum = compressed_checksum
+        if compressed_content_range is not None:
+            self._compressed_content_range = compressed_content_range
+        if checksum is not None:
+            self._cached_checksum = checksum
+
+        if callable(content):
             self._content_callable = content
+        else:
+            self._set_content(content)
+        if content_stream is not None:
+            self._content_stream = content_stream
 
         self.architecture = architecture
         self.os = os
@@ -47,85 +123,514 @@ class Layer:
         self.author = author
         self.config = config or schema.DockerConfigConfig().dict()
 
+    @property
+    def compression(self):
+        return self._compression
+
+    @compression.setter
+    def compression(self, value: str):
+        if value not in compression.COMPRESSION_MEDIA_TYPES:
+            raise ValueError(f"compression={value} not supported")
+
+        if getattr(self, "_compression", value) != value:
+            self._invalidate_compressed()
+        self._compression = value
+
+    @property
+    def compression_toc(self):
+        return self._compression_toc
+
+    @compression_toc.setter
+    def compression_toc(self, value: bool):
+        if getattr(self, "_compression_toc", value) != value:
+            self._invalidate_compressed()
+        self._compression_toc = value
+
+    def _invalidate_compressed(self):
+        # changing compression invalidates the compressed content
+        for attribute in [
+            "_compressed_content",
+            "_compressed_file",
+            "_cached_compressed_size",
+            "_cached_compressed_checksum",
+        ]:
+            if hasattr(self, attribute):
+                delattr(self, attribute)
+
+    @property
+    def media_type(self):
+        return compression.COMPRESSION_MEDIA_TYPES[self.compression]
+
+    def _set_content(self, content):
+        if isinstance(content, bytes):
+            self._cached_content = content
+        elif isinstance(content, utils.FileSlice):
+            self._content_file = content
+        else:  # path
+            self._content_file = utils.FileSlice(content)
+
+    @property
+    def _content_unresolved(self):
+        return not hasattr(self, "_cached_content") and not hasattr(
+            self, "_content_file"
+        )
+
+    def _resolve_content(self):
+        if self._content_unresolved:
+            self._set_content(self._content_callable())
+
     @property
     def content(self):
-        if hasattr(self, "_cached_content"):
-            return self._cached_content
-        self._cached_content = self._content_callable()
+        self._resolve_content()
+        if hasattr(self, "_content_file"):
+            return self._content_file.read()
         return self._cached_content
 
+    @property
+    def content_buffer(self):
+        """Buffer of the layer tar which is memory mapped for file backed
+        layers instead of read into memory
+
+        """
+        self._resolve_content()
+        if hasattr(self, "_content_file"):
+            return self._content_file.mmap()
+        return memoryview(self._cached_content)
+
+    def open(self):
+        """Binary file object of the layer tar"""
+        if self._content_unresolved and hasattr(self, "_content_stream"):
+            return self._content_stream()
+
+        self._resolve_content()
+        if hasattr(self, "_content_file"):
+            return self._content_file.open()
+        return io.BytesIO(self._cached_content)
+
     @property
     def size(self):
-        return len(self.content)
+        if hasattr(self, "_cached_size"):
+            return self._cached_size
+        self._resolve_content()
+        if hasattr(self, "_content_file"):
+            return self._content_file.size
+        return len(self._cached_content)
 
     @property
     def checksum(self):
         if hasattr(self, "_cached_checksum"):
             return self._cached_checksum
-        self._cached_checksum = hashlib.sha256(self.content).hexdigest()
+        with self.open() as fileobj:
+            self._cached_checksum = utils.sha256_fileobj(fileobj)
         return self._cached_checksum
 
+    @property
+    def _original_blob(self):
+        return (
+            getattr(self, "_blob_compression", None) == self.compression
+            and not self.compression_toc
+        )
+
+    def _compress(self):
+        if hasattr(self, "_compressed_content") or hasattr(self, "_compressed_file"):
+            return
+
+        if self._original_blob:
+
+            def _write_blob(fileobj):
+                with self._compressed_content_stream() as blob_fileobj:
+                    shutil.copyfileobj(blob_fileobj, fileobj, utils.DEFAULT_CHUNK_SIZE)
+
+            self._compressed_file = utils.FileSlice.temporary(_write_blob)
+            return
+
+        self._resolve_content()
+        if hasattr(self, "_content_file"):
+
+            def _write_compressed(fileobj):
+                with self.open() as content_fileobj:
+                    compression.compress_fileobj(
+                        content_fileobj,
+                        fileobj,
+                        self.compression,
+                        level=self.compression_level,
+                        threads=self.compression_threads,
+                        block_size=self.compression_block_size,
+                        toc=self.toc if self.compression_toc else None,
+                    )
+
+            self._compressed_file = utils.FileSlice.temporary(_write_compressed)
+        else:
+            self._compressed_content = compression.compress(
+                self._cached_content,
+                self.compression,
+                level=self.compression_level,
+                threads=self.compression_threads,
+                block_size=self.compression_block_size,
+                toc=self.toc if self.compression_toc else None,
+            )
+
     @property
     def compressed_content(self):
-        if hasattr(self, "_compressed_content"):
-            return self._compressed_content
-        # mtime needs to be set to a constant to ensure reproducibility
-        self._compressed_content = gzip.compress(self.content, mtime=0)
+        self._compress()
+        if hasattr(self, "_compressed_file"):
+            return self._compressed_file.read()
         return self._compressed_content
 
+    @property
+    def compressed_buffer(self):
+        """Buffer of the compressed layer tar which is memory mapped for
+        file backed layers instead of read into memory
+
+        """
+        self._compress()
+        if hasattr(self, "_compressed_file"):
+            return self._compressed_file.mmap()
+        return memoryview(self._compressed_content)
+
+    def open_compressed(self):
+        """Binary file object of the gzip compressed layer tar"""
+        self._compress()
+        if hasattr(self, "_compressed_file"):
+            return self._compressed_file.open()
+        return io.BytesIO(self._compressed_content)
+
     @property
     def compressed_size(self):
+        if self._original_blob and self._blob_size is not None:
+            return self._blob_size
         if hasattr(self, "_cached_compressed_size"):
             return self._cached_compressed_size
-        self._cached_compressed_size = len(self.compressed_content)
+        self._compress()
+        if hasattr(self, "_compressed_file"):
+            self._cached_compressed_size = self._compressed_file.size
+        else:
+            self._cached_compressed_size = len(self._compressed_content)
         return self._cached_compressed_size
 
     @property
     def compressed_checksum(self):
+        if self._original_blob and self._blob_checksum is not None:
+            return self._blob_checksum
         if hasattr(self, "_cached_compressed_checksum"):
             return self._cached_compressed_checksum
-        self._cached_compressed_checksum = hashlib.sha256(
-            self.compressed_content
-        ).hexdigest()
+        with self.open_compressed() as fileobj:
+            self._cached_compressed_checksum = utils.sha256_fileobj(fileobj)
         return self._cached_compressed_checksum
 
     @property
     def tar(self):
-        return tarfile.TarFile(fileobj=io.BytesIO(self.content))
+        """Seekable `tarfile.TarFile` of the layer tar
+
+        The content of lazy layers is resolved first since `open` may
+        return a stream. The file object is closed along with the tar.
+
+        """
+        self._resolve_content()
+        fileobj = self.open()
+        try:
+            tar = tarfile.TarFile(fileobj=fileobj)
+        except BaseException:
+            fileobj.close()
+            raise
+        tar._extfileobj = False
+        return tar
 
     @property
     def targz(self):
+        if self.compression != "gzip":
+            raise ValueError(f"layer is compressed with {self.compression}")
         return self.compressed_content
 
+    @property
+    def toc(self):
+        """Table of contents of the layer tar as a list of
+        `tar.TocEntry`
+
+        """
+        if hasattr(self, "_toc"):
+            return self._toc
+
+        diff_id = f"sha256:{self.checksum}" if self.toc_cache is not None else None
+        toc = None if diff_id is None else self.toc_cache.get(diff_id)
+        if toc is None:
+            remote_gzip = self._remote_gzip
+            remote_index = self._remote_index() if remote_gzip else None
+            if remote_index is not None:
+                toc = remote_index[0]
+            else:
+                if remote_gzip:
+                    # the blob has no table of contents so it is fetched
+                    # once and kept for reading files
+                    self._resolve_content()
+                with self.open() as fileobj:
+                    toc = index_layer(fileobj)
+            if diff_id is not None:
+                self.toc_cache.put(diff_id, toc)
+        self._toc = toc
+        return toc
+
+    @property
+    def _remote_gzip(self):
+        return (
+            self._content_unresolved
+            and hasattr(self, "_compressed_content_range")
+            and getattr(self, "_blob_compression", None) == "gzip"
+        )
+
+    def _remote_index(self):
+        """Table of contents and `compression.GzipIndex` embedded in the
+        compressed blob of a lazy gzip layer or None if it has none
+
+        The gzip member checkpoints are kept in `toc_cache` keyed by
+        the blob digest along with the table of contents so that the
+        blob is only read again for the files themselves.
+
+        """
+        if hasattr(self, "_gzip_index"):
+            return self._gzip_index
+
+        blob_digest = None
+        if self.toc_cache is not None and self._blob_checksum is not None:
+            blob_digest = f"sha256:{self._blob_checksum}"
+
+        if blob_digest is not None:
+            checkpoints = self.toc_cache.get_index(blob_digest)
+            # an empty list records a blob without table of contents
+            if checkpoints == []:
+                self._gzip_index = None
+                return None
+            toc = getattr(self, "_toc", None)
+            if toc is None and checkpoints is not None:
+                toc = self.toc_cache.get(f"sha256:{self.checksum}")
+            if checkpoints is not None and toc is not None:
+                self._gzip_index = toc, compression.GzipIndex(
+                    [(*checkpoint, None) for checkpoint in checkpoints]
+                )
+                return self._gzip_index
+
+        self._gzip_index = compression.read_gzip_toc(self._compressed_content_range)
+        if blob_digest is not None:
+            self.toc_cache.put_index(
+                blob_digest,
+                []
+                if self._gzip_index is None
+                else self._gzip_index[1].member_checkpoints,
+            )
+        return self._gzip_index
+
     def list_files(self):
-        return self.tar.getnames()
+        return [entry.name for entry in self.toc]
+
+    def read_file(self, path: str):
+        """Content of the file at `path` within the layer read directly
+        from its offset in the layer tar
+
+        Files of lazy gzip layers with a table of contents embedded in
+        the compressed blob are read with ranges of the blob. Other
+        lazy layers are fetched once.
+
+        Links are followed within the layer. Raises a KeyError if
+        `path` is not a file in the layer.
+
+        """
+        if not hasattr(self, "_toc_paths"):
+            self._toc_paths = {_member_path(entry.name): entry for entry in self.toc}
+        entry = resolve_toc_entry(self._toc_paths, path)
+
+        remote_index = self._remote_index() if self._remote_gzip else None
+        if remote_index is not None:
+            return remote_index[1].read(
+                self._compressed_content_range, entry.offset_data, entry.size
+            )
+
+        self._resolve_content()
+        if hasattr(self, "_content_file"):
+            return self._content_file.read(entry.offset_data, entry.size)
+        return self._cached_content[entry.offset_data : entry.offset_data + entry.size]
 
 
 class Image:
-    def __init__(self, name, tag, layers=None):
+    """Docker image made of an ordered list of layers
+
+    `storage` determines where the content of layers added to the
+    image is stored either in "memory" or in temporary files on disk
+    with "file".
+
+    `platform` such as "linux/arm64/v8" sets the os and architecture
+    of the image configuration and the platform of the image in a
+    manifest list see `Registry.push_index`.
+
+    """
+
+    def __init__(
+        self,
+        name,
+        tag,
+        layers=None,
+        storage: str = "memory",
+        platform: str = None,
+    ):
+        if storage not in {"memory", "file"}:
+            raise ValueError(f"storage={storage} not supported")
+        if platform is not None:
+            schema.DockerManifestListPlatform.from_string(platform)
+
         self.name = name
         self.tag = tag
         self.layers = layers or []
+        self.storage = storage
+        self.platform = platform
 
     def remove_layer(self):
         self.layers.pop(0)
 
     def add_layer_path(
-        self, path, arcpath=None, recursive=True, filter=None, base_id=None
+        self,
+        path,
+        arcpath=None,
+        recursive=True,
+        filter=None,
+        base_id=None,
+        build_cache: BuildCache = None,
+        max_workers: int = None,
     ):
-        digest = write_tar_from_path(
-            path, arcpath=arcpath, recursive=recursive, filter=filter
+        """Add layer with the contents of `path`
+
+        With `build_cache` the layer tar is reused from a previous
+        build of `path` if the files are unchanged. With `max_workers`
+        directories are listed and files read by a pool of threads.
+
+        """
+        if build_cache is None:
+            digest = self._write_layer(
+                functools.partial(
+                    write_tar_from_path,
+                    path,
+                    arcpath=arcpath,
+                    recursive=recursive,
+                    filter=filter,
+                    max_workers=max_workers,
+                )
+            )
+            self._add_layer(digest, base_id=base_id)
+            return
+
+        tar_file, size, checksum = build_cache.build(
+            path,
+            arcpath=arcpath,
+            recursive=recursive,
+            filter=filter,
+            max_workers=max_workers,
         )
+        layer = self._add_layer(
+            tar_file if self.storage == "file" else tar_file.read(), base_id=base_id
+        )
+        layer._cached_size = size
+        layer._cached_checksum = checksum
+
+    def add_layer_diff(
+        self,
+        path,
+        base: Union[str, os.PathLike, Layer],
+        arcpath=None,
+        filter=None,
+        base_id=None,
+    ):
+        """Add layer with the changes of `path` from `base`
+
+        `base` is either a directory with the previous contents of
+        `path` or a `Layer` built from them. Only new and modified
+        files are added and deleted files are removed with whiteouts.
+        Files of a directory `base` with the same metadata and
+        modification time are assumed to be unchanged while the
+        content of files of a `Layer` is compared since layers only
+        store modification times to the second.
+
+        """
+        with contextlib.ExitStack() as stack:
+            if isinstance(base, Layer):
+                # members are compared by seeking within the layer
+                base._resolve_content()
+                base = stack.enter_context(
+                    tarfile.TarFile(fileobj=stack.enter_context(base.open()))
+                )
+            digest = self._write_layer(
+                functools.partial(
+                    write_tar_from_diff, path, base, arcpath=arcpath, filter=filter
+                )
+            )
         self._add_layer(digest, base_id=base_id)
 
-    def add_layer_paths(self, paths, filter=None, base_id=None):
-        digest = write_tar_from_paths(paths, filter=filter)
+    def add_layer_paths(
+        self, paths, filter=None, base_id=None, max_workers: int = None
+    ):
+        digest = self._write_layer(
+            functools.partial(
+                write_tar_from_paths, paths, filter=filter, max_workers=max_workers
+            )
+        )
         self._add_layer(digest, base_id=base_id)
 
     def add_layer_contents(self, contents, filter=None, base_id=None):
-        digest = write_tar_from_contents(contents, filter=filter)
+        digest = self._write_layer(
+            functools.partial(write_tar_from_contents, contents, filter=filter)
+        )
         self._add_layer(digest, base_id=base_id)
 
+    def squash(self, start: int = 0, end: int = None):
+        """Merge the layers `self.layers[start:end]` into a single layer
+
+        Files replaced or deleted by upper layers are dropped. Whiteouts
+        are kept unless the merged layers include the base layer. The
+        merged layer takes the id and metadata of the top most layer.
+
+        """
+        end = len(self.layers) if end is None else end
+        layers = self.layers[start:end]
+        if not layers:
+            raise ValueError(f"no layers to squash in [{start}:{end}]")
+
+        with contextlib.ExitStack() as stack:
+            tars = []
+            for layer in layers:
+                # lazy layers are fetched since tar members are read
+                # by seeking when links must be copied
+                layer._resolve_content()
+                fileobj = stack.enter_context(layer.open())
+                tars.append(stack.enter_context(tarfile.TarFile(fileobj=fileobj)))
+
+            content = self._write_layer(
+                functools.partial(
+                    write_tar_from_layers,
+                    tars,
+                    keep_whiteouts=layers[-1] is not self.layers[-1],
+                )
+            )
+
+        top = layers[0]
+        layer = Layer(
+            id=top.id,
+            parent=layers[-1].parent,
+            content=content,
+            architecture=top.architecture,
+            os=top.os,
+            created=top.created,
+            author=top.author,
+            config=top.config,
+            compression=top.compression,
+            compression_level=top.compression_level,
+            compression_threads=top.compression_threads,
+            compression_block_size=top.compression_block_size,
+        )
+        self.layers[start:end] = [layer]
+        return layer
+
+    def _write_layer(self, write_tar):
+        if self.storage == "file":
+            return utils.FileSlice.temporary(lambda fileobj: write_tar(fileobj=fileobj))
+        return write_tar()
+
     def _add_layer(self, digest, base_id=None):
         if len(self.layers) == 0:
             parent_id = None
@@ -140,11 +645,17 @@ class Image:
         )
 
         self.layers.insert(0, layer)
+        return layer
 
     @classmethod
     def from_filename(cls, filename):
-        tar = tarfile.TarFile(filename)
-        return parse_v1(tar)
+        """Read images from docker image tar `filename`
+
+        Only the headers of the tar are scanned, the layers are read
+        from `filename` when they are used.
+
+        """
+        return parse_v1_index(index_tar(filename))
 
     def write_filename(self, filename, version="v1"):
         if version != "v1":
@@ -152,9 +663,30 @@ class Image:
 
         write_v1(self, filename)
 
+    @property
+    def manifest_media_type(self):
+        """zstd compressed layers are only supported by OCI manifests"""
+        if any(layer.compression == "zstd" for layer in self.layers):
+            return schema.OCI_MANIFEST_MEDIA_TYPE
+        return schema.DOCKER_MANIFEST_V2_MEDIA_TYPE
+
     @property
     def manifest_v2(self):
-        docker_manifest = schema.DockerManifestV2.construct()
+        if self.manifest_media_type == schema.OCI_MANIFEST_MEDIA_TYPE:
+            docker_manifest = schema.DockerManifestV2.construct(
+                mediaType=schema.OCI_MANIFEST_MEDIA_TYPE
+            )
+            config_media_type = schema.OCI_CONFIG_MEDIA_TYPE
+        else:
+            docker_manifest = schema.DockerManifestV2.construct()
+            config_media_type = schema.DOCKER_CONFIG_MEDIA_TYPE
+
+        platform = {}
+        if self.platform is not None:
+            platform = schema.DockerManifestListPlatform.from_string(
+                self.platform
+            ).dict(exclude_none=True)
+
         docker_config = schema.DockerConfig.construct(
             config=schema.DockerConfigConfig(),
             container_config=schema.DockerConfigConfig(),
@@ -163,18 +695,25 @@ class Image:
 
         for layer in self.layers:
             docker_layer = schema.DockerManifestV2Layer(
-                size=layer.compressed_size, digest=f"sha256:{layer.compressed_checksum}"
+                mediaType=layer.media_type,
+                size=layer.compressed_size,
+                digest=f"sha256:{layer.compressed_checksum}",
             )
             docker_manifest.layers.append(docker_layer)
             docker_config_history = schema.DockerConfigHistory()
             docker_config.history.append(docker_config_history)
             docker_config.rootfs.diff_ids.append(f"sha256:{layer.checksum}")
 
-        docker_config_content = utils.sorted_json_dumps(docker_config.dict())
+        # DockerConfig has no variant field
+        docker_config_content = utils.sorted_json_dumps(
+            {**docker_config.dict(), **platform}
+        )
         docker_config_hash = hashlib.sha256(docker_config_content).hexdigest()
 
         docker_manifest.config = schema.DockerManifestV2Config(
-            size=len(docker_config_content), digest=f"sha256:{docker_config_hash}"
+            mediaType=config_media_type,
+            size=len(docker_config_content),
+            digest=f"sha256:{docker_config_hash}",
         )
         docker_manifest_content = utils.sorted_json_dumps(docker_manifest.dict())
         docker_manifest_hash = hashlib.sha256(docker_manifest_content).hexdigest()
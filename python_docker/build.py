@@ -0,0 +1,231 @@
+import concurrent.futures
+import contextlib
+import hashlib
+import json
+import os
+import tarfile
+import tempfile
+
+from python_docker import utils
+from python_docker.tar import _add_entries, walk_path
+
+
+def default_build_cache_path():
+    cache_home = os.environ.get(
+        "XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")
+    )
+    return os.path.join(cache_home, "python-docker", "layers")
+
+
+def _stat_key(statres):
+    return [
+        statres.st_size,
+        statres.st_mtime_ns,
+        statres.st_ctime_ns,
+        statres.st_mode,
+        statres.st_ino,
+        statres.st_dev,
+    ]
+
+
+class BuildCache:
+    """On-disk cache of layer tars built from directories
+
+    The last tar built from each path is kept along with the metadata
+    of the files in it. A tree whose file metadata is unchanged reuses
+    the previous tar and its checksum without reading any file
+    content. When only some files changed the content of the unchanged
+    files is copied from the previous tar and the checksum is computed
+    while the tar is written.
+
+    Files are assumed to be unchanged if their path, size,
+    modification time, change time, mode and inode are the same.
+    Reusing a tar marks it as recently used and the tars of the least
+    recently used paths are evicted once the cache exceeds `max_size`
+    bytes.
+
+    """
+
+    def __init__(self, path: str = None, max_size: int = None):
+        self.path = path or default_build_cache_path()
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.path, exist_ok=True)
+
+    def _entry_path(self, path, arcpath, recursive: bool):
+        key = json.dumps([os.path.abspath(path), arcpath, recursive])
+        return os.path.join(self.path, hashlib.sha256(key.encode("utf-8")).hexdigest())
+
+    def _load(self, entry_path: str):
+        try:
+            with open(entry_path + ".json") as f:
+                entry = json.load(f)
+            tar_file = utils.FileSlice(os.path.join(self.path, entry["tar"]))
+        except (FileNotFoundError, ValueError, KeyError):
+            return None, None
+        return entry, tar_file
+
+    def build(
+        self,
+        path,
+        arcpath=None,
+        recursive: bool = True,
+        filter=None,
+        max_workers: int = None,
+    ):
+        """Build tar of `path` as `write_tar_from_path` would
+
+        Returns a `utils.FileSlice` of the tar along with its size and
+        sha256 checksum.
+
+        """
+        if max_workers is None:
+            return self._build(path, arcpath, recursive, filter)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return self._build(path, arcpath, recursive, filter, executor)
+
+    def _build(self, path, arcpath, recursive, filter, executor=None):
+        entry_path = self._entry_path(path, arcpath, recursive)
+        entry, previous_tar = self._load(entry_path)
+
+        # the headers and file metadata determine the tar if the
+        # content of files with unchanged metadata is unchanged
+        fingerprint = hashlib.sha256()
+        files = {}
+        entries = []
+        with tarfile.TarFile(mode="w", fileobj=_NullWriter()) as tar:
+            for name, tarinfo, statres in walk_path(
+                tar, path, arcpath, recursive, filter, executor=executor
+            ):
+                fingerprint.update(tarinfo.tobuf(tar.format, tar.encoding, tar.errors))
+                if tarinfo.isreg():
+                    files[name] = _stat_key(statres)
+                    fingerprint.update(json.dumps(files[name]).encode("utf-8"))
+                entries.append((name, tarinfo, statres))
+        fingerprint = fingerprint.hexdigest()
+
+        if entry is not None and entry["fingerprint"] == fingerprint:
+            self.hits += 1
+            # modification time is used to track the least recently used tars
+            with contextlib.suppress(FileNotFoundError):
+                os.utime(previous_tar.path)
+            return previous_tar, entry["size"], entry["checksum"]
+        self.misses += 1
+
+        previous_files = entry["files"] if entry is not None else {}
+
+        def _open_previous(name, tarinfo, statres):
+            previous = previous_files.get(name)
+            if previous is None or previous["stat"] != files[name]:
+                return None
+            if previous["size"] != tarinfo.size:
+                return None
+            return utils.FileSlice(
+                previous_tar.path,
+                offset=previous["offset"],
+                size=previous["size"],
+                file=previous_tar._file,
+            ).open()
+
+        fd, temp_path = tempfile.mkstemp(dir=self.path, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as fileobj:
+                writer = utils.HashingWriter(fileobj)
+                with tarfile.TarFile(mode="w", fileobj=writer) as tar:
+                    offsets = _add_entries(
+                        tar, entries, _open_previous, executor=executor
+                    )
+                size, checksum = writer.size, writer.hexdigest()
+
+            tar_name = f"{os.path.basename(entry_path)}-{checksum}.tar"
+            os.replace(temp_path, os.path.join(self.path, tar_name))
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(temp_path)
+            raise
+        finally:
+            if previous_tar is not None:
+                previous_tar.close()
+
+        self._save(
+            entry_path,
+            {
+                "fingerprint": fingerprint,
+                "tar": tar_name,
+                "size": size,
+                "checksum": checksum,
+                "files": {
+                    name: {
+                        "stat": files[name],
+                        "offset": offset,
+                        "size": files[name][0],
+                    }
+                    for name, offset in offsets.items()
+                },
+            },
+        )
+        if entry is not None and entry["tar"] != tar_name:
+            # slices of the previous tar remain readable once removed
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(os.path.join(self.path, entry["tar"]))
+
+        tar_file = utils.FileSlice(os.path.join(self.path, tar_name))
+        self._evict(keep=tar_file.path)
+        return tar_file, size, checksum
+
+    def _save(self, entry_path: str, entry: dict):
+        fd, temp_path = tempfile.mkstemp(dir=self.path, prefix=".tmp-")
+        with os.fdopen(fd, "w") as f:
+            json.dump(entry, f)
+        os.replace(temp_path, entry_path + ".json")
+
+    def _tars(self):
+        for entry in os.scandir(self.path):
+            if (
+                entry.is_file()
+                and entry.name.endswith(".tar")
+                and not entry.name.startswith(".tmp-")
+            ):
+                yield entry.path, entry.stat()
+
+    @property
+    def size(self):
+        return sum(stat.st_size for _, stat in self._tars())
+
+    def evict(self):
+        self._evict()
+
+    def _evict(self, keep: str = None):
+        if self.max_size is None:
+            return
+
+        tars = sorted(self._tars(), key=lambda tar: tar[1].st_mtime)
+        size = sum(stat.st_size for _, stat in tars)
+        for path, stat in tars:
+            if size <= self.max_size:
+                break
+            if path == keep:
+                continue
+            # tar names start with the name of their entry
+            entry_name = os.path.basename(path).split("-", 1)[0]
+            with contextlib.suppress(OSError):
+                os.remove(os.path.join(self.path, entry_name + ".json"))
+            # tars open on windows cannot be removed
+            with contextlib.suppress(OSError):
+                os.remove(path)
+            size -= stat.st_size
+
+
+class _NullWriter:
+    """File object discarding everything written to it"""
+
+    def __init__(self):
+        self.offset = 0
+
+    def tell(self):
+        return self.offset
+
+    def write(self, buffer):
+        self.offset += len(buffer)
+        return len(buffer)
@@ -0,0 +1,374 @@
+import collections
+import contextlib
+import hashlib
+import io
+import json
+import os
+import re
+import tempfile
+import threading
+
+from python_docker import utils
+from python_docker.tar import TocEntry
+
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
+
+def default_cache_path():
+    cache_home = os.environ.get(
+        "XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")
+    )
+    return os.path.join(cache_home, "python-docker", "blobs")
+
+
+# digest grammar of the OCI image specification with sha256 sized
+# hex checksums which keeps blob paths within the cache
+DIGEST_PATTERN = re.compile(r"^[a-z0-9]+(?:[+._-][a-z0-9]+)*:[a-f0-9]{64}$")
+
+
+class BlobCache:
+    """Content addressable on-disk cache of blobs keyed by digest
+
+    The cache may be shared by several `Registry` instances and
+    processes. Blobs are written to a temporary file and atomically
+    renamed into place once complete. Reading a blob marks it as
+    recently used and the least recently used blobs are evicted once
+    the cache exceeds `max_size` bytes.
+
+    Blobs of digests with a hashlib algorithm are verified as they are
+    read and removed from the cache if they do not match. `hits` and
+    `misses` count the blobs opened through `open` and `get`.
+
+    """
+
+    def __init__(self, path: str = None, max_size: int = None):
+        self.path = path or default_cache_path()
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._counter_lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+
+    def blob_path(self, digest: str):
+        if not DIGEST_PATTERN.match(digest):
+            raise ValueError(f"invalid blob digest {digest}")
+        algorithm, checksum = digest.split(":", 1)
+        return os.path.join(self.path, algorithm, checksum)
+
+    def __contains__(self, digest: str):
+        return os.path.exists(self.blob_path(digest))
+
+    @contextlib.contextmanager
+    def lock(self):
+        """Exclusive lock on the cache shared between processes"""
+        with open(os.path.join(self.path, ".lock"), "wb") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def open(self, digest: str, verify: bool = True):
+        """Open cached blob for reading or return None if not cached
+
+        The digest is verified once the end of the blob is read unless
+        `verify` is False such as for seeking within the blob.
+
+        """
+        fileobj = self._open(digest, verify)
+        with self._counter_lock:
+            if fileobj is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return fileobj
+
+    def _open(self, digest: str, verify: bool = True):
+        path = self.blob_path(digest)
+        try:
+            fileobj = open(path, "rb")
+        except FileNotFoundError:
+            return None
+
+        # modification time is used to track the least recently used blobs
+        with contextlib.suppress(FileNotFoundError):
+            os.utime(path)
+        return self._verifying(fileobj, digest, path) if verify else fileobj
+
+    def _verifying(self, fileobj, digest: str, path: str):
+        algorithm = digest.split(":", 1)[0]
+        if algorithm not in hashlib.algorithms_available:
+            return fileobj
+        return io.BufferedReader(
+            _CachedBlobReader(fileobj, digest, path), utils.DEFAULT_CHUNK_SIZE
+        )
+
+    def get(self, digest: str, count: bool = True):
+        """Content of cached blob or None if it is not cached or does
+        not match its digest
+
+        Lookups with `count` False such as of manifests and tables of
+        contents are not counted in `hits` and `misses`.
+
+        """
+        fileobj = self.open(digest) if count else self._open(digest)
+        if fileobj is None:
+            return None
+        with fileobj:
+            try:
+                return fileobj.read()
+            except ValueError:
+                return None
+
+    @contextlib.contextmanager
+    def writer(self, digest: str, on_commit=None):
+        """Write blob into cache
+
+        Yields a file object to write the blob to. The blob is only
+        added to the cache if the block exits without an exception.
+        `on_commit(path)` is called once the blob is in place while
+        the cache is locked so that it may open the blob before any
+        eviction.
+
+        """
+        path = self.blob_path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as fileobj:
+                yield fileobj
+            with self.lock():
+                os.replace(temp_path, path)
+                if on_commit is not None:
+                    on_commit(path)
+                self._evict(keep=path)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(temp_path)
+            raise
+
+    def download(self, digest: str):
+        """Write blob into cache and open the written blob
+
+        Yields a file object to write the blob to as `writer`. Once the
+        block exits the blob opened for reading is available as the
+        `fileobj` attribute of the returned context manager which
+        stays readable even if the blob is evicted afterwards.
+
+        """
+        return _BlobDownload(self, digest)
+
+    def put(self, digest: str, content: bytes):
+        with self.writer(digest) as fileobj:
+            fileobj.write(content)
+
+    def _blobs(self):
+        for entry in os.scandir(self.path):
+            if not entry.is_dir():
+                continue
+            for blob_entry in os.scandir(entry.path):
+                if blob_entry.is_file() and not blob_entry.name.startswith(".tmp-"):
+                    yield blob_entry.path, blob_entry.stat()
+
+    @property
+    def size(self):
+        return sum(stat.st_size for _, stat in self._blobs())
+
+    def evict(self):
+        with self.lock():
+            self._evict()
+
+    def _evict(self, keep: str = None):
+        if self.max_size is None:
+            return
+
+        blobs = sorted(self._blobs(), key=lambda blob: blob[1].st_mtime)
+        size = sum(stat.st_size for _, stat in blobs)
+        for path, stat in blobs:
+            if size <= self.max_size:
+                break
+            if path == keep:
+                continue
+            # blobs open on windows cannot be removed
+            with contextlib.suppress(OSError):
+                os.remove(path)
+            size -= stat.st_size
+
+
+class _CachedBlobReader(utils.VerifyingReader):
+    """Reader of a cached blob which removes it from the cache if it
+    does not match its digest
+
+    """
+
+    def __init__(self, fileobj, digest: str, path: str):
+        super().__init__(fileobj, digest)
+        self._path = path
+
+    def readinto(self, buffer):
+        try:
+            return super().readinto(buffer)
+        except ValueError:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self._path)
+            raise
+
+
+class _BlobDownload:
+    def __init__(self, cache: BlobCache, digest: str):
+        self.fileobj = None
+        self._writer = cache.writer(digest, on_commit=self._open)
+
+    def _open(self, path: str):
+        self.fileobj = open(path, "rb")
+
+    def __enter__(self):
+        return self._writer.__enter__()
+
+    def __exit__(self, *args):
+        return self._writer.__exit__(*args)
+
+
+class _LRUDict:
+    """Thread safe mapping holding at most `max_entries` entries
+    evicting the least recently used ones
+
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class ManifestCache:
+    """In memory cache of manifests and image configurations keyed by
+    digest
+
+    Each tag is mapped to the digest it last resolved to so that an
+    unchanged tag only needs to be revalidated with a HEAD request.
+    Content is also stored in `blob_cache` when given so that it is
+    shared with other instances. At most `max_entries` manifests and
+    tags are kept in memory.
+
+    """
+
+    def __init__(self, blob_cache: BlobCache = None, max_entries: int = 1024):
+        self.blob_cache = blob_cache
+        self._contents = _LRUDict(max_entries)
+        self._digests = _LRUDict(max_entries)
+
+    def digest(self, image: str, reference: str, media_type: str):
+        """Digest `reference` last resolved to or None if unknown
+
+        References which are digests resolve to themselves.
+
+        """
+        if reference.startswith("sha256:"):
+            return reference
+        return self._digests.get((image, reference, media_type))
+
+    def tag(self, image: str, reference: str, media_type: str, digest: str):
+        if not reference.startswith("sha256:"):
+            self._digests[(image, reference, media_type)] = digest
+
+    def get(self, digest: str):
+        content = self._contents.get(digest)
+        if content is None and self.blob_cache is not None:
+            content = self.blob_cache.get(digest, count=False)
+            if content is not None:
+                self._contents[digest] = content
+        return content
+
+    def put(self, digest: str, content: bytes):
+        """Cache `content` raising a ValueError if it does not match
+        `digest`
+
+        """
+        if not utils.matches_digest(content, digest):
+            raise ValueError(f"content does not match digest {digest}")
+        self._contents[digest] = content
+        if self.blob_cache is not None and digest not in self.blob_cache:
+            self.blob_cache.put(digest, content)
+
+
+class TocCache:
+    """In memory cache of layer tables of contents keyed by the diff id
+    of the layer
+
+    Tables of contents are also stored in `blob_cache` when given
+    under the "toc-sha256" algorithm so that they persist across
+    processes and are evicted along with blobs. At most `max_entries`
+    tables of contents are kept in memory.
+
+    The gzip member checkpoints of compressed blobs are cached the
+    same way keyed by the blob digest under the "gzindex-sha256"
+    algorithm.
+
+    """
+
+    def __init__(self, blob_cache: BlobCache = None, max_entries: int = 64):
+        self.blob_cache = blob_cache
+        self._tocs = _LRUDict(max_entries)
+        self._indexes = _LRUDict(max_entries)
+
+    def _blob_digest(self, diff_id: str):
+        return f"toc-{diff_id}"
+
+    def get(self, diff_id: str):
+        toc = self._tocs.get(diff_id)
+        if toc is None and self.blob_cache is not None:
+            content = self.blob_cache.get(self._blob_digest(diff_id), count=False)
+            if content is not None:
+                toc = [TocEntry(*entry) for entry in json.loads(content)]
+                self._tocs[diff_id] = toc
+        return toc
+
+    def put(self, diff_id: str, toc):
+        self._tocs[diff_id] = toc
+        if self.blob_cache is not None:
+            self.blob_cache.put(
+                self._blob_digest(diff_id), json.dumps(toc).encode("utf-8")
+            )
+
+    def get_index(self, blob_digest: str):
+        """Gzip member checkpoints of blob `blob_digest` as a list of
+        uncompressed and compressed offsets or None if unknown
+
+        """
+        checkpoints = self._indexes.get(blob_digest)
+        if checkpoints is None and self.blob_cache is not None:
+            content = self.blob_cache.get(f"gzindex-{blob_digest}", count=False)
+            if content is not None:
+                checkpoints = [tuple(checkpoint) for checkpoint in json.loads(content)]
+                self._indexes[blob_digest] = checkpoints
+        return checkpoints
+
+    def put_index(self, blob_digest: str, checkpoints):
+        self._indexes[blob_digest] = checkpoints
+        if self.blob_cache is not None:
+            self.blob_cache.put(
+                f"gzindex-{blob_digest}", json.dumps(checkpoints).encode("utf-8")
+            )
@@ -0,0 +1,490 @@
+import bisect
+import collections
+import concurrent.futures
+import gzip
+import io
+import json
+import shutil
+import struct
+import zlib
+
+from python_docker import schema
+from python_docker.utils import DEFAULT_CHUNK_SIZE
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+COMPRESSION_MEDIA_TYPES = {
+    "gzip": schema.DOCKER_LAYER_GZIP_MEDIA_TYPE,
+    "zstd": schema.OCI_LAYER_ZSTD_MEDIA_TYPE,
+}
+
+MEDIA_TYPE_COMPRESSIONS = {
+    schema.DOCKER_LAYER_GZIP_MEDIA_TYPE: "gzip",
+    schema.OCI_LAYER_GZIP_MEDIA_TYPE: "gzip",
+    schema.OCI_LAYER_ZSTD_MEDIA_TYPE: "zstd",
+}
+
+DEFAULT_COMPRESSION_LEVELS = {
+    "gzip": 9,
+    "zstd": 3,
+}
+
+# size of the blocks compressed independently by parallel gzip
+DEFAULT_BLOCK_SIZE = 2**17
+# deflate window size used as the dictionary from the previous block
+_DEFLATE_WINDOW_SIZE = 2**15
+
+
+def _gzip_header(level: int):
+    # mtime is set to a constant and the os to unknown to ensure
+    # reproducibility regardless of python version and platform
+    if level == 9:
+        extra_flags = b"\x02"
+    elif level == 1:
+        extra_flags = b"\x04"
+    else:
+        extra_flags = b"\x00"
+    return b"\x1f\x8b\x08\x00" + struct.pack("<L", 0) + extra_flags + b"\xff"
+
+
+def gzip_compress_fileobj(
+    src,
+    dst,
+    level: int = 9,
+    threads: int = 1,
+    block_size: int = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+):
+    """Stream gzip compressed `src` file object into `dst`
+
+    By default a single deflate stream is written. If `block_size` is
+    set or `threads` is greater than one `src` is split into blocks
+    which are deflated independently on a pool of `threads` threads
+    and concatenated into a single gzip member similar to pigz. Each
+    block is primed with the last 32 KiB of the previous block so the
+    output only depends on `level` and `block_size` and not on the
+    number of threads.
+
+    """
+    if threads > 1 and block_size is None:
+        block_size = DEFAULT_BLOCK_SIZE
+
+    dst.write(_gzip_header(level))
+    if block_size is None:
+        crc, size = _deflate_stream(src, dst, level, chunk_size)
+    else:
+        crc, size = _deflate_blocks(src, dst, level, threads, block_size)
+    dst.write(struct.pack("<LL", crc, size & 0xFFFFFFFF))
+
+
+def _deflate_stream(src, dst, level: int, chunk_size: int):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    crc, size = 0, 0
+    for chunk in iter(lambda: src.read(chunk_size), b""):
+        crc = zlib.crc32(chunk, crc)
+        size += len(chunk)
+        dst.write(compressor.compress(chunk))
+    dst.write(compressor.flush())
+    return crc, size
+
+
+def _deflate_block(block: bytes, dictionary: bytes, level: int, last: bool):
+    kwargs = {"zdict": dictionary} if dictionary else {}
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, **kwargs)
+    # a sync flush byte aligns the block without marking the end of
+    # the deflate stream so that blocks can be concatenated
+    return compressor.compress(block) + compressor.flush(
+        zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH
+    )
+
+
+def _deflate_blocks(src, dst, level: int, threads: int, block_size: int):
+    crc, size = 0, 0
+    dictionary = b""
+    pending = collections.deque()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        block = src.read(block_size)
+        while True:
+            next_block = src.read(block_size)
+            last = not next_block
+
+            crc = zlib.crc32(block, crc)
+            size += len(block)
+            pending.append(
+                executor.submit(_deflate_block, block, dictionary, level, last)
+            )
+            dictionary = (dictionary + block)[-_DEFLATE_WINDOW_SIZE:]
+
+            # bound the number of blocks held in memory
+            while len(pending) > 2 * threads:
+                dst.write(pending.popleft().result())
+
+            if last:
+                break
+            block = next_block
+
+        while pending:
+            dst.write(pending.popleft().result())
+
+    return crc, size
+
+
+def gzip_compress(content, level: int = 9, threads: int = 1, block_size: int = None):
+    dst = io.BytesIO()
+    gzip_compress_fileobj(
+        io.BytesIO(content), dst, level=level, threads=threads, block_size=block_size
+    )
+    return dst.getvalue()
+
+
+def gzip_decompress_fileobj(src, dst, chunk_size: int = DEFAULT_CHUNK_SIZE):
+    """Stream gzip decompressed `src` file object into `dst`"""
+    with gzip.GzipFile(fileobj=src, mode="rb") as gzip_fileobj:
+        shutil.copyfileobj(gzip_fileobj, dst, chunk_size)
+
+
+# uncompressed bytes between checkpoints of a gzip index
+DEFAULT_INDEX_SPACING = 2**22
+# uncompressed bytes after which a tar member starts a new gzip member
+# in gzip layers with a table of contents
+DEFAULT_TOC_SPACING = 2**18
+# compressed bytes decompressed at once while building a gzip index
+_INDEX_INPUT_SIZE = 2**15
+# identifies the footer of gzip layers with a table of contents
+_TOC_FOOTER_MAGIC = b"PYDOCKERTOC"
+
+
+class GzipIndex:
+    """Checkpoints of a gzip stream allowing decompression to start
+    close to any uncompressed offset similar to zran
+
+    Each checkpoint is a tuple of the uncompressed offset, the
+    compressed offset and a copy of the decompressor at that point or
+    None where a new gzip member starts. Checkpoints at gzip member
+    boundaries can be serialized with `member_checkpoints`.
+
+    """
+
+    def __init__(self, checkpoints=None):
+        self.checkpoints = checkpoints or [(0, 0, None)]
+
+    @classmethod
+    def build(cls, fileobj, spacing: int = DEFAULT_INDEX_SPACING):
+        """Index the gzip stream read from `fileobj` in a single pass"""
+        with GzipIndexingReader(fileobj, spacing) as reader:
+            while reader.read(DEFAULT_CHUNK_SIZE):
+                pass
+            return reader.index
+
+    @property
+    def member_checkpoints(self):
+        return [
+            (uncompressed_offset, compressed_offset)
+            for uncompressed_offset, compressed_offset, state in self.checkpoints
+            if state is None
+        ]
+
+    def read(self, read_range, offset: int, size: int):
+        """Read `size` uncompressed bytes at `offset`
+
+        `read_range(start, end)` returns the compressed bytes from
+        `start` up to `end` or the end of the stream if `end` is None.
+        Only the compressed bytes between the checkpoints surrounding
+        the requested range are read.
+
+        """
+        offsets = [checkpoint[0] for checkpoint in self.checkpoints]
+        start = bisect.bisect_right(offsets, offset) - 1
+        end = bisect.bisect_left(offsets, offset + size)
+        uncompressed_offset, compressed_offset, state = self.checkpoints[start]
+        compressed_end = (
+            self.checkpoints[end][1] if end < len(self.checkpoints) else None
+        )
+
+        data = read_range(compressed_offset, compressed_end)
+        decompressor = _gzip_decompressor() if state is None else state.copy()
+        chunks = []
+        while data:
+            chunks.append(decompressor.decompress(data))
+            data = decompressor.unused_data if decompressor.eof else b""
+            if decompressor.eof:
+                decompressor = _gzip_decompressor()
+        content = b"".join(chunks)
+        return content[offset - uncompressed_offset :][:size]
+
+
+def _gzip_decompressor():
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+class GzipIndexingReader(io.RawIOBase):
+    """Reader decompressing the gzip stream `fileobj` while building a
+    `GzipIndex` with checkpoints every `spacing` uncompressed bytes
+
+    """
+
+    def __init__(self, fileobj, spacing: int = DEFAULT_INDEX_SPACING):
+        self._fileobj = fileobj
+        self._spacing = spacing
+        self._decompressor = _gzip_decompressor()
+        self._member_start = True
+        self._buffer, self._position = b"", 0
+        self._compressed_offset = 0
+        self._uncompressed_offset = 0
+        self.index = GzipIndex()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self._position == len(self._buffer):
+            data = self._fileobj.read(DEFAULT_CHUNK_SIZE)
+            if not data:
+                return 0
+            # checkpoints are placed between slices of the input
+            self._buffer = b"".join(
+                self._decompress(data[i : i + _INDEX_INPUT_SIZE])
+                for i in range(0, len(data), _INDEX_INPUT_SIZE)
+            )
+            self._position = 0
+
+        size = min(len(buffer), len(self._buffer) - self._position)
+        memoryview(buffer)[:size] = self._buffer[self._position : self._position + size]
+        self._position += size
+        return size
+
+    def _decompress(self, data: bytes):
+        self._compressed_offset += len(data)
+        chunks = []
+        while data:
+            self._member_start = False
+            chunks.append(self._decompressor.decompress(data))
+            data = self._decompressor.unused_data if self._decompressor.eof else b""
+            if self._decompressor.eof:
+                self._decompressor = _gzip_decompressor()
+                self._member_start = True
+        content = b"".join(chunks)
+        self._uncompressed_offset += len(content)
+
+        last_offset = self.index.checkpoints[-1][0]
+        if self._uncompressed_offset - last_offset >= self._spacing:
+            state = None if self._member_start else self._decompressor.copy()
+            self.index.checkpoints.append(
+                (self._uncompressed_offset, self._compressed_offset, state)
+            )
+        return content
+
+    def close(self):
+        self._fileobj.close()
+        super().close()
+
+
+def _gzip_member(data: bytes, level: int):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return (
+        _gzip_header(level)
+        + compressor.compress(data)
+        + compressor.flush()
+        + struct.pack("<LL", zlib.crc32(data), len(data) & 0xFFFFFFFF)
+    )
+
+
+def _gzip_empty_member(flags: int, fields: bytes):
+    """Gzip member without content with the optional header `fields`
+    set in `flags`
+
+    """
+    compressor = zlib.compressobj(0, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return (
+        b"\x1f\x8b\x08"
+        + bytes([flags])
+        + struct.pack("<L", 0)
+        + b"\x00\xff"
+        + fields
+        + compressor.flush()
+        + struct.pack("<LL", 0, 0)
+    )
+
+
+def _toc_footer(toc_offset: int):
+    payload = b"%016x" % toc_offset + _TOC_FOOTER_MAGIC
+    subfield = b"PD" + struct.pack("<H", len(payload)) + payload
+    # FEXTRA
+    return _gzip_empty_member(0x04, struct.pack("<H", len(subfield)) + subfield)
+
+
+TOC_FOOTER_SIZE = len(_toc_footer(0))
+
+
+def gzip_compress_toc_fileobj(
+    src, dst, toc, level: int = 9, spacing: int = DEFAULT_TOC_SPACING
+):
+    """Stream gzip compressed layer tar `src` into `dst` along with its
+    table of contents similar to eStargz
+
+    `toc` is the list of `tar.TocEntry` of `src`. A new gzip member is
+    started at the first tar member `spacing` bytes after the start
+    of the previous gzip member. The table of contents and the
+    offsets of the gzip members are stored as json in the comment of
+    an empty gzip member followed by an empty gzip member pointing to
+    it. The decompressed content is identical to `src` and can be
+    read from the offsets with `read_gzip_toc` and `GzipIndex`.
+
+    """
+    boundaries = []
+    for entry in toc:
+        if not boundaries or entry.offset - boundaries[-1] >= spacing:
+            boundaries.append(entry.offset)
+    boundaries = boundaries[1:]
+
+    checkpoints = []
+    uncompressed_offset, compressed_offset = 0, 0
+    for boundary in boundaries + [None]:
+        data = (
+            src.read() if boundary is None else src.read(boundary - uncompressed_offset)
+        )
+        member = _gzip_member(data, level)
+        dst.write(member)
+        checkpoints.append((uncompressed_offset, compressed_offset))
+        uncompressed_offset += len(data)
+        compressed_offset += len(member)
+
+    content = json.dumps(
+        {"version": 1, "entries": toc, "checkpoints": checkpoints},
+        separators=(",", ":"),
+    ).encode("ascii")
+    # FCOMMENT
+    dst.write(_gzip_empty_member(0x10, content + b"\x00"))
+    dst.write(_toc_footer(compressed_offset))
+
+
+def read_gzip_toc(read_range):
+    """Table of contents and `GzipIndex` of a gzip layer blob written
+    by `gzip_compress_toc_fileobj`
+
+    `read_range(start, end)` returns the bytes of the blob from
+    `start` up to `end` or the end of the blob if `end` is None where a
+    negative `start` counts from the end. Returns None if the blob has
+    no table of contents.
+
+    """
+    from python_docker.tar import TocEntry
+
+    footer = read_range(-TOC_FOOTER_SIZE, None)
+    payload = bytes(footer[16 : 16 + 16 + len(_TOC_FOOTER_MAGIC)])
+    if len(footer) != TOC_FOOTER_SIZE or not payload.endswith(_TOC_FOOTER_MAGIC):
+        return None
+
+    member = read_range(int(payload[:16], 16), None)
+    content = json.loads(member[10 : member.index(b"\x00", 10)])
+    toc = [TocEntry(*entry) for entry in content["entries"]]
+    index = GzipIndex(
+        [
+            (uncompressed_offset, compressed_offset, None)
+            for uncompressed_offset, compressed_offset in content["checkpoints"]
+        ]
+    )
+    return toc, index
+
+
+def _check_zstandard():
+    if zstandard is None:
+        raise ImportError("zstd compression requires the zstandard package")
+
+
+def zstd_compress_fileobj(src, dst, level: int = 3, threads: int = 1):
+    """Stream zstd compressed `src` file object into `dst`"""
+    _check_zstandard()
+    # zero threads compresses within the calling thread
+    compressor = zstandard.ZstdCompressor(
+        level=level, threads=threads if threads > 1 else 0
+    )
+    compressor.copy_stream(src, dst)
+
+
+def zstd_decompress_fileobj(src, dst):
+    """Stream zstd decompressed `src` file object into `dst`"""
+    _check_zstandard()
+    zstandard.ZstdDecompressor().copy_stream(src, dst)
+
+
+def media_type_compression(media_type: str):
+    if media_type not in MEDIA_TYPE_COMPRESSIONS:
+        raise ValueError(f"layer media type {media_type} not supported")
+    return MEDIA_TYPE_COMPRESSIONS[media_type]
+
+
+def compress_fileobj(
+    src,
+    dst,
+    compression: str = "gzip",
+    level: int = None,
+    threads: int = 1,
+    block_size: int = None,
+    toc=None,
+):
+    """Stream `src` compressed with `compression` into `dst`
+
+    If the table of contents `toc` of the layer tar `src` is given it
+    is embedded with `gzip_compress_toc_fileobj`.
+
+    """
+    if compression not in COMPRESSION_MEDIA_TYPES:
+        raise ValueError(f"compression={compression} not supported")
+
+    level = DEFAULT_COMPRESSION_LEVELS[compression] if level is None else level
+    if toc is not None:
+        if compression != "gzip":
+            raise ValueError(f"table of contents not supported with {compression}")
+        gzip_compress_toc_fileobj(src, dst, toc, level=level)
+    elif compression == "gzip":
+        gzip_compress_fileobj(
+            src, dst, level=level, threads=threads, block_size=block_size
+        )
+    elif compression == "zstd":
+        zstd_compress_fileobj(src, dst, level=level, threads=threads)
+
+
+def compress(content, compression: str = "gzip", **kwargs):
+    dst = io.BytesIO()
+    compress_fileobj(io.BytesIO(content), dst, compression, **kwargs)
+    return dst.getvalue()
+
+
+def decompress_fileobj(src, dst, compression: str = "gzip"):
+    """Stream `src` decompressed with `compression` into `dst`"""
+    if compression == "gzip":
+        gzip_decompress_fileobj(src, dst)
+    elif compression == "zstd":
+        zstd_decompress_fileobj(src, dst)
+    else:
+        raise ValueError(f"compression={compression} not supported")
+
+
+class _GzipReader(gzip.GzipFile):
+    """Gzip reader which closes the underlying file object"""
+
+    def close(self):
+        fileobj = self.fileobj
+        super().close()
+        if fileobj is not None:
+            fileobj.close()
+
+
+def open_decompressed(fileobj, compression: str = "gzip"):
+    """Readable file object decompressing `fileobj` as it is read
+
+    Closing the returned file object closes `fileobj`.
+
+    """
+    if compression == "gzip":
+        return _GzipReader(fileobj=fileobj, mode="rb")
+    elif compression == "zstd":
+        _check_zstandard()
+        return zstandard.ZstdDecompressor().stream_reader(fileobj, closefd=True)
+    raise ValueError(f"compression={compression} not supported")
@@ -0,0 +1,145 @@
+import logging
+import re
+import threading
+from typing import NamedTuple, Optional
+from urllib.parse import urlparse
+
+
+class RequestEvent(NamedTuple):
+    """Single http request made by a registry client
+
+    `seconds` is the time until the response body was read or the
+    streamed response was closed. `retries` is the number of earlier
+    attempts of the same request. `status` is None if no response was
+    received in which case `error` is the exception raised.
+
+    """
+
+    method: str
+    url: str
+    url_template: str
+    status: Optional[int]
+    bytes_sent: int
+    bytes_received: int
+    seconds: float
+    retries: int = 0
+    error: Optional[BaseException] = None
+
+
+_URL_TEMPLATES = [
+    (re.compile(r"/v2/.+/blobs/uploads/"), "/v2/{name}/blobs/uploads/"),
+    (re.compile(r"/v2/.+/blobs/uploads/[^/]+"), "/v2/{name}/blobs/uploads/{uuid}"),
+    (re.compile(r"/v2/.+/blobs/[^/]+"), "/v2/{name}/blobs/{digest}"),
+    (re.compile(r"/v2/.+/manifests/[^/]+"), "/v2/{name}/manifests/{reference}"),
+    (re.compile(r"/v2/.+/tags/list"), "/v2/{name}/tags/list"),
+]
+
+
+def url_template(url: str):
+    """Path of `url` with repository names, references and upload ids
+    replaced by placeholders to group requests by endpoint
+
+    """
+    path = urlparse(url).path
+    for pattern, template in _URL_TEMPLATES:
+        if pattern.fullmatch(path):
+            return template
+    return path
+
+
+class LoggingObserver:
+    """Log every request to `logger` at `level`"""
+
+    def __init__(self, logger: logging.Logger = None, level: int = logging.DEBUG):
+        self.logger = logger or logging.getLogger("python_docker.registry")
+        self.level = level
+
+    def __call__(self, event: RequestEvent):
+        self.logger.log(
+            self.level,
+            "%s %s %s sent=%d received=%d seconds=%.3f retries=%d",
+            event.method,
+            event.url,
+            event.status if event.status is not None else repr(event.error),
+            event.bytes_sent,
+            event.bytes_received,
+            event.seconds,
+            event.retries,
+        )
+
+
+class RequestMetrics:
+    """Prometheus style counters of requests labeled by method, url
+    template and status
+
+    Counters are read with `get` or rendered in the prometheus text
+    exposition format with `render`.
+
+    """
+
+    COUNTERS = {
+        "requests_total": "Total number of registry requests",
+        "request_seconds_total": "Total seconds spent in registry requests",
+        "request_sent_bytes_total": "Total bytes sent in registry request bodies",
+        "request_received_bytes_total": "Total bytes received in registry response bodies",
+        "request_retries_total": "Total number of retried registry requests",
+    }
+
+    def __init__(self, prefix: str = "python_docker_registry"):
+        self.prefix = prefix
+        self._counters = {name: {} for name in self.COUNTERS}
+        self._lock = threading.Lock()
+
+    def __call__(self, event: RequestEvent):
+        labels = (
+            event.method,
+            event.url_template,
+            str(event.status) if event.status is not None else "error",
+        )
+        values = {
+            "requests_total": 1,
+            "request_seconds_total": event.seconds,
+            "request_sent_bytes_total": event.bytes_sent,
+            "request_received_bytes_total": event.bytes_received,
+            "request_retries_total": 1 if event.retries else 0,
+        }
+        with self._lock:
+            for name, value in values.items():
+                counter = self._counters[name]
+                counter[labels] = counter.get(labels, 0) + value
+
+    def get(
+        self,
+        name: str,
+        method: str = None,
+        url_template: str = None,
+        status: str = None,
+    ):
+        """Sum of counter `name` over the requests matching the labels"""
+        with self._lock:
+            return sum(
+                value
+                for (
+                    label_method,
+                    label_url_template,
+                    label_status,
+                ), value in self._counters[name].items()
+                if method in (None, label_method)
+                and url_template in (None, label_url_template)
+                and status in (None, label_status)
+            )
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name, description in self.COUNTERS.items():
+                metric = f"{self.prefix}_{name}"
+                lines.append(f"# HELP {metric} {description}")
+                lines.append(f"# TYPE {metric} counter")
+                for (method, template, status), value in sorted(
+                    self._counters[name].items()
+                ):
+                    lines.append(
+                        f'{metric}{{method="{method}",url="{template}",status="{status}"}} {value}'
+                    )
+        return "\n".join(lines) + "\n"
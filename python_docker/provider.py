@@ -9,11 +9,12 @@ class DockerRegistry(registry.Registry):
         hostname: str = "https://registry-1.docker.io",
         username: str = os.environ.get("DOCKER_USERNAME"),
         password: str = os.environ.get("DOCKER_PASSWORD"),
+        **kwargs,
     ):
-        super().__init__(hostname, username, password)
+        super().__init__(hostname, username, password, **kwargs)
 
-    def pull_image(self, image: str, tag: str = "latest", lazy: bool = False):
+    def pull_image(self, image: str, tag: str = "latest", lazy: bool = False, **kwargs):
         if "/" not in image:
             image = "library/" + image
 
-        return super().pull_image(image, tag, lazy)
+        return super().pull_image(image, tag, lazy, **kwargs)
@@ -1,14 +1,40 @@
+import concurrent.futures
+import contextlib
+import copy
 import json
-import gzip
 import functools
-import base64
-import re
+import hashlib
+import io
+import itertools
+import tempfile
+import time
+from typing import Tuple
 from urllib.parse import urlparse, parse_qs
 
 import requests
+import requests.adapters
 
 from python_docker.base import Image, Layer
-from python_docker import schema
+from python_docker import auth, schema, utils, compression
+from python_docker.observers import RequestEvent, url_template
+from python_docker.cache import DIGEST_PATTERN, BlobCache, ManifestCache, TocCache
+from python_docker.retry import IDEMPOTENT_METHODS, RetryPolicy
+
+
+# seconds to connect and to wait between bytes received
+DEFAULT_TIMEOUT = (30.0, 300.0)
+
+# OCI image manifests share the structure of v2 manifests and OCI
+# image indexes the structure of manifest lists. Tags of single
+# platform images return a v2 manifest when asking for a list.
+MANIFEST_VERSION_MEDIA_TYPES = {
+    "v1": "application/vnd.docker.distribution.manifest.v1+json",
+    "v2": f"{schema.DOCKER_MANIFEST_V2_MEDIA_TYPE}, {schema.OCI_MANIFEST_MEDIA_TYPE}",
+    "list": f"{schema.DOCKER_MANIFEST_LIST_MEDIA_TYPE}, {schema.OCI_INDEX_MEDIA_TYPE}, {schema.DOCKER_MANIFEST_V2_MEDIA_TYPE}, {schema.OCI_MANIFEST_MEDIA_TYPE}",
+}
+
+# platform pulled from manifest lists when none is given
+DEFAULT_PLATFORM = "linux/amd64"
 
 
 class Registry:
@@ -17,22 +43,48 @@ class Registry:
         hostname: str = "https://registry-1.docker.io",
         username: str = None,
         password: str = None,
+        cache: BlobCache = None,
+        observers=None,
+        retry: RetryPolicy = None,
+        timeout=DEFAULT_TIMEOUT,
+        pool_maxsize: int = 32,
     ):
+        """Client for the registry at `hostname`
+
+        Failed requests are retried according to `retry`. `timeout`
+        is either the seconds to connect and to wait for data from
+        the registry or a tuple of both. Up to `pool_maxsize`
+        connections to the registry are kept alive and reused which
+        should be at least the number of concurrent transfers.
+
+        """
         self.hostname = hostname
         self.username = username
         self.password = password
-        self.detect_authentication()
+        self.cache = cache
+        # callables notified with a RequestEvent for every request
+        self.observers = list(observers or [])
+        self.retry = retry or RetryPolicy()
+        self.timeout = timeout
+        self.token_cache = auth.TokenCache()
+        self.manifest_cache = ManifestCache(cache)
+        self.toc_cache = TocCache(cache)
+        self._basic_authenticated = False
         self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_maxsize)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.authentication_type = None
+        self.detect_authentication()
 
     def detect_authentication(self):
-        response = requests.get(f"{self.hostname}/v2/")
+        response = self.request("/v2/")
         if "www-authenticate" in response.headers:
-            auth_scheme, parameters = response.headers["www-authenticate"].split(" ", 1)
+            auth_scheme, parameters = auth.parse_www_authenticate(
+                response.headers["www-authenticate"]
+            )
             self.authentication_type = auth_scheme
-            self.authentication_parameters = {
-                key: value
-                for key, value in re.findall('([^,=]*)="([^"]*)"', parameters)
-            }
+            self.authentication_parameters = parameters
             if auth_scheme == "Basic":
                 if self.username is None or self.password is None:
                     raise ValueError(
@@ -45,105 +97,308 @@ class Registry:
         else:
             self.authentication_type = None
 
-    def basic_authenticate(self, image: str = None, action: str = None):
-        credentials = base64.b64encode(
-            f"{self.username}:{self.password}".encode("utf-8")
-        ).decode("utf-8")
-        self.session.headers.update({"Authorization": f"Basic {credentials}"})
+    def basic_authenticate(
+        self, image: str = None, action: str = None, mount_from=None
+    ):
+        self.session.headers.update(
+            {"Authorization": auth.basic_credentials(self.username, self.password)}
+        )
 
-    def token_authenticate(self, image: str = None, action: str = None):
-        query = {
-            "service": self.authentication_parameters["service"],
-        }
-        headers = {}
+    def token_authenticate(
+        self,
+        image: str = None,
+        action: str = None,
+        mount_from=None,
+        refresh: bool = False,
+    ):
+        """Get bearer token for the requested scope
+
+        Tokens are cached until they expire and reused for any scope
+        they cover. If `refresh` is set a new token is always
+        requested. Returns the token.
+
+        """
+        access = auth.scope_access(image, action, mount_from)
 
-        if image is not None and action is not None:
-            query["scope"] = f"repository:{image}:{action}"
+        with self.token_cache.lock:
+            token = None if refresh else self.token_cache.get(access)
+            if token is None:
+                token = self._request_token(access)
+                self.token_cache.put(access, token)
 
-        if self.username is not None:
-            query["account"] = self.username
+        self.session.headers.update({"Authorization": token.header})
+        return token
 
+    def _request_token(self, access):
+        headers = {}
         if self.username is not None and self.password is not None:
-            credentials = base64.b64encode(
-                f"{self.username}:{self.password}".encode("utf-8")
-            ).decode("utf-8")
-            headers["Authorization"] = f"Basic {credentials}"
+            headers["Authorization"] = auth.basic_credentials(
+                self.username, self.password
+            )
 
-        base_url = self.authentication_parameters["realm"]
-        if query:
-            base_url += "?" + "&".join(f"{key}={value}" for key, value in query.items())
+        base_url = auth.token_url(
+            self.authentication_parameters, access, username=self.username
+        )
 
-        response = requests.get(base_url, headers=headers)
+        # the session headers may hold a token for the registry
+        response = self._send("GET", base_url, session=requests, headers=headers)
         if response.status_code != 200:
             raise ValueError(f"token authentication failed for {base_url}")
 
-        token = response.json()["token"]
-        self.session.headers.update({"Authorization": f"Bearer {token}"})
+        return auth.Token.from_response(response.json())
 
-    def authenticate(self, image: str = None, action: str = None):
+    def authenticate(self, image: str = None, action: str = None, mount_from=None):
         if self.authentication_type == "Basic":
-            self.basic_authenticate(image, action)
+            self.basic_authenticate(image, action, mount_from)
+            # credentials are only verified once
+            if not self._basic_authenticated:
+                if not self.authenticated():
+                    raise ValueError("failed to authenticate")
+                self._basic_authenticated = True
         elif self.authentication_type == "Bearer":
-            self.token_authenticate(image, action)
-
-        if not self.authenticated():
-            raise ValueError("failed to authenticate")
+            # a token is only issued for valid credentials
+            self.token_authenticate(image, action, mount_from)
 
     def authenticated(self):
-        response = self.session.get(f"{self.hostname}/v2/")
+        response = self.request("/v2/")
         return response.status_code != 401
 
     def request(
-        self, url: str, method="GET", headers=None, params=None, data=None, **kwargs
+        self,
+        url: str,
+        method="GET",
+        headers=None,
+        params=None,
+        data=None,
+        stream=False,
+        image: str = None,
+        action: str = None,
+        idempotent: bool = None,
+        **kwargs,
     ):
-        method_map = {
-            "HEAD": self.session.head,
-            "GET": self.session.get,
-            "POST": self.session.post,
-            "PUT": self.session.put,
-            "PATCH": self.session.patch,
-            "DELETE": self.session.delete,
-        }
-
-        return method_map[method](
-            f"{self.hostname}{url}", headers=headers, params=params, data=data
-        )
+        """Send request to the registry
 
-    def get_manifest(self, image: str, tag: str, version="v1"):
-        version_map = {
-            "v1": "application/vnd.docker.distribution.manifest.v1+json",
-            "v2": "application/vnd.docker.distribution.manifest.v2+json",
-        }
+        Requests for an `image` and `action` with bearer authentication
+        use a token for that scope. If the registry responds with 401
+        the token is refreshed and the request retried once.
 
-        if version not in version_map:
-            raise ValueError(f"manifest version={version} not supported")
+        Connection errors and transient error responses are retried
+        with backoff according to `retry` if the request is
+        `idempotent`, by default if its method is. Request bodies which
+        cannot be rewound are never retried.
 
-        response = self.request(
-            f"/v2/{image}/manifests/{tag}",
-            image=image,
-            action="pull",
-            headers={"Accept": version_map[version]},
+        """
+        scoped = (
+            self.authentication_type == "Bearer"
+            and image is not None
+            and action is not None
+        )
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT_METHODS
+        data_position = _body_position(data)
+        rewindable = (
+            data is None or isinstance(data, bytes) or data_position is not None
         )
 
-        response.raise_for_status()
-        data = response.json()
+        token, refresh, refreshed, retries = None, False, False, 0
+        for attempt in itertools.count():
+            if attempt > 0 and data_position is not None:
+                data.seek(data_position)
+
+            request_headers = dict(headers or {})
+            if scoped:
+                token = self.token_authenticate(image, action, refresh=refresh)
+                request_headers["Authorization"] = token.header
+            refresh = False
+
+            try:
+                response = self._send(
+                    method,
+                    f"{self.hostname}{url}",
+                    retries=attempt,
+                    headers=request_headers,
+                    params=params,
+                    data=data,
+                    stream=stream,
+                )
+            except (
+                requests.ConnectionError,
+                requests.Timeout,
+                requests.exceptions.ChunkedEncodingError,
+            ):
+                delay = None
+                if idempotent and rewindable:
+                    delay = self.retry.delay(retries)
+                if delay is None:
+                    raise
+            else:
+                if (
+                    scoped
+                    and response.status_code == 401
+                    and rewindable
+                    and not refreshed
+                ):
+                    response.close()
+                    self.token_cache.invalidate(token)
+                    refresh = refreshed = True
+                    continue
+
+                delay = None
+                if (
+                    idempotent
+                    and rewindable
+                    and self.retry.should_retry_status(response.status_code)
+                ):
+                    delay = self.retry.delay(
+                        retries, response.headers.get("Retry-After")
+                    )
+                if delay is None:
+                    return response
+                response.close()
+
+            retries += 1
+            time.sleep(delay)
+
+    def _send(self, method: str, url: str, retries: int = 0, session=None, **kwargs):
+        """Send a single http request notifying the observers
+
+        Streamed responses are reported once they are closed.
+
+        """
+        session = session or self.session
+        kwargs.setdefault("timeout", self.timeout)
+        if not self.observers:
+            return session.request(method, url, **kwargs)
+
+        start = time.perf_counter()
+        try:
+            response = session.request(method, url, **kwargs)
+        except requests.RequestException as e:
+            self._notify(
+                RequestEvent(
+                    method=method,
+                    url=url,
+                    url_template=url_template(url),
+                    status=None,
+                    bytes_sent=0,
+                    bytes_received=0,
+                    seconds=time.perf_counter() - start,
+                    retries=retries,
+                    error=e,
+                )
+            )
+            raise
+
+        def _finish():
+            self._notify(
+                RequestEvent(
+                    method=method,
+                    url=url,
+                    url_template=url_template(url),
+                    status=response.status_code,
+                    bytes_sent=int(response.request.headers.get("Content-Length", 0)),
+                    bytes_received=_bytes_received(response),
+                    seconds=time.perf_counter() - start,
+                    retries=retries,
+                )
+            )
+
+        if kwargs.get("stream"):
+            _on_close(response, _finish)
+        else:
+            _finish()
+        return response
+
+    def _notify(self, event: RequestEvent):
+        for observer in self.observers:
+            observer(event)
+
+    def get_manifest(self, image: str, tag: str, version="v1"):
+        if version not in MANIFEST_VERSION_MEDIA_TYPES:
+            raise ValueError(f"manifest version={version} not supported")
+
+        data = json.loads(self.get_manifest_content(image, tag, version=version))
         if version == "v1":
             return schema.DockerManifestV1.parse_obj(data)
-        elif version == "v2":
+        elif version == "v2" or not _is_manifest_list(data):
             return schema.DockerManifestV2.parse_obj(data)
+        else:
+            return schema.DockerManifestList.parse_obj(data)
+
+    def get_platform_manifest(self, image: str, tag: str, platform: str = None):
+        """Get v2 manifest of `tag` for `platform` such as "linux/arm64"
+
+        If `tag` is a manifest list or OCI image index the manifest of
+        `platform` is fetched, by default `DEFAULT_PLATFORM`. Returns
+        the manifest and its platform from the list or None if `tag`
+        is a single manifest.
+
+        """
+        manifest = self.get_manifest(image, tag, version="list")
+        if isinstance(manifest, schema.DockerManifestV2):
+            return manifest, None
+
+        descriptor = _select_manifest(image, tag, manifest, platform)
+        return (
+            self.get_manifest(image, descriptor.digest, version="v2"),
+            descriptor.platform,
+        )
+
+    def get_manifest_content(self, image: str, tag: str, version="v2"):
+        """Get raw manifest of `tag` which may also be a digest
+
+        Manifests are cached by digest. A tag which was fetched before
+        is revalidated with a HEAD request and only downloaded again if
+        its digest changed.
+
+        """
+        media_type = MANIFEST_VERSION_MEDIA_TYPES[version]
+        digest = self.manifest_cache.digest(image, tag, media_type)
+        if digest is not None and digest != tag:
+            digest = self.get_manifest_digest(image, tag, version=version)
 
-    def get_manifest_configuration(self, image: str, tag: str):
-        manifestV2 = self.get_manifest(image, tag, version="v2")
-        config_data = json.loads(self.get_blob(image, manifestV2.config.digest))
-        return schema.DockerConfig.parse_obj(config_data)
+        content = None if digest is None else self.manifest_cache.get(digest)
+        if content is None:
+            response = self.request(
+                f"/v2/{image}/manifests/{tag}",
+                image=image,
+                action="pull",
+                headers={"Accept": media_type},
+            )
+            response.raise_for_status()
+            content = response.content
+            digest = _manifest_digest(response.headers, content, tag)
+            self.manifest_cache.put(digest, content)
+
+        self.manifest_cache.tag(image, tag, media_type, digest)
+        return content
+
+    def get_manifest_configuration(
+        self, image: str, tag: str, manifest: schema.DockerManifestV2 = None
+    ):
+        """Get image configuration referenced by the v2 manifest of `tag`
 
-    def get_manifest_digest(self, image: str, tag: str):
+        Pass `manifest` if it was already fetched to avoid requesting it
+        again. Configurations are cached by digest.
+
+        """
+        if manifest is None:
+            manifest = self.get_manifest(image, tag, version="v2")
+
+        digest = manifest.config.digest
+        content = self.manifest_cache.get(digest)
+        if content is None:
+            content = self.get_blob(image, digest)
+            self.manifest_cache.put(digest, content)
+        return schema.DockerConfig.parse_obj(json.loads(content))
+
+    def get_manifest_digest(self, image: str, tag: str, version="v2"):
         response = self.request(
             f"/v2/{image}/manifests/{tag}",
             method="HEAD",
             image=image,
             action="pull",
-            headers={"Accept": "application/vnd.docker.distribution.manifest.v2+json"},
+            headers={"Accept": MANIFEST_VERSION_MEDIA_TYPES[version]},
         )
         response.raise_for_status()
         return response.headers["Docker-Content-Digest"]
@@ -154,35 +409,407 @@ class Registry:
         )
         return response.status_code == 200
 
-    def get_blob(self, image: str, blobsum: str):
+    def check_blobs(self, image: str, blobsums, max_workers: int = 4):
+        """Check for the existence of several blobs concurrently
+
+        Returns a dictionary mapping each blobsum to whether it
+        exists on the registry.
+
+        """
+        blobsums = list(blobsums)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            exists = executor.map(functools.partial(self.check_blob, image), blobsums)
+            return dict(zip(blobsums, exists))
+
+    def get_blob(self, image: str, blobsum: str, byte_range: Tuple[int, int] = None):
+        """Content of blob `blobsum`
+
+        With `byte_range` a tuple of the start and end offsets only
+        that part of the blob is requested with a range request. The
+        end may be None to read up to the end of the blob and a
+        negative start counts from the end. Partial content can not
+        be verified against the digest.
+
+        """
+        if byte_range is not None:
+            return self._get_blob_range(image, blobsum, *byte_range)
+
+        if self.cache is not None:
+            with self.download_blob(image, blobsum) as fileobj:
+                return fileobj.read()
+
         response = self.request(
             f"/v2/{image}/blobs/{blobsum}", image=image, action="pull"
         )
         response.raise_for_status()
         return response.content
 
-    def begin_upload(self, image: str):
+    def _get_blob_range(self, image: str, blobsum: str, start: int, end: int = None):
+        if self.cache is not None:
+            content = _read_cached_range(self.cache, blobsum, start, end)
+            if content is not None:
+                return content
+
+        if end is not None and 0 <= end <= start:
+            return b""
+        response = self.request(
+            f"/v2/{image}/blobs/{blobsum}",
+            image=image,
+            action="pull",
+            headers={"Range": _range_header(start, end)},
+        )
+        response.raise_for_status()
+        if response.status_code != 206:
+            # registry ignored the range and sent the whole blob
+            return response.content[start:end]
+        return response.content
+
+    def download_blob(
+        self,
+        image: str,
+        blobsum: str,
+        fileobj=None,
+        chunk_size: int = utils.DEFAULT_CHUNK_SIZE,
+    ):
+        """Stream blob into `fileobj` verifying the digest as it is written
+
+        When `fileobj` is not specified a spooled temporary file is
+        used so that at most `chunk_size` bytes are held in
+        memory. Returns `fileobj` positioned at the start of the blob.
+
+        If the registry has a blob cache and `fileobj` is not
+        specified the blob is read from the cache when available and
+        otherwise downloaded into the cache.
+
+        """
+        if self.cache is not None and fileobj is None:
+            cached_fileobj = self.cache.open(blobsum)
+            if cached_fileobj is not None:
+                return cached_fileobj
+
+            download = self.cache.download(blobsum)
+            with download as cache_fileobj:
+                self._download_blob(image, blobsum, cache_fileobj, chunk_size)
+            return download.fileobj
+
+        if fileobj is None:
+            fileobj = tempfile.SpooledTemporaryFile(max_size=chunk_size)
+        self._download_blob(image, blobsum, fileobj, chunk_size)
+        fileobj.seek(0)
+        return fileobj
+
+    def open_blob(self, image: str, blobsum: str):
+        """Readable file object streaming blob from the cache or registry
+
+        The digest is verified once the end of the blob is read.
+
+        """
+        if self.cache is not None:
+            cached_fileobj = self.cache.open(blobsum)
+            if cached_fileobj is not None:
+                return cached_fileobj
+
+        response = self.request(
+            f"/v2/{image}/blobs/{blobsum}", image=image, action="pull", stream=True
+        )
+        response.raise_for_status()
+        response.raw.decode_content = True
+        return io.BufferedReader(
+            utils.VerifyingReader(response.raw, blobsum), utils.DEFAULT_CHUNK_SIZE
+        )
+
+    def _download_blob(self, image: str, blobsum: str, fileobj, chunk_size: int):
+        """Stream blob into `fileobj` verifying the digest
+
+        If the connection fails while the blob is being read the
+        download is resumed with a range request for the remaining
+        bytes according to `retry`.
+
+        """
+        algorithm, expected_checksum = blobsum.split(":", 1)
+        hasher = hashlib.new(algorithm)
+        start = fileobj.tell()
+
+        offset, resumes = 0, 0
+        while True:
+            headers = {"Range": f"bytes={offset}-"} if offset else None
+            with self.request(
+                f"/v2/{image}/blobs/{blobsum}",
+                image=image,
+                action="pull",
+                headers=headers,
+                stream=True,
+            ) as response:
+                response.raise_for_status()
+                if offset and response.status_code != 206:
+                    # registry ignored the range and sent the whole blob
+                    hasher, offset = hashlib.new(algorithm), 0
+                    fileobj.seek(start)
+                    fileobj.truncate()
+
+                try:
+                    for chunk in response.iter_content(chunk_size=chunk_size):
+                        hasher.update(chunk)
+                        fileobj.write(chunk)
+                        offset += len(chunk)
+                except (
+                    requests.ConnectionError,
+                    requests.exceptions.ChunkedEncodingError,
+                ):
+                    delay = self.retry.delay(resumes)
+                    if delay is None:
+                        raise
+                    resumes += 1
+                    time.sleep(delay)
+                    continue
+            break
+
+        if hasher.hexdigest() != expected_checksum:
+            raise ValueError(
+                f"blob {blobsum} digest mismatch got {algorithm}:{hasher.hexdigest()}"
+            )
+
+    def begin_upload(self, image: str, mount: str = None, mount_from: str = None):
+        """Begin a blob upload returning the upload location and query
+
+        If `mount` and `mount_from` are specified the registry is
+        first asked to mount the blob `mount` from the repository
+        `mount_from`. When the blob is mounted there is nothing to
+        upload and None is returned.
+
+        """
+        params = {}
+        if mount is not None and mount_from is not None:
+            params = {"mount": mount, "from": mount_from}
+
+        # a failed upload session is abandoned and expires on the registry
         response = self.request(
-            f"/v2/{image}/blobs/uploads/", method="POST", image=image, action="push"
+            f"/v2/{image}/blobs/uploads/",
+            method="POST",
+            image=image,
+            action="push",
+            params=params,
+            idempotent=True,
         )
         response.raise_for_status()
-        location = urlparse(response.headers["Location"])
-        return location.path, parse_qs(location.query)
+        if params and response.status_code == 201:
+            return None
+        return _parse_location(response.headers["Location"])
+
+    def get_upload_status(
+        self, image: str, upload_location: str, upload_query: dict, uploaded: int = 0
+    ):
+        """Query the progress of an upload
 
-    def upload_blob(self, image: str, digest, checksum):
-        upload_location, upload_query = self.begin_upload(image)
-        upload_query["digest"] = f"sha256:{checksum}"
+        Returns the upload location and query to continue the upload
+        along with the offset of the next byte the registry expects or
+        None if it is not reported. `uploaded` is the number of bytes
+        known to have been received by the registry.
 
+        """
         response = self.request(
             upload_location,
-            method="PUT",
-            data=digest,
             image=image,
             action="push",
             params=upload_query,
-            headers={"Content-Type": "application/octet-stream"},
         )
         response.raise_for_status()
+        upload_location, upload_query = _parse_location(response.headers["Location"])
+        return (
+            upload_location,
+            upload_query,
+            _parse_range_offset(response.headers, uploaded),
+        )
+
+    def upload_blob_chunks(
+        self,
+        image: str,
+        upload_location: str,
+        upload_query: dict,
+        digest,
+        chunk_size: int = utils.DEFAULT_CHUNK_SIZE,
+        max_resumes: int = None,
+    ):
+        """Upload blob content in chunks using PATCH requests
+
+        `digest` is either bytes or a seekable file object. When a
+        chunk fails to upload the upload is resumed with backoff from
+        the offset reported by the registry up to `max_resumes`
+        consecutive times, by default `retry.total`. Returns the
+        upload location and query to complete the upload.
+
+        """
+        if max_resumes is None:
+            max_resumes = self.retry.total
+
+        fileobj = io.BytesIO(digest) if isinstance(digest, bytes) else digest
+        fileobj.seek(0, io.SEEK_END)
+        size = fileobj.tell()
+
+        offset, resumes = 0, 0
+        while offset < size:
+            fileobj.seek(offset)
+            chunk = fileobj.read(chunk_size)
+
+            try:
+                response = self.request(
+                    upload_location,
+                    method="PATCH",
+                    data=chunk,
+                    image=image,
+                    action="push",
+                    params=upload_query,
+                    headers={
+                        "Content-Type": "application/octet-stream",
+                        "Content-Range": f"{offset}-{offset + len(chunk) - 1}",
+                        "Content-Length": str(len(chunk)),
+                    },
+                )
+                response.raise_for_status()
+            except requests.RequestException as e:
+                resumes += 1
+                if resumes > max_resumes:
+                    raise
+                delay = self.retry.backoff(resumes - 1, _retry_after(e.response))
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                upload_location, upload_query, status_offset = self.get_upload_status(
+                    image, upload_location, upload_query, uploaded=offset
+                )
+                offset = 0 if status_offset is None else status_offset
+                continue
+
+            resumes = 0
+            upload_location, upload_query = _parse_location(
+                response.headers["Location"]
+            )
+            status_offset = _parse_range_offset(response.headers, offset + len(chunk))
+            offset = offset + len(chunk) if status_offset is None else status_offset
+
+        return upload_location, upload_query
+
+    def upload_blob(
+        self,
+        image: str,
+        digest,
+        checksum,
+        chunk_size: int = None,
+        mount_from: str = None,
+    ):
+        """Upload blob to registry
+
+        `digest` is either bytes, a file object or a callable
+        returning either of them which is only called if the blob is
+        uploaded. A file object returned by the callable is closed
+        once uploaded. By default the blob is uploaded in a single
+        monolithic PUT request. If `chunk_size` is set the blob is
+        instead uploaded in chunks of `chunk_size` bytes which are
+        resumed on failure.
+
+        If `mount_from` is set the blob is mounted from that
+        repository and only uploaded if the registry refuses the
+        mount.
+
+        """
+        upload = self.begin_upload(
+            image, mount=f"sha256:{checksum}", mount_from=mount_from
+        )
+        if upload is None:
+            return
+        upload_location, upload_query = upload
+
+        with contextlib.ExitStack() as stack:
+            if callable(digest):
+                digest = digest()
+                if not isinstance(digest, bytes):
+                    stack.enter_context(digest)
+
+            if chunk_size is not None:
+                upload_location, upload_query = self.upload_blob_chunks(
+                    image, upload_location, upload_query, digest, chunk_size=chunk_size
+                )
+                digest = None
+
+            upload_query["digest"] = f"sha256:{checksum}"
+
+            self._complete_upload(
+                image,
+                upload_location,
+                upload_query,
+                digest,
+                checksum,
+                headers={"Content-Type": "application/octet-stream"},
+            )
+
+    def _complete_upload(
+        self,
+        image: str,
+        upload_location: str,
+        upload_query: dict,
+        data,
+        checksum,
+        headers,
+    ):
+        """Complete blob upload with the final PUT request
+
+        The registry may have committed the blob even if the response
+        was lost and repeating the request then fails with an unknown
+        upload. The existence of the blob is checked instead before
+        the request is retried according to `retry` and if it fails.
+
+        """
+        blobsum = f"sha256:{checksum}"
+        data_position = _body_position(data)
+        rewindable = (
+            data is None or isinstance(data, bytes) or data_position is not None
+        )
+
+        retries = 0
+        while True:
+            if retries > 0 and data_position is not None:
+                data.seek(data_position)
+            try:
+                response = self.request(
+                    upload_location,
+                    method="PUT",
+                    data=data,
+                    image=image,
+                    action="push",
+                    params=upload_query,
+                    headers=headers,
+                    idempotent=False,
+                )
+            except (
+                requests.ConnectionError,
+                requests.Timeout,
+                requests.exceptions.ChunkedEncodingError,
+            ):
+                if self.check_blob(image, blobsum):
+                    return
+                delay = self.retry.delay(retries) if rewindable else None
+                if delay is None:
+                    raise
+            else:
+                if response.ok:
+                    return
+                if response.status_code != 404 and not self.retry.should_retry_status(
+                    response.status_code
+                ):
+                    response.raise_for_status()
+                if self.check_blob(image, blobsum):
+                    return
+                delay = None
+                if rewindable and response.status_code != 404:
+                    delay = self.retry.delay(
+                        retries, response.headers.get("Retry-After")
+                    )
+                if delay is None:
+                    response.raise_for_status()
+                response.close()
+
+            retries += 1
+            time.sleep(delay)
 
     def upload_manifest(self, image: str, tag: str, manifest: dict):
         manifest_config, manifest_config_checksum = manifest["config"]
@@ -191,15 +818,22 @@ class Registry:
         if not self.check_blob(image, f"sha256:{manifest_config_checksum}"):
             self.upload_blob(image, manifest_config, manifest_config_checksum)
 
+        self.put_manifest(image, tag, manifest)
+
+    def put_manifest(
+        self,
+        image: str,
+        tag: str,
+        manifest: bytes,
+        media_type: str = schema.DOCKER_MANIFEST_V2_MEDIA_TYPE,
+    ):
         response = self.request(
             f"/v2/{image}/manifests/{tag}",
             method="PUT",
             data=manifest,
-            iamge=image,
+            image=image,
             action="push",
-            headers={
-                "Content-Type": "application/vnd.docker.distribution.manifest.v2+json"
-            },
+            headers={"Content-Type": media_type},
         )
         response.raise_for_status()
 
@@ -221,7 +855,16 @@ class Registry:
 
         return self.request(f"/v2/{image}/tags/list", params=query).json()["tags"]
 
-    def pull_image(self, image: str, tag: str = "latest", lazy: bool = False):
+    def pull_image(
+        self,
+        image: str,
+        tag: str = "latest",
+        lazy: bool = False,
+        max_workers: int = 4,
+        prefetch: bool = False,
+        storage: str = "file",
+        platform: str = None,
+    ):
         """Pull specific image from docker registry
 
         Crates an Image object with a list of ordered Layers
@@ -230,65 +873,513 @@ class Registry:
         are making small modifications to docker images adding a few
         layers.
 
+        Lazy layers which are only read once such as when writing the
+        image with `Image.write_filename` are streamed directly from
+        the registry without being stored.
+
+        Layers are downloaded and decompressed concurrently using
+        `max_workers` threads. If `prefetch` is set to True along with
+        `lazy` the layers are downloaded in the background and
+        referencing the layer content waits for the download to
+        finish.
+
+        With `storage` set to "file", the default, layers are
+        decompressed into temporary files instead of being held in
+        memory. `Image` defaults to "memory" since layers added locally
+        are usually small while pulled layers may be as large as any
+        image on the registry. The pulled image keeps `storage` for the
+        layers added to it.
+
+        Multi-arch images are resolved to the manifest of `platform`
+        before any blob is fetched see `get_platform_manifest`. A
+        ValueError is raised if `platform` is given and the image is
+        not available for it.
+
         """
         self.authenticate(image=image, action="pull")
 
-        def _get_layer_blob(image, blobsum):
-            return gzip.decompress(self.get_blob(image, blobsum))
+        def _get_layer_blob(image, blobsum, layer_compression):
+            with self.download_blob(image, blobsum) as fileobj:
+                decompress = functools.partial(
+                    compression.decompress_fileobj,
+                    fileobj,
+                    compression=layer_compression,
+                )
+                if storage == "file":
+                    return utils.FileSlice.temporary(decompress)
+                content = io.BytesIO()
+                decompress(content)
+                return content.getvalue()
 
-        manifest = self.get_manifest(image, tag, version="v2")
-        manifest_config = self.get_manifest_configuration(image, tag)
+        def _open_layer_blob(image, blobsum, layer_compression):
+            return compression.open_decompressed(
+                self.open_blob(image, blobsum), layer_compression
+            )
 
-        layers = []
-        parent = None
-        # traverse in reverse order so that parent id can be correct
-        for diffid_checksum, layer in zip(
-            manifest_config.rootfs.diff_ids[::-1], manifest.layers[::-1]
-        ):
-            checksum = diffid_checksum.split(":")[1]
-            compressed_size = layer.size
-            compressed_checksum = layer.digest.split(":")[1]
+        manifest, manifest_platform = self.get_platform_manifest(image, tag, platform)
+        manifest_config = self.get_manifest_configuration(image, tag, manifest=manifest)
+        image_platform = _image_platform(manifest_config, manifest_platform, platform)
 
-            if lazy:
-                digest = functools.partial(_get_layer_blob, image, layer.digest)
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+
+        def _layer_content(layer, layer_compression):
+            if lazy and not prefetch:
+                content = functools.partial(
+                    _get_layer_blob, image, layer.digest, layer_compression
+                )
             else:
-                digest = _get_layer_blob(image, layer.digest)
-
-            layers.insert(
-                0,
-                Layer(
-                    id=checksum,
-                    parent=parent,
-                    architecture=manifest_config.architecture,
-                    os=manifest_config.os,
-                    created=manifest_config.created,
-                    author=None,
-                    config=manifest_config.config.dict(),
-                    content=digest,
-                    checksum=checksum,
-                    compressed_size=compressed_size,
-                    compressed_checksum=compressed_checksum,
+                content = executor.submit(
+                    _get_layer_blob, image, layer.digest, layer_compression
+                ).result
+            return {
+                "content": content,
+                "content_stream": functools.partial(
+                    _open_layer_blob, image, layer.digest, layer_compression
                 ),
+                "compressed_content_range": functools.partial(
+                    _blob_range, self.get_blob, image, layer.digest
+                ),
+                "compressed_content_stream": functools.partial(
+                    self.open_blob, image, layer.digest
+                ),
+            }
+
+        try:
+            layers = _manifest_layers(
+                self.hostname,
+                image,
+                manifest,
+                manifest_config,
+                _layer_content,
+                toc_cache=self.toc_cache,
             )
+            if not lazy:
+                for layer in layers:
+                    layer._resolve_content()
+        finally:
+            # lazy prefetched layers continue downloading in the background
+            executor.shutdown(wait=not lazy)
 
-            parent = checksum
-        return Image(image, tag, layers)
+        return Image(image, tag, layers, storage=storage, platform=image_platform)
 
-    def push_image(self, image: Image):
-        self.authenticate(image=image.name, action="push,pull")
+    def push_image(
+        self,
+        image: Image,
+        max_workers: int = 4,
+        chunk_size: int = None,
+        compression: str = None,
+    ):
+        """Push image to docker registry
 
-        for layer in image.layers:
-            # make sure to check if the layer already exists on the
-            # registry this way if the layer is lazy (has not actually
-            # been downloaded) it does not have to be downloaded
-            if not self.check_blob(image.name, f"sha256:{layer.compressed_checksum}"):
-                self.upload_blob(
-                    image.name, layer.compressed_content, layer.compressed_checksum
-                )
+        Layers are compressed and the existence of each blob is
+        checked concurrently. Missing blobs are then uploaded using a
+        pool of `max_workers` threads and the manifest is only
+        uploaded once every blob is on the registry. See `upload_blob`
+        for `chunk_size`.
+
+        Layers pulled from a different repository on this registry
+        are mounted from that repository instead of being uploaded.
+
+        If `compression` is specified every layer is compressed with
+        it either "gzip" or "zstd" instead of the layer compression.
+
+        """
+        (image,) = _with_compression([image], compression)
+        (manifest,) = self._push_blobs(image.name, [image], max_workers, chunk_size)
+        self.put_manifest(
+            image.name,
+            image.tag,
+            manifest["manifest"][0],
+            media_type=image.manifest_media_type,
+        )
+
+    def push_index(
+        self,
+        image: str,
+        tag: str,
+        images,
+        max_workers: int = 4,
+        chunk_size: int = None,
+        compression: str = None,
+    ):
+        """Push multi-arch image made of `images` of different platforms
+
+        The blobs of all `images` are uploaded to repository `image`
+        in a single pass as in `push_image`. The manifest of each
+        image is then uploaded by digest and a manifest list
+        referencing them with the `Image.platform` of each image is
+        tagged `tag`. An OCI image index is used instead if any of the
+        manifests is an OCI manifest.
+
+        """
+        platforms = [image.platform for image in images]
+        if None in platforms:
+            raise ValueError("every image of a manifest list requires a platform")
+        if len(set(platforms)) != len(platforms):
+            raise ValueError(f"images have duplicate platforms {platforms}")
+
+        images = _with_compression(images, compression)
+        manifests = self._push_blobs(image, images, max_workers, chunk_size)
+        for child, manifest in zip(images, manifests):
+            content, checksum = manifest["manifest"]
+            self.put_manifest(
+                image,
+                f"sha256:{checksum}",
+                content,
+                media_type=child.manifest_media_type,
+            )
+
+        content, media_type = _manifest_list(images, manifests)
+        self.put_manifest(image, tag, content, media_type=media_type)
+
+    def _push_blobs(self, name, images, max_workers, chunk_size):
+        """Upload the missing blobs of `images` to repository `name`
+        and return their `Image.manifest_v2`
 
-        self.upload_manifest(image.name, image.tag, image.manifest_v2)
+        """
+        all_layers = [layer for image in images for layer in image.layers]
+        mount_from = _mount_sources(self.hostname, name, all_layers)
+        self.authenticate(
+            image=name,
+            action="push,pull",
+            mount_from=sorted(set(mount_from.values())),
+        )
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # compute all compressed layers concurrently before
+            # building the manifests which require their checksums
+            list(executor.map(lambda layer: layer.compressed_checksum, all_layers))
+            manifests = [image.manifest_v2 for image in images]
+            configs = {
+                f"sha256:{manifest['config'][1]}": manifest["config"]
+                for manifest in manifests
+            }
+
+            layers = {
+                f"sha256:{layer.compressed_checksum}": layer for layer in all_layers
+            }
+
+            def _upload_blob(blobsum):
+                if blobsum in layers:
+                    # compressed content is only referenced when the
+                    # layer is neither on the registry nor mounted
+                    layer = layers[blobsum]
+                    self.upload_blob(
+                        name,
+                        layer.open_compressed,
+                        layer.compressed_checksum,
+                        chunk_size=chunk_size,
+                        mount_from=mount_from.get(layer),
+                    )
+                else:
+                    self.upload_blob(name, *configs[blobsum])
+
+            blob_exists = self.check_blobs(
+                name, list(layers) + list(configs), max_workers=max_workers
+            )
+            futures = [
+                executor.submit(_upload_blob, blobsum)
+                for blobsum, exists in blob_exists.items()
+                if not exists
+            ]
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+
+        return manifests
 
     def delete_image(self, image, tag):
         digest = self.get_manifest_digest(image, tag)
         response = self.request(f"/v2/{image}/manifests/{digest}", method="DELETE")
         response.raise_for_status()
+
+
+def _manifest_layers(
+    hostname, image, manifest, manifest_config, layer_content, toc_cache=None
+):
+    """Build the ordered layers of an image from its manifest
+
+    `layer_content` is called with each manifest layer and its
+    compression and returns keyword arguments of `Layer` with the
+    content and ways to read it.
+
+    """
+    layers = []
+    parent = None
+    # traverse in reverse order so that parent id can be correct
+    for diffid_checksum, layer in zip(
+        manifest_config.rootfs.diff_ids[::-1], manifest.layers[::-1]
+    ):
+        checksum = diffid_checksum.split(":")[1]
+        layer_compression = compression.media_type_compression(layer.mediaType)
+        content_kwargs = layer_content(layer, layer_compression)
+
+        layers.insert(
+            0,
+            Layer(
+                id=checksum,
+                parent=parent,
+                architecture=manifest_config.architecture,
+                os=manifest_config.os,
+                created=manifest_config.created,
+                author=None,
+                config=manifest_config.config.dict(),
+                **content_kwargs,
+                checksum=checksum,
+                compressed_size=layer.size,
+                compressed_checksum=layer.digest.split(":")[1],
+                source=(hostname, image),
+                compression=layer_compression,
+                toc_cache=toc_cache,
+            ),
+        )
+
+        parent = checksum
+    return layers
+
+
+def _with_compression(images, compression: str = None):
+    """Copies of `images` with their layers compressed with
+    `compression` leaving the layers of `images` unchanged
+
+    Layers already compressed with `compression` are not copied so
+    that their compressed content is reused.
+
+    """
+    if compression is None:
+        return images
+
+    def _layer(layer):
+        if layer.compression == compression:
+            return layer
+        layer = copy.copy(layer)
+        layer.compression = compression
+        return layer
+
+    copies = []
+    for image in images:
+        image = copy.copy(image)
+        image.layers = [_layer(layer) for layer in image.layers]
+        copies.append(image)
+    return copies
+
+
+def _mount_sources(hostname, name, layers):
+    """Layers pulled from a repository other than `name` on registry
+    `hostname` mapped to that repository
+
+    """
+    mount_from = {}
+    for layer in layers:
+        if layer.source is not None:
+            source_hostname, source_image = layer.source
+            if source_hostname == hostname and source_image != name:
+                mount_from[layer] = source_image
+    return mount_from
+
+
+def _is_manifest_list(data: dict):
+    # the media type is optional in OCI image indexes
+    return data.get("mediaType") in {
+        schema.DOCKER_MANIFEST_LIST_MEDIA_TYPE,
+        schema.OCI_INDEX_MEDIA_TYPE,
+    } or ("manifests" in data and "layers" not in data)
+
+
+def _select_manifest(image, tag, manifest_list, platform: str = None):
+    """Descriptor of the first manifest of `platform` in a manifest
+    list where any variant matches if `platform` has none
+
+    """
+    wanted = schema.DockerManifestListPlatform.from_string(platform or DEFAULT_PLATFORM)
+    for descriptor in manifest_list.manifests:
+        if (
+            descriptor.platform is not None
+            and descriptor.platform.os == wanted.os
+            and descriptor.platform.architecture == wanted.architecture
+            and wanted.variant in {None, descriptor.platform.variant}
+        ):
+            return descriptor
+
+    available = [
+        _platform_string(descriptor.platform)
+        for descriptor in manifest_list.manifests
+        if descriptor.platform is not None
+    ]
+    raise ValueError(
+        f"image {image}:{tag} has no manifest for platform={platform or DEFAULT_PLATFORM} available {available}"
+    )
+
+
+def _platform_string(platform: schema.DockerManifestListPlatform):
+    return "/".join(
+        value
+        for value in [platform.os, platform.architecture, platform.variant]
+        if value is not None
+    )
+
+
+def _image_platform(manifest_config, manifest_platform, platform: str = None):
+    """Platform of a pulled image from its manifest list entry or
+    configuration raising a ValueError if it is not `platform`
+
+    """
+    if manifest_platform is not None:
+        return _platform_string(manifest_platform)
+
+    config_platform = schema.DockerManifestListPlatform(
+        os=manifest_config.os, architecture=manifest_config.architecture
+    )
+    if platform is not None:
+        wanted = schema.DockerManifestListPlatform.from_string(platform)
+        if (wanted.os, wanted.architecture) != (
+            config_platform.os,
+            config_platform.architecture,
+        ):
+            raise ValueError(
+                f"image is for platform={_platform_string(config_platform)} not platform={platform}"
+            )
+    return _platform_string(config_platform)
+
+
+def _manifest_list(images, manifests):
+    """Content and media type of the manifest list of `images` with
+    their `Image.manifest_v2`
+
+    """
+    if any(
+        image.manifest_media_type == schema.OCI_MANIFEST_MEDIA_TYPE for image in images
+    ):
+        media_type = schema.OCI_INDEX_MEDIA_TYPE
+    else:
+        media_type = schema.DOCKER_MANIFEST_LIST_MEDIA_TYPE
+
+    manifest_list = schema.DockerManifestList(
+        mediaType=media_type,
+        manifests=[
+            schema.DockerManifestListManifest(
+                mediaType=image.manifest_media_type,
+                size=len(manifest["manifest"][0]),
+                digest=f"sha256:{manifest['manifest'][1]}",
+                platform=schema.DockerManifestListPlatform.from_string(image.platform),
+            )
+            for image, manifest in zip(images, manifests)
+        ],
+    )
+    content = utils.sorted_json_dumps(manifest_list.dict(exclude_none=True))
+    return content, media_type
+
+
+def _manifest_digest(headers, content: bytes, reference: str):
+    """Digest of manifest `content` fetched for `reference`
+
+    Registries may omit the digest header for manifests. The content
+    is hashed and a ValueError is raised if it does not match the
+    digest header or `reference` when it is a digest.
+
+    """
+    digest = f"sha256:{hashlib.sha256(content).hexdigest()}"
+    for expected in [reference, headers.get("Docker-Content-Digest")]:
+        if expected is None or not DIGEST_PATTERN.match(expected):
+            continue
+        if not utils.matches_digest(content, expected):
+            raise ValueError(f"manifest {reference} does not match digest {expected}")
+        digest = expected
+    return digest
+
+
+def _body_position(data):
+    """Position to rewind a file object request body to or None if it
+    cannot be rewound such as pipes and sockets
+
+    """
+    try:
+        if hasattr(data, "seekable") and data.seekable():
+            return data.tell()
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def _retry_after(response):
+    if response is None:
+        return None
+    return response.headers.get("Retry-After")
+
+
+def _bytes_received(response):
+    # bytes read from the connection before content decoding
+    if hasattr(response.raw, "tell"):
+        return response.raw.tell()
+    return len(response.content)
+
+
+def _on_close(response, callback):
+    """Call `callback` once when the streamed `response` is closed
+
+    Streamed responses are either closed directly or through the
+    underlying raw response once read.
+
+    """
+    called = False
+
+    def _callback():
+        nonlocal called
+        if not called:
+            called = True
+            callback()
+
+    for closeable in (response, response.raw):
+        close = closeable.close
+
+        def _close(close=close):
+            try:
+                close()
+            finally:
+                _callback()
+
+        closeable.close = _close
+
+
+def _read_cached_range(cache: BlobCache, blobsum: str, start: int, end: int = None):
+    """Bytes of cached blob `blobsum` from `start` up to `end` or None
+    if it is not cached
+
+    """
+    cached_fileobj = cache.open(blobsum, verify=False)
+    if cached_fileobj is None:
+        return None
+    with cached_fileobj:
+        cached_fileobj.seek(start, io.SEEK_END if start < 0 else io.SEEK_SET)
+        return cached_fileobj.read(-1 if end is None else max(end - start, 0))
+
+
+def _blob_range(get_blob, image: str, blobsum: str, start: int, end: int = None):
+    return get_blob(image, blobsum, byte_range=(start, end))
+
+
+def _range_header(start: int, end: int = None):
+    if start < 0:
+        return f"bytes={start}"
+    return f"bytes={start}-{'' if end is None else end - 1}"
+
+
+def _parse_location(location: str):
+    location = urlparse(location)
+    return location.path, parse_qs(location.query)
+
+
+def _parse_range_offset(headers, uploaded: int = 0):
+    """Offset of the next byte expected by the registry from the
+    `Range: 0-<end>` header of an upload or None if it is missing
+
+    An empty upload and a single uploaded byte are both reported as
+    0-0 which are told apart by the number of bytes `uploaded` known
+    to have been received by the registry.
+
+    """
+    if "Range" not in headers:
+        return None
+    end = int(headers["Range"].split("-")[1])
+    if end == 0 and uploaded == 0:
+        return 0
+    return end + 1
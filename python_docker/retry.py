@@ -0,0 +1,79 @@
+import email.utils
+import random
+import time
+
+
+# methods which can be repeated without changing the result
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "PUT", "DELETE", "OPTIONS"})
+# responses indicating the registry may succeed if asked again later
+RETRY_STATUS_CODES = frozenset({408, 429, 500, 502, 503, 504})
+
+
+def parse_retry_after(retry_after: str, now: float = None):
+    """Seconds to wait from a `Retry-After` header which is either a
+    number of seconds or an http date
+
+    """
+    if retry_after is None:
+        return None
+    retry_after = retry_after.strip()
+    if retry_after.isdigit():
+        return float(retry_after)
+
+    try:
+        retry_at = email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    now = time.time() if now is None else now
+    return max(retry_at.timestamp() - now, 0.0)
+
+
+class RetryPolicy:
+    """When and how long to wait before retrying a failed request
+
+    Requests are retried at most `total` times. The delay before the
+    n-th retry is chosen uniformly between zero and
+    `backoff_factor * 2**n` seconds capped at `backoff_max` to spread
+    out clients retrying at the same time. A `Retry-After` header
+    sent with the response is honored instead unless it is longer than
+    `backoff_max` in which case the request is not retried.
+
+    """
+
+    def __init__(
+        self,
+        total: int = 3,
+        backoff_factor: float = 0.5,
+        backoff_max: float = 30.0,
+        status_codes=RETRY_STATUS_CODES,
+    ):
+        self.total = total
+        self.backoff_factor = backoff_factor
+        self.backoff_max = backoff_max
+        self.status_codes = frozenset(status_codes)
+
+    def should_retry_status(self, status_code: int):
+        return status_code in self.status_codes
+
+    def delay(self, retries: int, retry_after: str = None):
+        """Seconds to wait before retry number `retries` starting at
+        zero or None if the request should not be retried
+
+        """
+        if retries >= self.total:
+            return None
+        return self.backoff(retries, retry_after)
+
+    def backoff(self, retries: int, retry_after: str = None):
+        """Seconds to wait before retry number `retries` regardless of
+        `total` or None if `retry_after` is too long
+
+        """
+        if retry_after is not None:
+            seconds = parse_retry_after(retry_after)
+            if seconds is not None:
+                return seconds if seconds <= self.backoff_max else None
+
+        return random.uniform(
+            0, min(self.backoff_max, self.backoff_factor * 2**retries)
+        )
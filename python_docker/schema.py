@@ -7,6 +7,19 @@ from pydantic import BaseModel, Field
 from python_docker import __version__ as VERSION
 
 
+DOCKER_MANIFEST_V2_MEDIA_TYPE = "application/vnd.docker.distribution.manifest.v2+json"
+DOCKER_CONFIG_MEDIA_TYPE = "application/vnd.docker.container.image.v1+json"
+DOCKER_LAYER_GZIP_MEDIA_TYPE = "application/vnd.docker.image.rootfs.diff.tar.gzip"
+DOCKER_MANIFEST_LIST_MEDIA_TYPE = (
+    "application/vnd.docker.distribution.manifest.list.v2+json"
+)
+OCI_MANIFEST_MEDIA_TYPE = "application/vnd.oci.image.manifest.v1+json"
+OCI_CONFIG_MEDIA_TYPE = "application/vnd.oci.image.config.v1+json"
+OCI_LAYER_GZIP_MEDIA_TYPE = "application/vnd.oci.image.layer.v1.tar+gzip"
+OCI_LAYER_ZSTD_MEDIA_TYPE = "application/vnd.oci.image.layer.v1.tar+zstd"
+OCI_INDEX_MEDIA_TYPE = "application/vnd.oci.image.index.v1+json"
+
+
 def _docker_datetime_factory():
     """utcnow datetime + timezone as string"""
     return datetime.datetime.utcnow().astimezone().isoformat()
@@ -38,24 +51,56 @@ class DockerManifestV1(BaseModel):
 
 
 class DockerManifestV2Layer(BaseModel):
-    mediaType: str = "application/vnd.docker.image.rootfs.diff.tar.gzip"
+    mediaType: str = DOCKER_LAYER_GZIP_MEDIA_TYPE
     size: int
     digest: str
 
 
 class DockerManifestV2Config(BaseModel):
-    mediaType: str = "application/vnd.docker.container.image.v1+json"
+    mediaType: str = DOCKER_CONFIG_MEDIA_TYPE
     size: int
     digest: str
 
 
 class DockerManifestV2(BaseModel):
     schemaVersion: int = 2
-    mediaType: str = "application/vnd.docker.distribution.manifest.v2+json"
+    mediaType: str = DOCKER_MANIFEST_V2_MEDIA_TYPE
     config: DockerManifestV2Config
     layers: List[DockerManifestV2Layer] = []
 
 
+class DockerManifestListPlatform(BaseModel):
+    architecture: str
+    os: str
+    variant: Optional[str] = None
+
+    @classmethod
+    def from_string(cls, platform: str):
+        """Parse platform string such as "linux/arm64/v8" """
+        parts = platform.split("/")
+        if len(parts) not in {2, 3}:
+            raise ValueError(f"platform={platform} is not os/architecture[/variant]")
+        return cls(
+            os=parts[0],
+            architecture=parts[1],
+            variant=parts[2] if len(parts) == 3 else None,
+        )
+
+
+class DockerManifestListManifest(BaseModel):
+    mediaType: str = DOCKER_MANIFEST_V2_MEDIA_TYPE
+    size: int
+    digest: str
+    platform: Optional[DockerManifestListPlatform] = None
+
+
+# OCI image indexes share the structure of manifest lists
+class DockerManifestList(BaseModel):
+    schemaVersion: int = 2
+    mediaType: str = DOCKER_MANIFEST_LIST_MEDIA_TYPE
+    manifests: List[DockerManifestListManifest] = []
+
+
 class DockerConfigConfig(BaseModel):
     Hostname: str = ""
     Domainname: str = ""
@@ -1,9 +1,31 @@
+import collections
+import concurrent.futures
+import copy
+import functools
+import hashlib
 import io
 import json
+import os
+import posixpath
+import secrets
+import stat
 import tarfile
+from typing import NamedTuple
 
 from python_docker import utils
 
+# regular files up to this size are read ahead by worker threads
+PREFETCH_FILE_SIZE = 2**20
+# limits of file content and files read ahead of the tar writer
+PREFETCH_BUFFER_SIZE = 64 * 2**20
+PREFETCH_FILES = 1024
+
+try:
+    import grp
+    import pwd
+except ImportError:  # windows
+    grp = pwd = None
+
 
 def _extract_file(tar, filename):
     f = tar.extractfile(filename)
@@ -15,6 +37,40 @@ def _extract_json(tar, filename):
     return json.loads(f.decode("utf-8"))
 
 
+def _add_stream(tar, filename, fileobj, chunk_size: int = utils.DEFAULT_CHUNK_SIZE):
+    """Add file of unknown size to a tar written to a seekable file
+
+    The header is written with a placeholder size which is rewritten
+    once the content has been streamed. Returns the size and sha256
+    checksum of the content.
+
+    """
+    tar_info = tarfile.TarInfo(name=filename)
+    # gnu headers store large sizes in base-256 so that the header
+    # length does not depend on the size
+    header_offset = tar.offset
+    tar.fileobj.write(tar_info.tobuf(tarfile.GNU_FORMAT, tar.encoding, tar.errors))
+
+    hasher = hashlib.sha256()
+    size = 0
+    for chunk in iter(lambda: fileobj.read(chunk_size), b""):
+        hasher.update(chunk)
+        size += len(chunk)
+        tar.fileobj.write(chunk)
+
+    remainder = size % tarfile.BLOCKSIZE
+    if remainder:
+        tar.fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+    end_offset = tar.fileobj.tell()
+
+    tar_info.size = size
+    tar.fileobj.seek(header_offset)
+    tar.fileobj.write(tar_info.tobuf(tarfile.GNU_FORMAT, tar.encoding, tar.errors))
+    tar.fileobj.seek(end_offset)
+    tar.offset = end_offset
+    return size, hasher.hexdigest()
+
+
 def _add_file(tar, filename, content, filter=None):
     tar_info = tarfile.TarInfo(name=filename)
     tar_info.size = len(content)
@@ -27,11 +83,131 @@ def _add_file(tar, filename, content, filter=None):
     tar.addfile(tar_info, content)
 
 
-def _parse_v1_layer(tar, layer_id):
+def index_tar(filename):
+    """Index the members of tar `filename` with a single scan of the headers
+
+    Returns a `TarIndex` mapping member names to `utils.FileSlice` of
+    their content within the tar. Links are resolved to the content
+    of their target.
+
+    """
+    index, links = TarIndex(), {}
+    # all slices share a single open file owned by the index
+    index.file = open(filename, "rb", buffering=0)
+    try:
+        with tarfile.TarFile(filename) as tar:
+            for member in tar:
+                if member.isfile():
+                    index[member.name] = utils.FileSlice(
+                        filename, member.offset_data, member.size, file=index.file
+                    )
+                elif member.issym():
+                    links[member.name] = posixpath.normpath(
+                        posixpath.join(posixpath.dirname(member.name), member.linkname)
+                    )
+                elif member.islnk():
+                    links[member.name] = member.linkname
+    except BaseException:
+        index.close()
+        raise
+
+    for name, target in links.items():
+        seen = {name}
+        while target in links and target not in seen:
+            seen.add(target)
+            target = links[target]
+        if target in index:
+            index[name] = index[target]
+
+    return index
+
+
+class TarIndex(dict):
+    """Members of a tar indexed by `index_tar` sharing the open `file`
+
+    The file is closed with `close` or when the index is used as a
+    context manager after which the slices are no longer readable.
+    Otherwise it is closed once the index and all slices are garbage
+    collected.
+
+    """
+
+    file = None
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class TocEntry(NamedTuple):
+    """Member of a layer tar with the offsets of its header and content"""
+
+    name: str
+    type: str
+    mode: int
+    size: int
+    offset: int
+    offset_data: int
+    linkname: str = ""
+
+
+def index_layer(fileobj):
+    """Table of contents of the layer tar read from `fileobj`
+
+    Only the headers are read if `fileobj` is seekable. Returns a list
+    of `TocEntry` in the order of the members in the tar.
+
+    """
+    mode = "r:" if fileobj.seekable() else "r|"
+    with tarfile.open(fileobj=fileobj, mode=mode) as tar:
+        return [
+            TocEntry(
+                member.name,
+                member.type.decode("ascii"),
+                member.mode,
+                member.size,
+                member.offset,
+                member.offset_data,
+                member.linkname,
+            )
+            for member in tar
+        ]
+
+
+def resolve_toc_entry(toc_paths, path: str):
+    """Regular file `TocEntry` of `path` following links in a map of
+    normalized member paths to entries
+
+    Raises a KeyError if `path` does not resolve to a regular file.
+
+    """
+    path = _member_path(path)
+    seen = set()
+    while path in toc_paths and path not in seen:
+        seen.add(path)
+        entry = toc_paths[path]
+        if entry.type == tarfile.SYMTYPE.decode("ascii"):
+            path = _member_path(posixpath.join(posixpath.dirname(path), entry.linkname))
+        elif entry.type == tarfile.LNKTYPE.decode("ascii"):
+            path = _member_path(entry.linkname)
+        elif entry.type.encode("ascii") in tarfile.REGULAR_TYPES:
+            return entry
+        else:
+            break
+    raise KeyError(f"{path} is not a file in the layer")
+
+
+def _parse_v1_layer(read_file, read_content, layer_id):
     from python_docker.base import Layer
 
-    d = _extract_json(tar, f"{layer_id}/json")
-    content = _extract_file(tar, f"{layer_id}/layer.tar")
+    d = json.loads(read_file(f"{layer_id}/json").decode("utf-8"))
+    content = read_content(f"{layer_id}/layer.tar")
     return Layer(
         id=d["id"],
         parent=d.get("parent"),
@@ -44,19 +220,19 @@ def _parse_v1_layer(tar, layer_id):
     )
 
 
-def parse_v1(tar):
+def _parse_v1(read_file, read_content):
     from python_docker.base import Image
 
-    d = _extract_json(tar, "repositories")
+    d = json.loads(read_file("repositories").decode("utf-8"))
 
     images = []
     for image_name, config in d.items():
         for image_tag, layer_id in config.items():
-            current_layer = _parse_v1_layer(tar, layer_id)
+            current_layer = _parse_v1_layer(read_file, read_content, layer_id)
             layers = [current_layer]
             while current_layer.parent is not None:
                 layer_id = current_layer.parent
-                current_layer = _parse_v1_layer(tar, layer_id)
+                current_layer = _parse_v1_layer(read_file, read_content, layer_id)
                 layers.append(current_layer)
 
             images.append(Image(name=image_name, tag=image_tag, layers=layers))
@@ -64,14 +240,53 @@ def parse_v1(tar):
     return images
 
 
+def parse_v1(tar):
+    """Parse images from tar reading all layers into memory"""
+    read_file = functools.partial(_extract_file, tar)
+    return _parse_v1(read_file, read_file)
+
+
+def parse_v1_index(index):
+    """Parse images from an index of a tar created with `index_tar`
+
+    The content of the layers is only read from the tar when used.
+
+    """
+
+    def _read_file(name):
+        return index[name].read()
+
+    return _parse_v1(_read_file, index.__getitem__)
+
+
 def write_v1(image, filename):
+    # write to a temporary file which replaces filename once complete
+    # since layers may be read from filename
+    temp_filename = os.path.join(
+        os.path.dirname(os.path.abspath(filename)),
+        f".{os.path.basename(filename)}.{secrets.token_hex(8)}.tmp",
+    )
+    try:
+        _write_v1(image, temp_filename)
+        os.replace(temp_filename, filename)
+    except BaseException:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        raise
+
+
+def _write_v1(image, filename):
     with tarfile.TarFile(filename, "w") as tar:
         content = write_v1_repositories(image)
         _add_file(tar, "repositories", content)
 
         for layer in image.layers:
             _add_file(tar, f"{layer.id}/VERSION", b"1.0")
-            _add_file(tar, f"{layer.id}/layer.tar", layer.content)
+            # layers are streamed from their source and the size and
+            # checksum computed while writing
+            with layer.open() as fileobj:
+                size, checksum = _add_stream(tar, f"{layer.id}/layer.tar", fileobj)
+            layer._cached_size, layer._cached_checksum = size, checksum
             _add_file(tar, f"{layer.id}/json", write_v1_layer_metadata(layer))
 
 
@@ -97,34 +312,608 @@ def write_v1_repositories(image):
     return utils.sorted_json_dumps({image.name: {image.tag: image.layers[0].id}})
 
 
-def write_tar_from_contents(contents, filter=None):
+def _write_tar(write, fileobj=None):
+    if fileobj is not None:
+        with tarfile.TarFile(mode="w", fileobj=fileobj) as tar:
+            write(tar)
+        return None
+
+    digest = io.BytesIO()
+    with tarfile.TarFile(mode="w", fileobj=digest) as tar:
+        write(tar)
+    digest.seek(0)
+    return digest.getvalue()
+
+
+def write_tar_from_contents(contents, filter=None, fileobj=None):
     """Writes a tar file from a dict of archive names to bytes that represent the
     contents of each file.
+
+    The tar is returned as bytes unless `fileobj` is specified in
+    which case it is written to `fileobj`.
     """
-    digest = io.BytesIO()
-    with tarfile.TarFile(mode="w", fileobj=digest) as tar:
+
+    def _write(tar):
         for filename, content in contents.items():
             _add_file(tar, filename, content, filter=filter)
-    digest.seek(0)
-    return digest.getvalue()
+
+    return _write_tar(_write, fileobj)
 
 
-def write_tar_from_paths(paths, filter=None):
+def write_tar_from_paths(paths, filter=None, fileobj=None, max_workers: int = None):
     """Writes a tar file from a dict mapping host name paths to
     archive names.
+
+    With `max_workers` the paths are stat'ed and the file contents
+    read ahead by a pool of threads while a single writer adds them
+    in the same order.
     """
-    digest = io.BytesIO()
-    with tarfile.TarFile(mode="w", fileobj=digest) as tar:
+
+    def _write(tar, executor=None):
+        _add_entries(
+            tar, walk_paths(tar, paths, filter, executor=executor), executor=executor
+        )
+
+    return _write_tar(_with_executor(_write, max_workers), fileobj)
+
+
+def write_tar_from_path(
+    path, arcpath=None, recursive=True, filter=None, fileobj=None, max_workers=None
+):
+    """Writes a tar file from a single path.
+
+    With `max_workers` directories are listed and file contents read
+    ahead by a pool of threads while a single writer adds them in the
+    same sorted order. The tar is identical either way.
+    """
+
+    def _write(tar, executor=None):
+        _add_entries(
+            tar,
+            walk_path(tar, path, arcpath, recursive, filter, executor=executor),
+            executor=executor,
+        )
+
+    return _write_tar(_with_executor(_write, max_workers), fileobj)
+
+
+def _with_executor(write, max_workers: int = None):
+    if max_workers is None:
+        return write
+
+    def _write(tar):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            write(tar, executor=executor)
+
+    return _write
+
+
+WHITEOUT_PREFIX = ".wh."
+WHITEOUT_OPAQUE = ".wh..wh..opq"
+
+
+def _member_path(name: str):
+    path = posixpath.normpath("/" + name).lstrip("/")
+    return path or "."
+
+
+def _parents(path: str):
+    while path not in (".", ""):
+        path = posixpath.dirname(path) or "."
+        yield path
+
+
+def write_tar_from_layers(tars, keep_whiteouts: bool = True, fileobj=None):
+    """Writes a tar file merging layer tars ordered from the top most
+    layer down in a single pass over each of them
+
+    Entries of upper layers replace entries at the same path in lower
+    layers and OCI whiteouts (`.wh.<name>` files and `.wh..wh..opq`
+    opaque directory markers) hide the entries of lower layers. The
+    whiteouts are kept in the merged tar to apply to the layers below
+    it unless `keep_whiteouts` is False. Whiteouts of paths with
+    entries from upper layers are dropped since a layer may not delete
+    its own entries while opaque markers are always kept as they only
+    hide the entries of lower layers.
+
+    """
+
+    def _write(tar):
+        # state of the upper layers already merged
+        present, non_directories, deleted, opaque = set(), set(), set(), set()
+        # hardlinks to targets in layers below all merged layers
+        external_links = []
+
+        def _hidden(path):
+            return path in deleted or any(
+                parent in deleted or parent in opaque or parent in non_directories
+                for parent in _parents(path)
+            )
+
+        for layer_tar in tars:
+            added, added_non_directories = {}, set()
+            added_deleted, added_opaque = set(), set()
+            # hardlinks whose target is later in the same layer
+            deferred_links = []
+
+            def _add_link(member, target):
+                if target in added:
+                    tar.addfile(member)
+                elif target in present or _hidden(target):
+                    # target is replaced by an upper layer so the
+                    # link becomes a copy of the original content
+                    original = layer_members[target]
+                    link_copy = copy.copy(member)
+                    link_copy.type, link_copy.linkname = tarfile.REGTYPE, ""
+                    link_copy.size = original.size
+                    link_copy.pax_headers = {
+                        key: value
+                        for key, value in member.pax_headers.items()
+                        if key not in {"linkpath", "size"}
+                    }
+                    tar.addfile(link_copy, layer_tar.extractfile(original))
+                else:
+                    external_links.append(member)
+
+            layer_members = {}
+            for member in layer_tar:
+                path = _member_path(member.name)
+                directory, name = posixpath.split(path)
+                directory = directory or "."
+                layer_members.setdefault(path, member)
+
+                if name == WHITEOUT_OPAQUE:
+                    if _hidden(path):
+                        continue
+                    added_opaque.add(directory)
+                    if keep_whiteouts:
+                        tar.addfile(member)
+                    continue
+                if name.startswith(WHITEOUT_PREFIX + WHITEOUT_PREFIX):
+                    continue  # aufs metadata
+                if name.startswith(WHITEOUT_PREFIX):
+                    target = _member_path(
+                        posixpath.join(directory, name[len(WHITEOUT_PREFIX) :])
+                    )
+                    if _hidden(target):
+                        continue
+                    added_deleted.add(target)
+                    if keep_whiteouts and target not in present and target not in added:
+                        tar.addfile(member)
+                    continue
+
+                if path in present or path in added or _hidden(path):
+                    continue
+                added[path] = member
+                if not member.isdir():
+                    added_non_directories.add(path)
+
+                if member.islnk():
+                    target = _member_path(member.linkname)
+                    if target in added or target in layer_members:
+                        _add_link(member, target)
+                    else:
+                        deferred_links.append((member, target))
+                elif member.isreg():
+                    tar.addfile(member, layer_tar.extractfile(member))
+                else:
+                    tar.addfile(member)
+
+            for member, target in deferred_links:
+                if target in layer_members:
+                    _add_link(member, target)
+                else:
+                    external_links.append(member)
+
+            present.update(added)
+            non_directories.update(added_non_directories)
+            deleted.update(added_deleted)
+            opaque.update(added_opaque)
+
+        for member in external_links:
+            tar.addfile(member)
+
+    return _write_tar(_write, fileobj)
+
+
+def _diff_key(tarinfo):
+    """Tar header fields compared to decide whether an entry changed
+
+    Only the permission bits of the mode are stored in the header.
+
+    """
+    return (
+        tarinfo.type,
+        tarinfo.mode & 0o7777,
+        tarinfo.uid,
+        tarinfo.gid,
+        tarinfo.uname,
+        tarinfo.gname,
+        tarinfo.linkname,
+        tarinfo.size,
+        tarinfo.devmajor,
+        tarinfo.devminor,
+    )
+
+
+def _same_content(open_a, open_b, chunk_size: int = utils.DEFAULT_CHUNK_SIZE):
+    with open_a() as a, open_b() as b:
+        while True:
+            chunk = a.read(chunk_size)
+            if chunk != b.read(chunk_size):
+                return False
+            if not chunk:
+                return True
+
+
+def _base_entries(base, arcpath, filter):
+    """Map of member paths to the `tarfile.TarInfo`, a callable
+    opening the content and the modification time in nanoseconds if
+    known of each entry of `base` a directory or an opened
+    `tarfile.TarFile`
+
+    """
+    entries = {}
+    if isinstance(base, tarfile.TarFile):
+        for member in base:
+            entries[_member_path(member.name)] = (
+                member,
+                functools.partial(base.extractfile, member),
+                None,
+            )
+        return entries
+
+    # inodes of the base tree must not turn files of the new tree into
+    # hardlinks
+    with tarfile.TarFile(mode="w", fileobj=io.BytesIO()) as base_tar:
+        for path, tarinfo, statres in walk_path(base_tar, base, arcpath, filter=filter):
+            entries[_member_path(tarinfo.name)] = (
+                tarinfo,
+                functools.partial(open, path, "rb"),
+                statres.st_mtime_ns,
+            )
+    return entries
+
+
+def _is_parent(parent: str, path: str):
+    return parent == "." or path.startswith(parent + "/")
+
+
+def write_tar_from_diff(path, base, arcpath=None, filter=None, fileobj=None):
+    """Writes a tar file of the changes from `base` to `path`
+
+    `base` is either a directory or an opened `tarfile.TarFile` of a
+    layer. Only entries of `path` which are new or whose metadata or
+    content differ from `base` are added along with their parent
+    directories. Entries of `base` missing from `path` are deleted
+    with whiteouts. `filter` is applied to both trees.
+
+    Regular files of a directory `base` with the same metadata and
+    modification time are assumed to be unchanged without comparing
+    their content. Layers only store modification times to the second
+    which cannot tell apart files modified within the same second so
+    the content of regular files of a layer `base` with the same
+    metadata is always compared.
+
+    """
+
+    def _changed(key, path, tarinfo, statres, base_entries):
+        if key not in base_entries:
+            return True
+        base_tarinfo, open_base, base_mtime_ns = base_entries[key]
+        if _diff_key(tarinfo) != _diff_key(base_tarinfo):
+            return True
+        if not tarinfo.isreg():
+            return False
+        if base_mtime_ns is not None and statres.st_mtime_ns == base_mtime_ns:
+            return False
+        return not _same_content(functools.partial(open, path, "rb"), open_base)
+
+    def _entries(tar):
+        # the base tree is stored under the arcname of the new tree so
+        # that the names of both trees match
+        base_entries = _base_entries(base, path if arcpath is None else arcpath, filter)
+        directories, non_directories = set(), set()
+        # unchanged directories added once one of their children changed
+        parents = []
+        # unchanged files which may be the target of changed hardlinks
+        link_targets = {}
+
+        for entry in walk_path(tar, path, arcpath, filter=filter):
+            tarinfo, statres = entry[1], entry[2]
+            key = _member_path(tarinfo.name)
+            (directories if tarinfo.isdir() else non_directories).add(key)
+            while parents and not _is_parent(parents[-1][0], key):
+                parents.pop()
+
+            if not _changed(key, entry[0], tarinfo, statres, base_entries):
+                if tarinfo.isdir():
+                    parents.append((key, entry))
+                elif tarinfo.isreg() and statres.st_nlink > 1:
+                    link_targets[tarinfo.name] = entry
+                continue
+
+            for _, parent in parents:
+                yield parent
+            parents.clear()
+            if tarinfo.islnk() and tarinfo.linkname in link_targets:
+                yield link_targets.pop(tarinfo.linkname)
+            yield entry
+
+        for key in sorted(base_entries):
+            if key in directories or key in non_directories:
+                continue
+            # only the top most deleted path needs a whiteout and none
+            # are needed below directories replaced by other types
+            if any(
+                parent not in directories or parent in non_directories
+                for parent in _parents(key)
+                if parent in base_entries
+            ):
+                continue
+            directory, name = posixpath.split(key)
+            yield None, tarfile.TarInfo(
+                posixpath.join(directory, WHITEOUT_PREFIX + name)
+            ), None
+
+    def _write(tar):
+        _add_entries(
+            tar,
+            _entries(tar),
+            lambda path, tarinfo, statres: io.BytesIO() if path is None else None,
+        )
+
+    return _write_tar(_write, fileobj)
+
+
+@functools.lru_cache(maxsize=None)
+def _uname(uid: int):
+    try:
+        return pwd.getpwuid(uid)[0] if pwd else ""
+    except KeyError:
+        return ""
+
+
+@functools.lru_cache(maxsize=None)
+def _gname(gid: int):
+    try:
+        return grp.getgrgid(gid)[0] if grp else ""
+    except KeyError:
+        return ""
+
+
+def _tarinfo(tar, name, arcname, statres, linkname: str = None):
+    """Equivalent of `TarFile.gettarinfo` from an existing `os.lstat`
+    result `statres` and the target `linkname` of symlinks
+
+    """
+    arcname = os.path.splitdrive(arcname)[1].replace(os.sep, "/").lstrip("/")
+    tarinfo = tar.tarinfo()
+    tarinfo.tarfile = tar
+
+    stmd = statres.st_mode
+    if stat.S_ISREG(stmd):
+        inode = (statres.st_ino, statres.st_dev)
+        if (
+            statres.st_nlink > 1
+            and inode in tar.inodes
+            and arcname != tar.inodes[inode]
+        ):
+            type, linkname = tarfile.LNKTYPE, tar.inodes[inode]
+        else:
+            type, linkname = tarfile.REGTYPE, ""
+            if inode[0]:
+                tar.inodes[inode] = arcname
+    elif stat.S_ISDIR(stmd):
+        type, linkname = tarfile.DIRTYPE, ""
+    elif stat.S_ISFIFO(stmd):
+        type, linkname = tarfile.FIFOTYPE, ""
+    elif stat.S_ISLNK(stmd):
+        type = tarfile.SYMTYPE
+        linkname = os.readlink(name) if linkname is None else linkname
+    elif stat.S_ISCHR(stmd):
+        type, linkname = tarfile.CHRTYPE, ""
+    elif stat.S_ISBLK(stmd):
+        type, linkname = tarfile.BLKTYPE, ""
+    else:
+        return None
+
+    tarinfo.name = arcname
+    tarinfo.mode = stmd
+    tarinfo.uid = statres.st_uid
+    tarinfo.gid = statres.st_gid
+    tarinfo.size = statres.st_size if type == tarfile.REGTYPE else 0
+    tarinfo.mtime = statres.st_mtime
+    tarinfo.type = type
+    tarinfo.linkname = linkname
+    if pwd:
+        tarinfo.uname = _uname(tarinfo.uid) or tarinfo.uname
+    if grp:
+        tarinfo.gname = _gname(tarinfo.gid) or tarinfo.gname
+    if type in (tarfile.CHRTYPE, tarfile.BLKTYPE) and hasattr(os, "major"):
+        tarinfo.devmajor = os.major(statres.st_rdev)
+        tarinfo.devminor = os.minor(statres.st_rdev)
+    return tarinfo
+
+
+def walk_path(tar, path, arcpath=None, recursive=True, filter=None, executor=None):
+    """Walk `path` in the order `TarFile.add` adds it to `tar`
+
+    Yields tuples of the path, its `tarfile.TarInfo` after `filter`
+    and its `os.lstat` result. Directories excluded by `filter` are
+    not descended into. File contents are not read.
+
+    With a `concurrent.futures.Executor` the subdirectories of each
+    directory are listed ahead of the walk by `executor`. The
+    `filter` is still called from the walking thread in order.
+
+    """
+    path = os.fspath(path)
+    arcpath = path if arcpath is None else arcpath
+    scanner = _DirectoryScanner(executor) if executor is not None else None
+    yield from _walk(
+        tar, path, arcpath, os.lstat(path), None, recursive, filter, scanner
+    )
+
+
+def walk_paths(tar, paths, filter=None, executor=None):
+    """Walk a dict mapping paths to archive names in the order
+    `TarFile.add` adds them to `tar` without recursing
+
+    With an `executor` all paths are stat'ed ahead of the walk.
+
+    """
+    if executor is None:
         for path, arcpath in paths.items():
-            tar.add(path, arcname=arcpath, recursive=False, filter=filter)
-    digest.seek(0)
-    return digest.getvalue()
+            yield from walk_path(tar, path, arcpath, recursive=False, filter=filter)
+        return
 
+    scans = [
+        (os.fspath(path), arcpath, executor.submit(_scan_entry, os.fspath(path)))
+        for path, arcpath in paths.items()
+    ]
+    for path, arcpath, future in scans:
+        statres, linkname = future.result()
+        yield from _walk(tar, path, arcpath, statres, linkname, False, filter, None)
 
-def write_tar_from_path(path, arcpath=None, recursive=True, filter=None):
-    """Writes a tar file from a single path."""
-    digest = io.BytesIO()
-    with tarfile.TarFile(mode="w", fileobj=digest) as tar:
-        tar.add(path, arcname=arcpath, recursive=recursive, filter=filter)
-    digest.seek(0)
-    return digest.getvalue()
+
+def _scan_entry(path):
+    statres = os.lstat(path)
+    linkname = os.readlink(path) if stat.S_ISLNK(statres.st_mode) else None
+    return statres, linkname
+
+
+class _DirectoryScanner:
+    """List directories and stat their entries on an executor
+
+    When a directory is walked the listing of all its subdirectories
+    is started so that the latency of listing a directory overlaps
+    with walking its siblings.
+
+    """
+
+    def __init__(self, executor):
+        self.executor = executor
+        self.scans = {}
+
+    def _scan(self, path):
+        return [
+            (name, *_scan_entry(os.path.join(path, name)))
+            for name in sorted(os.listdir(path))
+        ]
+
+    def listdir(self, path):
+        future = self.scans.pop(path, None)
+        entries = self._scan(path) if future is None else future.result()
+        for name, statres, _ in entries:
+            if stat.S_ISDIR(statres.st_mode):
+                child = os.path.join(path, name)
+                self.scans[child] = self.executor.submit(self._scan, child)
+        return entries
+
+
+def _walk(tar, path, arcpath, statres, linkname, recursive, filter, scanner):
+    tarinfo = _tarinfo(tar, path, arcpath, statres, linkname)
+    if tarinfo is None:
+        return
+    if filter is not None:
+        tarinfo = filter(tarinfo)
+        if tarinfo is None:
+            return
+    yield path, tarinfo, statres
+
+    if tarinfo.isdir() and recursive:
+        if scanner is None:
+            entries = [
+                (name, os.lstat(os.path.join(path, name)), None)
+                for name in sorted(os.listdir(path))
+            ]
+        else:
+            entries = scanner.listdir(path)
+        for name, statres, linkname in entries:
+            yield from _walk(
+                tar,
+                os.path.join(path, name),
+                os.path.join(arcpath, name),
+                statres,
+                linkname,
+                recursive,
+                filter,
+                scanner,
+            )
+
+
+def _read_file(path: str):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _prefetch(entries, open_content, executor):
+    """Read the content of small files from `entries` ahead on
+    `executor` up to `PREFETCH_BUFFER_SIZE` bytes and `PREFETCH_FILES`
+    files
+
+    Yields each entry with a future or file object of its content
+    or None if it is read from the path when added.
+
+    """
+    pending = collections.deque()
+    buffered = 0
+    for path, tarinfo, statres in entries:
+        fileobj = None
+        if tarinfo.isreg():
+            if open_content is not None:
+                fileobj = open_content(path, tarinfo, statres)
+            if fileobj is None and tarinfo.size <= PREFETCH_FILE_SIZE:
+                fileobj = executor.submit(_read_file, path)
+                buffered += tarinfo.size
+        pending.append((path, tarinfo, statres, fileobj))
+
+        while pending and (
+            buffered > PREFETCH_BUFFER_SIZE or len(pending) > PREFETCH_FILES
+        ):
+            entry = pending.popleft()
+            if isinstance(entry[3], concurrent.futures.Future):
+                buffered -= entry[1].size
+            yield entry
+
+    yield from pending
+
+
+def _add_entries(tar, entries, open_content=None, executor=None):
+    """Add entries from `walk_path` to `tar`
+
+    The content of regular files is read from `open_content(path,
+    tarinfo, statres)` if it returns a file object and otherwise from
+    the file at path. With an `executor` small files are read ahead by
+    it. Returns a dictionary mapping the path of each regular file to
+    the offset of its content within the tar.
+
+    """
+    if executor is None:
+        entries = (
+            (
+                path,
+                tarinfo,
+                statres,
+                open_content(path, tarinfo, statres)
+                if open_content is not None and tarinfo.isreg()
+                else None,
+            )
+            for path, tarinfo, statres in entries
+        )
+    else:
+        entries = _prefetch(entries, open_content, executor)
+
+    offsets = {}
+    for path, tarinfo, statres, fileobj in entries:
+        if tarinfo.isreg():
+            if isinstance(fileobj, concurrent.futures.Future):
+                fileobj = io.BytesIO(fileobj.result())
+            with fileobj or open(path, "rb") as fileobj:
+                tar.addfile(tarinfo, fileobj)
+            blocks = -(-tarinfo.size // tarfile.BLOCKSIZE)
+            offsets[path] = tar.offset - blocks * tarfile.BLOCKSIZE
+        else:
+            tar.addfile(tarinfo)
+    return offsets
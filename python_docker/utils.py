@@ -1,5 +1,203 @@
+import contextlib
+import hashlib
+import io
 import json
+import mmap
+import os
+import tempfile
+import threading
+import weakref
+
+
+DEFAULT_CHUNK_SIZE = 2**20
+
+# serializes seeking and reading of files shared between slices where
+# os.pread is not available such as on windows
+_SEEK_LOCK = threading.Lock()
 
 
 def sorted_json_dumps(d):
     return json.dumps(d, sort_keys=True).encode("utf-8")
+
+
+def sha256_fileobj(fileobj, chunk_size: int = DEFAULT_CHUNK_SIZE):
+    hasher = hashlib.sha256()
+    for chunk in iter(lambda: fileobj.read(chunk_size), b""):
+        hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def matches_digest(content: bytes, digest: str):
+    """Whether `content` hashes to `digest` such as "sha256:<hex>" """
+    algorithm, checksum = digest.split(":", 1)
+    return (
+        algorithm in hashlib.algorithms_available
+        and hashlib.new(algorithm, content).hexdigest() == checksum
+    )
+
+
+class FileSlice:
+    """Region of a file on disk used to store content outside of memory
+
+    Content is read through `open` as a file object or through `mmap`
+    as a memory mapped buffer. The file is opened once when the slice
+    is created so that the content remains readable even if the path
+    is replaced. Slices of the same file may share `file`.
+
+    """
+
+    def __init__(self, path, offset: int = 0, size: int = None, file=None):
+        self.path = os.fspath(path)
+        self.offset = offset
+        self._file = file or open(self.path, "rb", buffering=0)
+        if size is None:
+            size = os.fstat(self._file.fileno()).st_size - offset
+        self.size = size
+
+    @classmethod
+    def temporary(cls, write):
+        """Create slice of a temporary file written by calling `write`
+        with a binary file object
+
+        The temporary file is removed once the slice is garbage collected.
+
+        """
+        fileobj = tempfile.NamedTemporaryFile(prefix="python-docker-", delete=False)
+        try:
+            with fileobj:
+                write(fileobj)
+        except BaseException:
+            os.remove(fileobj.name)
+            raise
+
+        file_slice = cls(fileobj.name)
+        weakref.finalize(file_slice, _remove_file, fileobj.name)
+        return file_slice
+
+    def open(self):
+        return io.BufferedReader(_FileSliceReader(self), DEFAULT_CHUNK_SIZE)
+
+    def close(self):
+        """Close the file of the slice and of slices sharing it"""
+        self._file.close()
+
+    def read(self, offset: int = 0, size: int = None):
+        """Read `size` bytes at `offset` within the slice"""
+        if size is None:
+            size = self.size - offset
+        size = max(min(size, self.size - offset), 0)
+        if hasattr(os, "pread"):
+            return os.pread(self._file.fileno(), size, self.offset + offset)
+        with _SEEK_LOCK:
+            self._file.seek(self.offset + offset)
+            return self._file.read(size)
+
+    def mmap(self):
+        if self.size == 0:
+            return memoryview(b"")
+
+        # mmap offsets must be a multiple of the allocation granularity
+        start = self.offset - (self.offset % mmap.ALLOCATIONGRANULARITY)
+        mapping = mmap.mmap(
+            self._file.fileno(),
+            self.offset - start + self.size,
+            offset=start,
+            access=mmap.ACCESS_READ,
+        )
+        return memoryview(mapping)[self.offset - start :]
+
+
+def _remove_file(path):
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(path)
+
+
+class _FileSliceReader(io.RawIOBase):
+    def __init__(self, file_slice: FileSlice):
+        self._file_slice = file_slice
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._position = offset
+        elif whence == io.SEEK_CUR:
+            self._position += offset
+        elif whence == io.SEEK_END:
+            self._position = self._file_slice.size + offset
+        return self._position
+
+    def readinto(self, buffer):
+        content = self._file_slice.read(self._position, len(buffer))
+        size = len(content)
+        memoryview(buffer)[:size] = content
+        self._position += size
+        return size
+
+
+class VerifyingReader(io.RawIOBase):
+    """Reader which computes the digest of `fileobj` as it is read and
+    raises a ValueError once the end is reached if it does not match
+    `digest`
+
+    """
+
+    def __init__(self, fileobj, digest: str):
+        self._fileobj = fileobj
+        self._digest = digest
+        algorithm, _ = digest.split(":", 1)
+        self._hasher = hashlib.new(algorithm)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = self._fileobj.readinto(buffer)
+        if size:
+            self._hasher.update(memoryview(buffer)[:size])
+        elif len(buffer):
+            algorithm, expected_checksum = self._digest.split(":", 1)
+            if self._hasher.hexdigest() != expected_checksum:
+                raise ValueError(
+                    f"blob {self._digest} digest mismatch got {algorithm}:{self._hasher.hexdigest()}"
+                )
+        return size
+
+    def close(self):
+        if not self.closed:
+            self._fileobj.close()
+        super().close()
+
+
+class HashingWriter(io.RawIOBase):
+    """Writer which computes the sha256 checksum and size of the
+    content written to `fileobj`
+
+    """
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self._hasher = hashlib.sha256()
+        self.size = 0
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.size
+
+    def write(self, buffer):
+        self._hasher.update(buffer)
+        self.size += len(buffer)
+        return self._fileobj.write(buffer)
+
+    def hexdigest(self):
+        return self._hasher.hexdigest()
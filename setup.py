@@ -34,6 +34,12 @@ setup(
         "requests",
     ],
     extras_require={
+        "zstd": [
+            "zstandard",
+        ],
+        "async": [
+            "httpx",
+        ],
         "dev": [
             "pytest",
             "black==22.6.0",
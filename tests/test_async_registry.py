@@ -0,0 +1,111 @@
+import asyncio
+import threading
+
+import pytest
+
+from benchmarks.stub_registry import StubRegistry
+from python_docker.base import Image
+from python_docker.cache import BlobCache
+
+pytest.importorskip("httpx")
+
+from python_docker.async_registry import AsyncRegistry  # noqa: E402
+
+
+@pytest.mark.parametrize(
+    "config",
+    [
+        dict(hostname="http://localhost:5000"),
+        dict(
+            hostname="http://localhost:6000",
+            username="admin",
+            password="password",
+        ),
+    ],
+)
+def test_local_docker_async_push_pull(config):
+    filename = "tests/assets/hello-world.tar"
+    image = Image.from_filename(filename)[0]
+
+    async def push_pull():
+        async with AsyncRegistry(**config) as registry:
+            await registry.push_image(image)
+
+            assert image.name in await registry.list_images()
+            assert image.tag in await registry.list_image_tags(image.name)
+
+            return await registry.pull_image(image.name, image.tag)
+
+    pulled_image = asyncio.run(push_pull())
+
+    assert pulled_image.name == image.name
+    assert [layer.checksum for layer in pulled_image.layers] == [
+        layer.checksum for layer in image.layers
+    ]
+
+
+def test_stub_async_push_pull_lazy():
+    image = Image.from_filename("tests/assets/busybox.tar")[0]
+    for i in range(4):
+        image.add_layer_contents({f"layer-{i}": str(i).encode()})
+
+    async def push_pull():
+        async with AsyncRegistry(stub.url, max_workers=1) as registry:
+            await registry.push_image(image)
+            lazy_image = await registry.pull_image(image.name, image.tag, lazy=True)
+
+            # lazy layers are fetched on the event loop from another thread
+            loop = asyncio.get_running_loop()
+            with pytest.raises(RuntimeError):
+                lazy_image.layers[0].content
+            await loop.run_in_executor(None, lambda: lazy_image.layers[0].content)
+
+            # recompressing lazy layers reads them through the event loop
+            lazy_image.name = "library/recompressed"
+            await registry.push_image(lazy_image, compression="zstd")
+            return await registry.pull_image(lazy_image.name, lazy_image.tag)
+
+    with StubRegistry() as stub:
+        pulled_image = asyncio.run(push_pull())
+
+    assert [layer.checksum for layer in pulled_image.layers] == [
+        layer.checksum for layer in image.layers
+    ]
+    assert all(layer.compression == "zstd" for layer in pulled_image.layers)
+
+
+class _ThreadRecordingCache(BlobCache):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.threads = set()
+
+    def open(self, *args, **kwargs):
+        self.threads.add(threading.get_ident())
+        return super().open(*args, **kwargs)
+
+    def lock(self):
+        self.threads.add(threading.get_ident())
+        return super().lock()
+
+
+def test_stub_async_cache_off_loop(tmp_path):
+    image = Image.from_filename("tests/assets/busybox.tar")[0]
+    cache = _ThreadRecordingCache(str(tmp_path))
+
+    async def push_pull():
+        async with AsyncRegistry(stub.url, cache=cache) as registry:
+            await registry.push_image(image)
+            pulled_image = await registry.pull_image(image.name, image.tag)
+            # second pull and range reads are served from the cache
+            await registry.pull_image(image.name, image.tag)
+            digest = f"sha256:{image.layers[0].compressed_checksum}"
+            await registry.get_blob(image.name, digest, byte_range=(0, 10))
+            return pulled_image, threading.get_ident()
+
+    with StubRegistry() as stub:
+        pulled_image, loop_thread = asyncio.run(push_pull())
+
+    assert pulled_image.layers[0].checksum == image.layers[0].checksum
+    assert cache.hits > 0 and cache.threads
+    # the blob cache is only accessed from the thread pool of the client
+    assert loop_thread not in cache.threads
@@ -0,0 +1,52 @@
+import time
+
+from python_docker import auth
+
+
+def test_parse_www_authenticate():
+    scheme, parameters = auth.parse_www_authenticate(
+        'Bearer realm="https://auth.docker.io/token",service="registry.docker.io"'
+    )
+    assert scheme == "Bearer"
+    assert parameters == {
+        "realm": "https://auth.docker.io/token",
+        "service": "registry.docker.io",
+    }
+
+
+def test_token_expiry():
+    token = auth.Token.from_response({"token": "abc", "expires_in": 300})
+    assert not token.expired
+    assert token.header == "Bearer abc"
+
+    token = auth.Token.from_response(
+        {
+            "access_token": "abc",
+            "expires_in": 300,
+            "issued_at": "2020-01-01T00:00:00.123456789Z",
+        }
+    )
+    assert token.expired
+
+    # tokens issued in the future due to clock skew use the received time
+    token = auth.Token.from_response(
+        {"token": "abc", "issued_at": "2999-01-01T00:00:00Z"}, received_at=time.time()
+    )
+    assert not token.expired
+
+
+def test_token_cache_scope():
+    cache = auth.TokenCache()
+    token = auth.Token("abc", time.time() + 300)
+    cache.put(auth.scope_access("a/b", "push,pull", mount_from=["a/c"]), token)
+
+    assert cache.get(auth.scope_access("a/b", "pull")) is token
+    assert cache.get(auth.scope_access("a/c", "pull")) is token
+    assert cache.get(auth.scope_access("a/c", "push")) is None
+    assert cache.get(auth.scope_access("a/d", "pull")) is None
+
+    cache.invalidate(token)
+    assert cache.get(auth.scope_access("a/b", "pull")) is None
+
+    cache.put(auth.scope_access("a/b", "pull"), auth.Token("abc", time.time()))
+    assert cache.get(auth.scope_access("a/b", "pull")) is None
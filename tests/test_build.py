@@ -0,0 +1,199 @@
+import hashlib
+import os
+import shutil
+
+from python_docker.base import Image
+from python_docker.build import BuildCache
+from python_docker.tar import write_tar_from_path, write_tar_from_paths
+
+
+def _write_tree(path):
+    for directory in ("bin", "lib"):
+        os.makedirs(os.path.join(path, directory))
+        for i in range(3):
+            with open(os.path.join(path, directory, f"file-{i}"), "wb") as f:
+                f.write(os.urandom(1000 + i))
+    os.symlink("bin/file-0", os.path.join(path, "link"))
+
+
+def test_build_cache_unchanged_tree(tmp_path):
+    source = str(tmp_path / "source")
+    _write_tree(source)
+    cache = BuildCache(str(tmp_path / "cache"))
+
+    tar_file, size, checksum = cache.build(source, arcpath="/app")
+    expected = write_tar_from_path(source, arcpath="/app")
+    assert tar_file.read() == expected
+    assert (size, checksum) == (len(expected), hashlib.sha256(expected).hexdigest())
+
+    tar_file, *result = cache.build(source, arcpath="/app")
+    assert result == [size, checksum]
+    assert tar_file.read() == expected
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_build_cache_changed_tree(tmp_path):
+    source = str(tmp_path / "source")
+    _write_tree(source)
+    cache = BuildCache(str(tmp_path / "cache"))
+    cache.build(source)
+
+    with open(os.path.join(source, "bin", "file-1"), "wb") as f:
+        f.write(b"changed")
+    os.remove(os.path.join(source, "lib", "file-2"))
+
+    tar_file, size, checksum = cache.build(source)
+    expected = write_tar_from_path(source)
+    assert tar_file.read() == expected
+    assert checksum == hashlib.sha256(expected).hexdigest()
+    assert (cache.hits, cache.misses) == (0, 2)
+
+
+def test_build_cache_max_size(tmp_path):
+    sources = [str(tmp_path / f"source-{i}") for i in range(3)]
+    for source in sources:
+        _write_tree(source)
+    size = len(write_tar_from_path(sources[0]))
+    cache = BuildCache(str(tmp_path / "cache"), max_size=2 * size + 1)
+
+    for i, source in enumerate(sources[:2]):
+        tar_file, _, _ = cache.build(source)
+        os.utime(tar_file.path, (i, i))
+
+    # mark first tar as most recently used
+    cache.build(sources[0])
+    cache.build(sources[2])
+    assert cache.size <= cache.max_size
+
+    cache.build(sources[0])
+    cache.build(sources[1])
+    assert (cache.hits, cache.misses) == (2, 4)
+
+
+def test_build_cache_filter(tmp_path):
+    source = str(tmp_path / "source")
+    _write_tree(source)
+    cache = BuildCache(str(tmp_path / "cache"))
+
+    def filter(tarinfo):
+        return None if tarinfo.name.endswith("lib") else tarinfo
+
+    tar_file, size, checksum = cache.build(source, filter=filter)
+    assert tar_file.read() == write_tar_from_path(source, filter=filter)
+
+
+def test_image_add_layer_path_build_cache(tmp_path):
+    source = str(tmp_path / "source")
+    _write_tree(source)
+    cache = BuildCache(str(tmp_path / "cache"))
+
+    images = []
+    for storage in ("file", "memory"):
+        image = Image("example", "latest", storage=storage)
+        image.add_layer_path(source, arcpath="/app", build_cache=cache)
+        images.append(image)
+
+    expected = write_tar_from_path(source, arcpath="/app")
+    for image in images:
+        assert bytes(image.layers[0].content) == expected
+        assert image.layers[0].checksum == hashlib.sha256(expected).hexdigest()
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_write_tar_max_workers(tmp_path):
+    source = str(tmp_path / "source")
+    _write_tree(source)
+
+    calls = []
+
+    def filter(tarinfo):
+        calls.append(tarinfo.name)
+        return None if tarinfo.name.endswith("lib") else tarinfo
+
+    expected = write_tar_from_path(source, arcpath="/app", filter=filter)
+    expected_calls, calls[:] = list(calls), []
+    assert (
+        write_tar_from_path(source, arcpath="/app", filter=filter, max_workers=4)
+        == expected
+    )
+    # filter is called in the same order from a single thread
+    assert calls == expected_calls
+
+    paths = {
+        os.path.join(source, "bin", "file-0"): "a",
+        os.path.join(source, "link"): "b",
+        os.path.join(source, "lib"): "c",
+    }
+    assert write_tar_from_paths(paths, max_workers=4) == write_tar_from_paths(paths)
+
+
+def test_image_add_layer_diff_default_arcpath(tmp_path):
+    base, source = str(tmp_path / "base"), str(tmp_path / "source")
+    _write_tree(base)
+    shutil.copytree(base, source, symlinks=True)
+    with open(os.path.join(source, "lib", "file-3"), "wb") as f:
+        f.write(b"new")
+
+    image = Image("example", "latest")
+    image.add_layer_diff(source, base)
+
+    # the base tree is compared under the arcname of the new tree
+    arcname = source.lstrip("/")
+    assert image.layers[0].list_files() == [
+        arcname,
+        f"{arcname}/lib",
+        f"{arcname}/lib/file-3",
+    ]
+
+
+def test_image_add_layer_diff(tmp_path):
+    base, source = str(tmp_path / "base"), str(tmp_path / "source")
+    _write_tree(base)
+    _write_tree(source)
+    for path in ("bin/file-0", "bin/file-1", "lib/file-0", "lib/file-1"):
+        shutil.copy2(os.path.join(base, path), os.path.join(source, path))
+    for path in ("bin/file-2", "lib/file-2"):
+        os.utime(os.path.join(source, path), (1, 1))
+    os.remove(os.path.join(source, "bin", "file-1"))
+    with open(os.path.join(source, "lib", "file-3"), "wb") as f:
+        f.write(b"new")
+    # same size with a new modification time
+    with open(os.path.join(source, "lib", "file-0"), "r+b") as f:
+        f.write(b"changed")
+    os.utime(os.path.join(source, "lib", "file-0"), (0, 0))
+    # same size modified within the same second which layers cannot store
+    os.utime(os.path.join(base, "lib", "file-1"), (10, 10))
+    with open(os.path.join(source, "lib", "file-1"), "r+b") as f:
+        f.write(b"changed")
+    os.utime(
+        os.path.join(source, "lib", "file-1"), ns=(10**10, 10**10 + 5 * 10**8)
+    )
+
+    for diff_base in (base, None):
+        image = Image("example", "latest")
+        image.add_layer_path(base, arcpath="/app")
+        image.add_layer_diff(source, diff_base or image.layers[0], arcpath="/app")
+
+        assert image.layers[0].list_files() == [
+            "app",
+            "app/bin",
+            "app/bin/file-2",
+            "app/lib",
+            "app/lib/file-0",
+            "app/lib/file-1",
+            "app/lib/file-2",
+            "app/lib/file-3",
+            "app/bin/.wh.file-1",
+        ]
+
+        expected = Image("example", "latest")
+        expected.add_layer_path(source, arcpath="/app")
+        image.squash()
+        with image.layers[0].tar as tar, expected.layers[0].tar as expected_tar:
+            assert sorted(tar.getnames()) == sorted(expected_tar.getnames())
+            for member in expected_tar:
+                if member.isreg():
+                    assert (
+                        tar.extractfile(member.name).read()
+                        == expected_tar.extractfile(member).read()
+                    )
@@ -0,0 +1,158 @@
+import hashlib
+import os
+
+import pytest
+
+from python_docker.cache import BlobCache, ManifestCache, TocCache
+from python_docker.registry import _manifest_digest
+from python_docker.tar import TocEntry
+
+
+def _digest(content):
+    return f"sha256:{hashlib.sha256(content).hexdigest()}"
+
+
+def test_blob_cache_put_get(tmp_path):
+    cache = BlobCache(str(tmp_path))
+    content = b"hello, world!"
+
+    assert cache.get(_digest(content)) is None
+    cache.put(_digest(content), content)
+
+    assert _digest(content) in cache
+    assert cache.get(_digest(content)) == content
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_blob_cache_failed_write(tmp_path):
+    cache = BlobCache(str(tmp_path))
+    content = b"hello, world!"
+
+    with pytest.raises(ValueError):
+        with cache.writer(_digest(content)) as fileobj:
+            fileobj.write(content)
+            raise ValueError("digest mismatch")
+
+    assert _digest(content) not in cache
+    assert cache.size == 0
+
+
+@pytest.mark.parametrize(
+    "digest",
+    ["sha256:../../x", "sha256:" + "0" * 63, "../sha256:" + "0" * 64, "sha256"],
+)
+def test_blob_cache_invalid_digest(tmp_path, digest):
+    cache = BlobCache(str(tmp_path))
+    with pytest.raises(ValueError):
+        cache.put(digest, b"content")
+
+
+def test_blob_cache_corrupted_blob(tmp_path):
+    cache = BlobCache(str(tmp_path))
+    content = b"hello, world!"
+    cache.put(_digest(content), content)
+    with open(cache.blob_path(_digest(content)), "wb") as f:
+        f.write(content[:5])
+
+    with cache.open(_digest(content), verify=False) as fileobj:
+        assert fileobj.read() == content[:5]
+    assert cache.get(_digest(content)) is None
+    assert _digest(content) not in cache
+
+
+def test_blob_cache_download(tmp_path):
+    cache = BlobCache(str(tmp_path))
+    content = b"hello, world!"
+
+    download = cache.download(_digest(content))
+    with download as fileobj:
+        fileobj.write(content)
+    os.remove(cache.blob_path(_digest(content)))
+    with download.fileobj:
+        assert download.fileobj.read() == content
+
+
+def test_blob_cache_lru_eviction(tmp_path):
+    cache = BlobCache(str(tmp_path), max_size=250)
+    contents = [bytes([i]) * 100 for i in range(3)]
+
+    for i, content in enumerate(contents[:2]):
+        cache.put(_digest(content), content)
+        os.utime(cache.blob_path(_digest(content)), (i, i))
+
+    # mark first blob as most recently used
+    assert cache.get(_digest(contents[0])) == contents[0]
+    cache.put(_digest(contents[2]), contents[2])
+
+    assert _digest(contents[0]) in cache
+    assert _digest(contents[1]) not in cache
+    assert _digest(contents[2]) in cache
+    assert cache.size == 200
+
+
+def test_manifest_cache(tmp_path):
+    blob_cache = BlobCache(str(tmp_path))
+    cache = ManifestCache(blob_cache)
+    content = b'{"schemaVersion": 2}'
+    media_type = "application/vnd.docker.distribution.manifest.v2+json"
+
+    assert cache.digest("foo/bar", "latest", media_type) is None
+    assert cache.digest("foo/bar", _digest(content), media_type) == _digest(content)
+
+    cache.put(_digest(content), content)
+    cache.tag("foo/bar", "latest", media_type, _digest(content))
+
+    assert cache.digest("foo/bar", "latest", media_type) == _digest(content)
+    assert cache.get(_digest(content)) == content
+    # content is shared with other instances through the blob cache
+    assert ManifestCache(blob_cache).get(_digest(content)) == content
+    assert ManifestCache().get(_digest(content)) is None
+
+    with pytest.raises(ValueError):
+        cache.put(_digest(b"other"), content)
+    # manifest lookups are not counted as blob cache hits or misses
+    assert (blob_cache.hits, blob_cache.misses) == (0, 0)
+
+
+def test_manifest_cache_max_entries():
+    cache = ManifestCache(max_entries=2)
+    contents = [b"a", b"b", b"c"]
+    for content in contents:
+        cache.put(_digest(content), content)
+    assert cache.get(_digest(b"a")) is None
+    assert cache.get(_digest(b"c")) == b"c"
+
+
+def test_manifest_digest():
+    content = b'{"schemaVersion": 2}'
+    assert _manifest_digest({}, content, "latest") == _digest(content)
+    assert _manifest_digest({}, content, _digest(content)) == _digest(content)
+
+    with pytest.raises(ValueError):
+        _manifest_digest(
+            {"Docker-Content-Digest": _digest(b"other")}, content, "latest"
+        )
+    with pytest.raises(ValueError):
+        _manifest_digest({}, content, _digest(b"other"))
+
+
+def test_toc_cache(tmp_path):
+    blob_cache = BlobCache(str(tmp_path))
+    cache = TocCache(blob_cache)
+    diff_id = _digest(b"layer")
+    toc = [TocEntry("etc/hostname", "0", 0o644, 9, 0, 512)]
+
+    assert cache.get(diff_id) is None
+    cache.put(diff_id, toc)
+
+    assert cache.get(diff_id) == toc
+    # tables of contents are shared with other instances through the
+    # blob cache
+    assert TocCache(blob_cache).get(diff_id) == toc
+    assert TocCache().get(diff_id) is None
+
+    blob_digest = _digest(b"blob")
+    assert cache.get_index(blob_digest) is None
+    cache.put_index(blob_digest, [(0, 0), (512, 100)])
+    assert TocCache(blob_cache).get_index(blob_digest) == [(0, 0), (512, 100)]
+    assert (blob_cache.hits, blob_cache.misses) == (0, 0)
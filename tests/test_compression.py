@@ -0,0 +1,107 @@
+import gzip
+import io
+import os
+import tarfile
+
+import pytest
+
+from python_docker import compression, schema
+from python_docker.tar import index_layer
+
+
+@pytest.mark.parametrize(
+    "content",
+    [
+        b"",
+        b"hello, world!",
+        os.urandom(2**18) + b"a" * 2**18 + os.urandom(1000),
+    ],
+)
+def test_gzip_compress_round_trip(content):
+    assert gzip.decompress(compression.gzip_compress(content)) == content
+    assert gzip.decompress(compression.gzip_compress(content, threads=4)) == content
+
+
+def test_gzip_compress_deterministic():
+    content = os.urandom(2**18) + b"a" * 2**20 + os.urandom(2**17 + 1)
+
+    compressed = compression.gzip_compress(content, level=6, block_size=2**16)
+    for threads in [1, 2, 8]:
+        assert compressed == compression.gzip_compress(
+            content, level=6, threads=threads, block_size=2**16
+        )
+
+
+def test_zstd_compress_round_trip():
+    pytest.importorskip("zstandard")
+
+    content = os.urandom(2**16) + b"a" * 2**18
+    compressed = compression.compress(content, "zstd")
+    assert compressed[:4] == b"\x28\xb5\x2f\xfd"
+
+    decompressed = io.BytesIO()
+    compression.decompress_fileobj(io.BytesIO(compressed), decompressed, "zstd")
+    assert decompressed.getvalue() == content
+
+
+def test_media_type_compression():
+    assert (
+        compression.media_type_compression(schema.OCI_LAYER_ZSTD_MEDIA_TYPE) == "zstd"
+    )
+    assert (
+        compression.media_type_compression(schema.DOCKER_LAYER_GZIP_MEDIA_TYPE)
+        == "gzip"
+    )
+    with pytest.raises(ValueError):
+        compression.media_type_compression("application/octet-stream")
+
+
+def test_gzip_index_read():
+    content = os.urandom(2**18) + b"a" * 2**20 + os.urandom(2**17 + 1)
+    compressed = compression.gzip_compress(content, level=6)
+    index = compression.GzipIndex.build(io.BytesIO(compressed), spacing=2**16)
+    assert len(index.checkpoints) > 1
+
+    reads = []
+
+    def read_range(start, end):
+        reads.append((start, end))
+        return compressed[start:end]
+
+    for offset, size in [
+        (0, 10),
+        (2**18 - 5, 10),
+        (2**20, 2**16),
+        (len(content) - 3, 10),
+    ]:
+        assert index.read(read_range, offset, size) == content[offset : offset + size]
+    assert all(end is None or end - start < len(compressed) for start, end in reads)
+
+
+def test_gzip_compress_toc_round_trip():
+    with open("tests/assets/busybox.tar", "rb") as f:
+        image_tar = tarfile.open(fileobj=f)
+        member = next(m for m in image_tar.getmembers() if m.name.endswith("layer.tar"))
+        content = image_tar.extractfile(member).read()
+    toc = index_layer(io.BytesIO(content))
+
+    compressed = io.BytesIO()
+    compression.gzip_compress_toc_fileobj(
+        io.BytesIO(content), compressed, toc, spacing=2**16
+    )
+    compressed = compressed.getvalue()
+    assert gzip.decompress(compressed) == content
+    assert compression.read_gzip_toc(lambda a, b: compressed[a:b]) is not None
+
+    read_toc, index = compression.read_gzip_toc(lambda a, b: compressed[a:b])
+    assert read_toc == toc
+    assert len(index.checkpoints) > 1
+    for entry in toc:
+        if entry.type == tarfile.REGTYPE.decode("ascii"):
+            assert (
+                index.read(lambda a, b: compressed[a:b], entry.offset_data, entry.size)
+                == content[entry.offset_data : entry.offset_data + entry.size]
+            )
+
+    plain = compression.gzip_compress(content)
+    assert compression.read_gzip_toc(lambda a, b: plain[a:b]) is None
@@ -1,7 +1,12 @@
+import io
 import tempfile
 import os
 
-from python_docker.base import Image
+import pytest
+
+from python_docker.base import Image, Layer
+from python_docker.cache import BlobCache, TocCache
+from python_docker.tar import index_tar
 
 
 def test_read_docker_image_from_file():
@@ -141,3 +146,207 @@ def test_remove_layer():
         image.run(["ls", "/"])
         == b"bin\ndev\netc\nhome\nproc\nroot\nsys\ntmp\nusr\nvar\n"
     )
+
+
+def test_file_storage_layer():
+    filename = "tests/assets/busybox.tar"
+    image = Image.from_filename(filename)[0]
+
+    file_image = Image(image.name, image.tag, storage="file")
+    file_image.add_layer_path("tests/assets/example", "/this/is/a/path")
+    image.add_layer_path("tests/assets/example", "/this/is/a/path")
+    layer, file_layer = image.layers[0], file_image.layers[0]
+
+    assert not hasattr(file_layer, "_cached_content")
+    assert file_layer.size == layer.size
+    assert file_layer.checksum == layer.checksum
+    assert file_layer.compressed_checksum == layer.compressed_checksum
+    assert file_layer.compressed_content == layer.compressed_content
+    assert isinstance(file_layer.content, bytes)
+    assert file_layer.content_buffer == layer.content_buffer == layer.content
+    assert file_layer.list_files() == layer.list_files()
+
+
+def test_read_write_file_storage_layer():
+    filename = "tests/assets/busybox.tar"
+    image = Image.from_filename(filename)[0]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        layer_filename = os.path.join(tmpdir, "layer.tar")
+        with open(layer_filename, "wb") as f:
+            f.write(image.layers[0].content)
+
+        file_image = Image(image.name, image.tag, [Layer("id", None, layer_filename)])
+        filename = os.path.join(tmpdir, "docker.tar")
+        file_image.write_filename(filename)
+        new_image = Image.from_filename(filename)[0]
+
+    assert new_image.layers[0].checksum == image.layers[0].checksum
+
+
+def test_write_streamed_layer():
+    filename = "tests/assets/busybox.tar"
+    image = Image.from_filename(filename)[0]
+    content = bytes(image.layers[0].content)
+
+    def _content():
+        raise AssertionError("layer content should be streamed")
+
+    streamed_image = Image(
+        image.name,
+        image.tag,
+        [Layer("id", None, _content, content_stream=lambda: io.BytesIO(content))],
+    )
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, "docker.tar")
+        streamed_image.write_filename(filename)
+        new_image = Image.from_filename(filename)[0]
+
+    assert streamed_image.layers[0].size == len(content)
+    assert streamed_image.layers[0].checksum == image.layers[0].checksum
+    assert new_image.layers[0].checksum == image.layers[0].checksum
+
+
+def test_read_docker_image_from_file_lazily():
+    filename = "tests/assets/busybox.tar"
+    image = Image.from_filename(filename)[0]
+    checksum = image.layers[0].checksum
+
+    # layers are read from the image tar when used
+    assert not hasattr(image.layers[0], "_cached_content")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, "docker.tar")
+        image.write_filename(filename)
+
+        # overwrite the tar the layers are read from
+        image = Image.from_filename(filename)[0]
+        image.add_layer_contents({"/a/b/c.txt": b"hello, world!"})
+        image.write_filename(filename)
+        new_image = Image.from_filename(filename)[0]
+
+        assert len(new_image.layers) == 2
+        assert new_image.layers[1].checksum == checksum
+        assert new_image.layers[0].list_files() == ["/a/b/c.txt"]
+
+
+def test_index_tar(monkeypatch):
+    filename = "tests/assets/busybox.tar"
+    with index_tar(filename) as index:
+        content = index["repositories"].read()
+        assert b"busybox" in content
+
+        # windows has no os.pread
+        monkeypatch.delattr("os.pread")
+        assert index["repositories"].read() == content
+        assert index["repositories"].read(2, 3) == content[2:5]
+    assert index.file.closed
+
+
+def test_squash_layers():
+    filename = "tests/assets/busybox.tar"
+    image = Image.from_filename(filename)[0]
+    base_files = set(image.layers[0].list_files())
+    assert "etc/passwd" in base_files
+
+    image.add_layer_contents({"/etc/.wh.passwd": b"", "/hello.txt": b"1"})
+    image.add_layer_contents({"/hello.txt": b"2"})
+    top_id = image.layers[0].id
+
+    upper = Image(image.name, image.tag, list(image.layers))
+    upper.squash(0, 2)
+    assert len(upper.layers) == 2
+    assert upper.layers[0].id == top_id
+    assert upper.layers[0].parent == upper.layers[1].id
+    # whiteouts apply to the layers below the squashed ones
+    assert sorted(upper.layers[0].list_files()) == ["/etc/.wh.passwd", "/hello.txt"]
+
+    image.squash()
+    assert len(image.layers) == 1
+    assert image.layers[0].parent is None
+    with image.layers[0].tar as tar:
+        assert set(tar.getnames()) == base_files - {"etc/passwd"} | {"/hello.txt"}
+        assert tar.extractfile("/hello.txt").read() == b"2"
+
+    # whiteouts of paths added again above are dropped while opaque
+    # markers still hide the layers below
+    image.add_layer_contents({"/.wh.hello.txt": b"", "/opt/.wh..wh..opq": b""})
+    image.add_layer_contents({"/hello.txt": b"3", "/opt/x": b"x"})
+    image.squash(0, 2)
+    assert sorted(image.layers[0].list_files()) == [
+        "/hello.txt",
+        "/opt/.wh..wh..opq",
+        "/opt/x",
+    ]
+
+
+def test_squash_layers_opaque_directory():
+    image = Image("example", "latest")
+    image.add_layer_contents({"/opt/a": b"a"})
+    image.add_layer_contents({"/opt/.wh..wh..opq": b"", "/opt/c": b"c"})
+    image.add_layer_contents({"/opt/b": b"b"})
+
+    image.squash(0, 2)
+    assert len(image.layers) == 2
+    assert sorted(image.layers[0].list_files()) == [
+        "/opt/.wh..wh..opq",
+        "/opt/b",
+        "/opt/c",
+    ]
+
+    image.squash()
+    assert sorted(image.layers[0].list_files()) == ["/opt/b", "/opt/c"]
+
+
+def test_layer_read_file(tmp_path):
+    filename = "tests/assets/busybox.tar"
+    layer = Image.from_filename(filename)[0].layers[0]
+
+    with layer.tar as tar:
+        assert layer.list_files() == tar.getnames()
+        assert layer.read_file("etc/passwd") == tar.extractfile("etc/passwd").read()
+        # links are followed
+        assert layer.read_file("/bin/ls") == tar.extractfile("bin/busybox").read()
+
+    with pytest.raises(KeyError):
+        layer.read_file("etc")
+
+    cache = TocCache(BlobCache(str(tmp_path)))
+    cached_layer = Layer("id", None, bytes(layer.content), toc_cache=cache)
+    assert cached_layer.list_files() == layer.list_files()
+    assert cache.get(f"sha256:{layer.checksum}") == layer.toc
+
+
+def test_layer_original_blob():
+    layer = Image.from_filename("tests/assets/busybox.tar")[0].layers[0]
+    layer.compression_level = 1
+    blob = bytes(layer.compressed_content)
+
+    opened = []
+
+    def _open_blob():
+        opened.append(True)
+        return io.BytesIO(blob)
+
+    pulled = Layer(
+        id=layer.id,
+        parent=None,
+        content=bytes(layer.content),
+        checksum=layer.checksum,
+        compressed_size=len(blob),
+        compressed_checksum=layer.compressed_checksum,
+        compressed_content_stream=_open_blob,
+    )
+    assert pulled.compressed_checksum == layer.compressed_checksum
+    assert pulled.compressed_size == len(blob)
+    assert not opened
+
+    assert bytes(pulled.compressed_content) == blob
+    assert len(opened) == 1
+
+    pulled.compression = "zstd"
+    assert pulled.compressed_checksum != layer.compressed_checksum
+    pulled.compression = "gzip"
+    assert pulled.compressed_checksum == layer.compressed_checksum
+    assert bytes(pulled.compressed_content) == blob
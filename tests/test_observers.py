@@ -0,0 +1,78 @@
+import logging
+
+import pytest
+
+from python_docker.observers import (
+    LoggingObserver,
+    RequestEvent,
+    RequestMetrics,
+    url_template,
+)
+
+
+@pytest.mark.parametrize(
+    "url, template",
+    [
+        ("http://localhost:5000/v2/", "/v2/"),
+        ("http://localhost:5000/v2/_catalog?n=10", "/v2/_catalog"),
+        ("/v2/library/busybox/tags/list", "/v2/{name}/tags/list"),
+        ("/v2/library/busybox/manifests/latest", "/v2/{name}/manifests/{reference}"),
+        ("/v2/foo/bar/blobs/sha256:abc123", "/v2/{name}/blobs/{digest}"),
+        ("/v2/foo/bar/blobs/uploads/", "/v2/{name}/blobs/uploads/"),
+        (
+            "/v2/foo/bar/blobs/uploads/1234-abcd?_state=x",
+            "/v2/{name}/blobs/uploads/{uuid}",
+        ),
+    ],
+)
+def test_url_template(url, template):
+    assert url_template(url) == template
+
+
+def _event(method="GET", url="/v2/foo/blobs/sha256:abc", status=200, **kwargs):
+    return RequestEvent(
+        method=method,
+        url=url,
+        url_template=url_template(url),
+        status=status,
+        bytes_sent=kwargs.get("bytes_sent", 0),
+        bytes_received=kwargs.get("bytes_received", 100),
+        seconds=kwargs.get("seconds", 0.5),
+        retries=kwargs.get("retries", 0),
+        error=kwargs.get("error"),
+    )
+
+
+def test_request_metrics():
+    metrics = RequestMetrics()
+    metrics(_event())
+    metrics(_event(retries=1))
+    metrics(_event(method="HEAD", status=404, bytes_received=0))
+    metrics(_event(status=None, error=ConnectionError()))
+
+    assert metrics.get("requests_total") == 4
+    assert metrics.get("requests_total", method="GET", status="200") == 2
+    assert metrics.get("requests_total", status="error") == 1
+    assert metrics.get("request_retries_total") == 1
+    assert metrics.get("request_seconds_total", method="GET") == 1.5
+    assert (
+        metrics.get(
+            "request_received_bytes_total", url_template="/v2/{name}/blobs/{digest}"
+        )
+        == 300
+    )
+
+    rendered = metrics.render()
+    assert "# TYPE python_docker_registry_requests_total counter" in rendered
+    assert (
+        'python_docker_registry_requests_total{method="HEAD",url="/v2/{name}/blobs/{digest}",status="404"} 1'
+        in rendered
+    )
+
+
+def test_logging_observer(caplog):
+    observer = LoggingObserver(level=logging.INFO)
+    with caplog.at_level(logging.INFO, logger="python_docker.registry"):
+        observer(_event())
+
+    assert "GET /v2/foo/blobs/sha256:abc 200" in caplog.text
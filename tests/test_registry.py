@@ -1,6 +1,12 @@
+import hashlib
+
 import pytest
+import requests
 
+from benchmarks.stub_registry import StubRegistry
 from python_docker import docker
+from python_docker.cache import BlobCache
+from python_docker.observers import RequestMetrics
 from python_docker.registry import Registry
 from python_docker.base import Image
 
@@ -86,6 +92,11 @@ def test_local_docker_pull():
     assert image.tag == new_tag
     assert len(image.layers) == 1
 
+    prefetched_image = registry.pull_image(
+        new_image, new_tag, lazy=True, max_workers=2, prefetch=True
+    )
+    assert prefetched_image.layers[0].content == image.layers[0].content
+
 
 @pytest.mark.parametrize(
     "config",
@@ -131,3 +142,187 @@ def test_local_docker_delete():
 
     available_tags = registry.list_image_tags(new_image)
     assert available_tags is None or new_tag not in available_tags
+
+
+def test_local_docker_download_blob():
+    filename = "tests/assets/hello-world.tar"
+    image = Image.from_filename(filename)[0]
+
+    registry = Registry(hostname="http://localhost:5000")
+    registry.push_image(image)
+
+    layer = image.layers[0]
+    blobsum = f"sha256:{layer.compressed_checksum}"
+    with registry.download_blob(image.name, blobsum, chunk_size=1024) as fileobj:
+        assert fileobj.read() == layer.compressed_content
+
+
+def test_local_docker_push_chunked():
+    filename = "tests/assets/busybox.tar"
+    image = Image.from_filename(filename)[0]
+    image.name = "library/chunkedbusybox"
+
+    registry = Registry(hostname="http://localhost:5000")
+    registry.push_image(image, chunk_size=2**16)
+
+    new_image = registry.pull_image(image.name, image.tag)
+    assert new_image.layers[0].checksum == image.layers[0].checksum
+
+
+def test_local_docker_push_mount():
+    filename = "tests/assets/busybox.tar"
+    image = Image.from_filename(filename)[0]
+    image.name = "library/mountbusybox"
+
+    registry = Registry(hostname="http://localhost:5000")
+    registry.push_image(image)
+
+    new_image = registry.pull_image(image.name, image.tag, lazy=True)
+    assert new_image.layers[0].source == ("http://localhost:5000", image.name)
+
+    new_image.name = "library/mountedbusybox"
+    registry.push_image(new_image)
+
+    blobsum = f"sha256:{image.layers[0].compressed_checksum}"
+    assert registry.check_blob(new_image.name, blobsum)
+
+
+def test_dockerhub_pull_platform():
+    registry = Registry("https://registry-1.docker.io")
+    image = registry.pull_image(
+        "library/busybox", "1.34.0", lazy=True, platform="linux/arm64"
+    )
+    assert image.platform == "linux/arm64/v8"
+    assert len(image.layers) == 1
+
+    with pytest.raises(ValueError):
+        registry.pull_image(
+            "library/busybox", "1.34.0", lazy=True, platform="windows/amd64"
+        )
+
+
+def test_local_docker_push_index():
+    filename = "tests/assets/busybox.tar"
+    amd64_image = Image.from_filename(filename)[0]
+    amd64_image.platform = "linux/amd64"
+    arm64_image = Image.from_filename(filename)[0]
+    arm64_image.platform = "linux/arm64/v8"
+    arm64_image.add_layer_contents({"arch": b"arm64"})
+
+    registry = Registry(hostname="http://localhost:5000")
+    registry.push_index("library/multibusybox", "latest", [amd64_image, arm64_image])
+
+    image = registry.pull_image(
+        "library/multibusybox", "latest", lazy=True, platform="linux/arm64"
+    )
+    assert image.platform == "linux/arm64/v8"
+    assert image.layers[0].read_file("arch") == b"arm64"
+
+    image = registry.pull_image("library/multibusybox", "latest", lazy=True)
+    assert image.platform == "linux/amd64"
+    assert len(image.layers) == 1
+
+
+class _LostResponseRegistry(Registry):
+    """Registry whose blob upload completing requests lose their response"""
+
+    def _send(self, method, url, retries=0, session=None, **kwargs):
+        response = super()._send(method, url, retries, session, **kwargs)
+        if method == "PUT" and "digest" in (kwargs.get("params") or {}):
+            response.close()
+            raise requests.ConnectionError("connection reset")
+        return response
+
+
+def test_stub_upload_blob_lost_response():
+    content = b"hello, world!"
+    checksum = hashlib.sha256(content).hexdigest()
+
+    with StubRegistry() as stub:
+        registry = _LostResponseRegistry(stub.url)
+        registry.upload_blob("library/lost", content, checksum)
+        assert registry.check_blob("library/lost", f"sha256:{checksum}")
+        # the completing request is sent once rather than retried
+        assert sum(method == "PUT" for method, _ in stub.requests) == 1
+
+
+def test_stub_push_image_compression():
+    pytest.importorskip("zstandard")
+    image = Image.from_filename("tests/assets/busybox.tar")[0]
+    image.name = "library/busybox"
+
+    with StubRegistry() as stub:
+        registry = Registry(stub.url)
+        registry.push_image(image, compression="zstd")
+        pulled_image = registry.pull_image(image.name, image.tag)
+
+    # the layers of the pushed image are left unchanged
+    assert image.layers[0].compression == "gzip"
+    assert pulled_image.layers[0]._blob_compression == "zstd"
+    assert pulled_image.layers[0].checksum == image.layers[0].checksum
+
+
+def test_stub_pull_lazy_layer_tar():
+    image = Image.from_filename("tests/assets/busybox.tar")[0]
+    image.name = "library/busybox"
+
+    with StubRegistry() as stub:
+        registry = Registry(stub.url)
+        registry.push_image(image)
+        lazy_image = registry.pull_image(image.name, image.tag, lazy=True)
+        with lazy_image.layers[0].tar as tar:
+            content = tar.extractfile("etc/passwd").read()
+
+    assert content == image.layers[0].read_file("etc/passwd")
+    assert tar.fileobj.closed
+
+
+def _blob_bytes(metrics):
+    return metrics.get(
+        "request_received_bytes_total", url_template="/v2/{name}/blobs/{digest}"
+    )
+
+
+@pytest.mark.parametrize("compression_toc", [False, True])
+def test_stub_lazy_read_file_bytes(tmp_path, compression_toc):
+    image = Image.from_filename("tests/assets/busybox.tar")[0]
+    image.name = "library/busybox"
+    image.layers[0].compression_toc = compression_toc
+    blob_size = image.layers[0].compressed_size
+    passwd = image.layers[0].read_file("etc/passwd")
+
+    with StubRegistry() as stub:
+        Registry(stub.url).push_image(image)
+
+        metrics = RequestMetrics()
+        registry = Registry(
+            stub.url, cache=BlobCache(str(tmp_path)), observers=[metrics]
+        )
+        layer = registry.pull_image(image.name, image.tag, lazy=True).layers[0]
+        # image configuration
+        pulled = _blob_bytes(metrics)
+        assert layer.read_file("etc/passwd") == passwd
+        assert layer.read_file("etc/group")
+        assert layer.list_files() == image.layers[0].list_files()
+        if compression_toc:
+            assert _blob_bytes(metrics) - pulled < blob_size // 10
+        else:
+            # blobs without table of contents are fetched once
+            assert _blob_bytes(metrics) - pulled <= blob_size + 1024
+
+        # the table of contents and gzip index persist in the cache
+        metrics = RequestMetrics()
+        registry = Registry(
+            stub.url, cache=BlobCache(str(tmp_path)), observers=[metrics]
+        )
+        layer = registry.pull_image(image.name, image.tag, lazy=True).layers[0]
+        pulled = _blob_bytes(metrics)
+        requests_pulled = metrics.get("requests_total")
+        assert layer.read_file("etc/passwd") == passwd
+        if compression_toc:
+            # a single range request for the file
+            assert metrics.get("requests_total") == requests_pulled + 1
+            assert _blob_bytes(metrics) - pulled < blob_size // 10
+        else:
+            # the blob fetched before is read from the cache
+            assert metrics.get("requests_total") == requests_pulled
@@ -0,0 +1,71 @@
+import email.utils
+import io
+import os
+
+import pytest
+
+from python_docker import utils
+from python_docker.registry import _body_position, _parse_range_offset
+from python_docker.retry import RetryPolicy, parse_retry_after
+
+
+@pytest.mark.parametrize(
+    "retry_after, seconds",
+    [
+        (None, None),
+        ("0", 0.0),
+        ("120", 120.0),
+        (email.utils.formatdate(1000 + 30, usegmt=True), 30.0),
+        (email.utils.formatdate(1000 - 30, usegmt=True), 0.0),
+        ("not a date", None),
+    ],
+)
+def test_parse_retry_after(retry_after, seconds):
+    assert parse_retry_after(retry_after, now=1000) == seconds
+
+
+def test_retry_policy_backoff():
+    retry = RetryPolicy(total=3, backoff_factor=1.0, backoff_max=5.0)
+
+    for retries, maximum in [(0, 1.0), (1, 2.0), (2, 4.0)]:
+        assert 0 <= retry.delay(retries) <= maximum
+    assert retry.delay(3) is None
+    # backoff is capped and is not limited by total
+    assert 0 <= retry.backoff(10) <= 5.0
+
+
+def test_retry_policy_retry_after():
+    retry = RetryPolicy(total=3, backoff_max=5.0)
+
+    assert retry.delay(0, retry_after="2") == 2.0
+    assert retry.delay(0, retry_after="60") is None
+    assert retry.delay(3, retry_after="2") is None
+    assert retry.should_retry_status(503)
+    assert not retry.should_retry_status(404)
+
+
+def test_body_position():
+    fileobj = io.BytesIO(b"abc")
+    fileobj.seek(1)
+    assert _body_position(fileobj) == 1
+    assert _body_position(b"abc") is None
+
+    read_fd, write_fd = os.pipe()
+    with os.fdopen(read_fd, "rb") as pipe, os.fdopen(write_fd, "wb"):
+        assert _body_position(pipe) is None
+
+    reader = utils.VerifyingReader(io.BytesIO(b"abc"), "sha256:00")
+    assert _body_position(reader) is None
+
+
+@pytest.mark.parametrize(
+    "headers, uploaded, offset",
+    [
+        ({}, 0, None),
+        ({"Range": "0-0"}, 0, 0),
+        ({"Range": "0-0"}, 1, 1),
+        ({"Range": "0-99"}, 0, 100),
+    ],
+)
+def test_parse_range_offset(headers, uploaded, offset):
+    assert _parse_range_offset(headers, uploaded) == offset